@@ -1,5 +1,8 @@
 #include "AccelStepper.h"
 
+// Set by the sketch while the serial link is framed; the debug prints below are text only
+extern bool binaryMode;
+
 //////////////////////////////////////////////////////
 // Defines a 1-Axis Control for our Battery CNC Controller
 // This class assumes that a stepper controller is used
@@ -72,7 +75,9 @@ public:
   }
 
   // Run the stepper according to active program. Will not process past home.
+  // Calls yield() like delay() does, so the sketch's heartbeat runs during blocking moves.
   void run() {
+    yield();
     if (ESTOPPED) {
       stop();
       return;
@@ -93,14 +98,18 @@ public:
       return;
     }
     delay(5);
-    Serial.println("# Homing");
+    if (!binaryMode)
+      Serial.println("# Homing");
     stepper.setSpeed(inverted ? homeSpeed : -homeSpeed);
-    Serial.println(ESTOPPED);
+    if (!binaryMode)
+      Serial.println(ESTOPPED);
     while (digitalRead(mHomePin) == HIGH && !ESTOPPED) {
+      yield();
       stepper.runSpeed();
       // delay(5);
     }
-    Serial.println(ESTOPPED);
+    if (!binaryMode)
+      Serial.println(ESTOPPED);
     stepper.stop();
     delay(50);
     move(100);
@@ -113,7 +122,8 @@ public:
 
   // Emergency stop
   void eStop() {
-    Serial.println("# EMERGENCY STOP");
+    if (!binaryMode)
+      Serial.println("# EMERGENCY STOP");
     ESTOPPED = true;
     stepper.stop();
     stepper.run();
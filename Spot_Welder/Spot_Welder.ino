@@ -16,6 +16,37 @@ const int yHomePin = A1;
 const int zHomePin = A2;
 
 #define WELD_TIME 800
+#define TEXT_BAUD 9600
+
+// Framed binary protocol, see welder/protocol.py
+#define FRAME_SYNC 0xA5
+#define FRAME_MAX_PAYLOAD 120
+// Back to text at TEXT_BAUD after this long without a valid frame, in ms
+#define LINK_TIMEOUT 2000
+// Weld mask storage, two bits per cell (480 cells); fits in one frame
+#define MAX_WELD_BYTES FRAME_MAX_PAYLOAD
+
+enum FrameType {
+  F_COMMAND = 0x01,
+  F_PING = 0x02,
+  F_ACK = 0x10,
+  F_PROGRESS = 0x11,
+  F_STATUS = 0x12,
+  F_DONE = 0x13,
+  F_WELDS = 0x14,
+  F_TEXT = 0x15,
+  F_AXES = 0x16
+};
+
+enum Status {
+  ST_IDLE,
+  ST_MOVING,
+  ST_PAUSED,
+  ST_FINISHED,
+  ST_ESTOP,
+  ST_PONG
+};
+const char *STATUS_TEXT[] = {"idle", "moving", "paused", "finished", "ESTOP", "pong"};
 
 enum PackType {
   PT_A,
@@ -39,9 +70,85 @@ const float Z_STEPDOWN = 400;
 const float WELD_SPACE = 1016.0 * 0.12;
 
 int row = 0, cell = 0, side = 0;
-uint8_t welded[16][24] = {0};
+// Pack shape, set with packShape
+int packRows = 16, packCells = 24;
+// Weld mask, bit (row * packCells + cell) * 2 + side, least significant bit first
+uint8_t welded[MAX_WELD_BYTES] = {0};
+
+// Command that arrived while a job was running, run by loop() afterwards
+String deferredCmd = "";
+// Framing state: seq of the last frame sent, of the last command read and of deferredCmd
+bool binaryMode = false;
+uint8_t txSeq = 0, cmdSeq = 0, deferredSeq = 0;
+unsigned long lastFrame = 0;
+// Axes with a non-blocking move whose completion still has to be reported
+bool xAwaiting = false, yAwaiting = false, zAwaiting = false;
+// Hold-to-jog: the axis being jogged and when the host last renewed the jog. A jog
+// not renewed for JOG_TIMEOUT ms stops, so a lost key release can't run an axis away.
+const unsigned long JOG_TIMEOUT = 300;
+const float JOG_DISTANCE = 10000;
+Axis *jogAxis = NULL;
+unsigned long lastJog = 0;
+// Heartbeat: once the host asks with "heartbeat <ms>", a pong goes out at least that
+// often, also in the middle of a job, so the host notices a dead link within a few
+// intervals. 0 (the default after a reset) turns it off.
+unsigned long beatInterval = 0;
+unsigned long lastBeat = 0;
+// Set by the e-stop interrupt; the ESTOP status goes out from yield() or loop()
+volatile bool eStopPending = false;
+// Weld hold and settling delays in ms, the host may tune them with "setTiming"
+unsigned long weldTime = WELD_TIME;
+unsigned long cellDelay = 100;
+unsigned long passDelay = 1000;
+unsigned long rowDelay = 3000;
 
 void moveToCell(int mRow, int mCell, int mSide, PackType packType, bool retract = true);
+void moveToPoint(float px, float py, bool retract = true);
+
+// Run axis in direction (sign only) until jogStop() or JOG_TIMEOUT without a renewal
+bool jog(Axis &axis, float direction) {
+  if (direction == 0)
+    return false;
+  if (jogAxis != NULL && jogAxis != &axis)
+    jogAxis->stop();
+  jogAxis = &axis;
+  lastJog = millis();
+  axis.move(direction > 0 ? JOG_DISTANCE : -JOG_DISTANCE);
+  return true;
+}
+
+// Decelerate a jogged axis, "done" follows once it stands
+void jogStop(Axis &axis, bool &awaiting) {
+  axis.stop();
+  awaiting = true;
+  if (jogAxis == &axis)
+    jogAxis = NULL;
+}
+
+// Send the heartbeat when it is due. Never from the e-stop interrupt, which could cut
+// into a frame being sent.
+void beat() {
+  if (beatInterval == 0 || !(SREG & _BV(SREG_I)) || millis() - lastBeat < beatInterval)
+    return;
+  lastBeat = millis();
+  sendStatus(ST_PONG);
+}
+
+// Report an emergency stop noted by the interrupt. Like the heartbeat, never from the
+// interrupt itself, which could cut into a frame being sent.
+void reportEStop() {
+  if (!eStopPending || !(SREG & _BV(SREG_I)))
+    return;
+  eStopPending = false;
+  sendStatus(ST_ESTOP);
+}
+
+// delay() and the blocking loops in Axis.h call yield(), so the heartbeat and the
+// e-stop report keep going through welds, fixed delays and blocking moves
+void yield() {
+  reportEStop();
+  beat();
+}
 
 void eStop() {
   delay(20);
@@ -51,11 +158,11 @@ void eStop() {
   y.eStop();
   z.eStop();
   stopped = true;
-  Serial.println("ESTOP");
+  eStopPending = true;
 }
 
 void setup() {
-  Serial.begin(9600);
+  Serial.begin(TEXT_BAUD);
 
   // Configure X Axis Settings
   x.setMaxSpeed(1000);
@@ -86,19 +193,324 @@ void setup() {
   z.resetEStop();
 }
 
-// Weld the current cell
-void zWeld() {
+////////////////////////////////////////////////////////////////////////
+// Output, as text lines or frames
+uint16_t crc16(const uint8_t *data, int length, uint16_t crc = 0xFFFF) {
+  for (int i = 0; i < length; i++) {
+    crc ^= (uint16_t)data[i] << 8;
+    for (int bit = 0; bit < 8; bit++)
+      crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+  }
+  return crc;
+}
+
+void sendFrame(uint8_t type, const uint8_t *payload, uint8_t length) {
+  uint8_t header[4] = {FRAME_SYNC, length, txSeq++, type};
+  uint16_t crc = crc16(payload, length, crc16(header + 1, 3));
+  Serial.write(header, 4);
+  Serial.write(payload, length);
+  Serial.write(crc & 0xFF);
+  Serial.write(crc >> 8);
+}
+
+// Any other output, e.g. query results
+void sendLine(String line) {
+  if (binaryMode)
+    sendFrame(F_TEXT, (const uint8_t *)line.c_str(), min(line.length(), FRAME_MAX_PAYLOAD));
+  else
+    Serial.println(line);
+}
+
+// Debug lines are only sent in the text protocol
+void sendDebug(String line) {
+  if (!binaryMode)
+    Serial.println(line);
+}
+
+// Status word; in frames idle and moving carry the axis positions
+void sendStatus(uint8_t status) {
+  if (!binaryMode) {
+    Serial.println(STATUS_TEXT[status]);
+    return;
+  }
+  uint8_t payload[13] = {status};
+  if (status != ST_IDLE && status != ST_MOVING) {
+    sendFrame(F_STATUS, payload, 1);
+    return;
+  }
+  int32_t positions[3] = {(int32_t)x.getPosition(), (int32_t)y.getPosition(), (int32_t)z.getPosition()};
+  memcpy(payload + 1, positions, sizeof(positions));
+  sendFrame(F_STATUS, payload, sizeof(payload));
+}
+
+// Positions, targets and running flags (bit 0 x, 1 y, 2 z) of all axes, the answer to status
+void sendAxes() {
+  int32_t values[6] = {(int32_t)x.getPosition(), (int32_t)y.getPosition(), (int32_t)z.getPosition(),
+                       (int32_t)x.getTargetPosition(), (int32_t)y.getTargetPosition(), (int32_t)z.getTargetPosition()};
+  uint8_t running = x.isRunning() | y.isRunning() << 1 | z.isRunning() << 2;
+  if (binaryMode) {
+    uint8_t payload[sizeof(values) + 1];
+    memcpy(payload, values, sizeof(values));
+    payload[sizeof(values)] = running;
+    sendFrame(F_AXES, payload, sizeof(payload));
+    return;
+  }
+  Serial.print("S");
+  for (int i = 0; i < 6; i++) {
+    Serial.print(" ");
+    Serial.print(values[i]);
+  }
+  Serial.print(" ");
+  Serial.println(running);
+}
+
+// Result of a command, seq is the frame it arrived in
+void sendAck(String cmd, bool ok, uint8_t seq) {
+  if (binaryMode) {
+    uint8_t payload[2] = {seq, ok};
+    sendFrame(F_ACK, payload, 2);
+  }
+  else
+    Serial.println((ok ? "ok " : "err ") + cmd);
+}
+
+void sendDone(const char *name) {
+  if (binaryMode)
+    sendFrame(F_DONE, (const uint8_t *)name, 1);
+  else {
+    Serial.print("done ");
+    Serial.println(name);
+  }
+}
+
+void sendProgress() {
+  if (binaryMode) {
+    uint8_t payload[3] = {(uint8_t)row, (uint8_t)side, (uint8_t)cell};
+    sendFrame(F_PROGRESS, payload, 3);
+    return;
+  }
   Serial.print("R");
   Serial.print(row); // Row count
   Serial.print(" ");
   Serial.print(side); // Pass count
   Serial.print(" ");
   Serial.println(cell); // Cell count
-  z.stepdownCycle(WELD_TIME);
-  welded[row][cell] |= (1 << side);
 }
 
-// Run the script to weld a series of 24 cells
+// Read the next command, from a line or from an F_COMMAND frame. Returns an empty
+// string for pings, corrupted frames and frames that aren't commands.
+String readCommand() {
+  if (!binaryMode) {
+    String cmd = Serial.readStringUntil('\n');
+    cmd.trim();
+    return cmd;
+  }
+  if (Serial.read() != FRAME_SYNC)
+    return "";
+  uint8_t header[3];
+  uint8_t payload[FRAME_MAX_PAYLOAD + 1];
+  uint8_t crc[2];
+  if (Serial.readBytes(header, 3) != 3 || header[0] > FRAME_MAX_PAYLOAD)
+    return "";
+  if (Serial.readBytes(payload, header[0]) != header[0] || Serial.readBytes(crc, 2) != 2)
+    return "";
+  if (crc16(payload, header[0], crc16(header, 3)) != (crc[0] | crc[1] << 8))
+    return "";
+  lastFrame = millis();
+  cmdSeq = header[1];
+  if (header[2] == F_PING) {
+    sendStatus(ST_PONG);
+    return "";
+  }
+  if (header[2] == F_WELDS) {
+    // Weld mask as bytes, run as setWelds
+    String cmd = "setWelds ";
+    for (int i = 0; i < header[0]; i++) {
+      if (payload[i] < 16)
+        cmd += '0';
+      cmd += String(payload[i], HEX);
+    }
+    return cmd;
+  }
+  if (header[2] != F_COMMAND)
+    return "";
+  payload[header[0]] = 0;
+  String cmd = (char *)payload;
+  cmd.trim();
+  return cmd;
+}
+
+bool inPack(int mRow, int mCell, int mSide) {
+  return mRow >= 0 && mRow < packRows && mCell >= 0 && mCell < packCells && (mSide == 0 || mSide == 1);
+}
+
+// Bytes of the weld mask in use for the current pack shape
+int weldBytes() {
+  return (packRows * packCells * 2 + 7) / 8;
+}
+
+bool isWelded(int mRow, int mCell, int mSide) {
+  int i = (mRow * packCells + mCell) * 2 + mSide;
+  return welded[i >> 3] & (1 << (i & 7));
+}
+
+// Weld the current cell
+void zWeld() {
+  sendProgress();
+  z.stepdownCycle(weldTime);
+  if (inPack(row, cell, side)) {
+    int i = (row * packCells + cell) * 2 + side;
+    welded[i >> 3] |= 1 << (i & 7);
+  }
+}
+
+// Send the weld mask as "W <hex>": two bits per cell (side 0 low), four cells per byte
+void sendWelds() {
+  if (binaryMode) {
+    sendFrame(F_WELDS, welded, weldBytes());
+    return;
+  }
+  Serial.print("W ");
+  for (int i = 0; i < weldBytes(); i++) {
+    if (welded[i] < 16)
+      Serial.print('0');
+    Serial.print(welded[i], HEX);
+  }
+  Serial.println();
+}
+
+int hexDigit(char c) {
+  if (c >= '0' && c <= '9')
+    return c - '0';
+  if (c >= 'A' && c <= 'F')
+    return c - 'A' + 10;
+  if (c >= 'a' && c <= 'f')
+    return c - 'a' + 10;
+  return -1;
+}
+
+// Load the weld mask in the format of sendWelds(). Returns false if it is malformed.
+bool loadWelds(String hex) {
+  if ((int)hex.length() != weldBytes() * 2)
+    return false;
+  for (unsigned int i = 0; i < hex.length(); i++) {
+    if (hexDigit(hex[i]) < 0)
+      return false;
+  }
+  for (int i = 0; i < weldBytes(); i++)
+    welded[i] = hexDigit(hex[2 * i]) << 4 | hexDigit(hex[2 * i + 1]);
+  return true;
+}
+
+// Read the next job control word (stop, pause, continue or next)
+// Any other command is kept in deferredCmd for loop() and an empty string is returned
+String readControl() {
+  String cmd = readCommand();
+  sendDebug("# " + cmd);
+  if (cmd == "stop" || cmd == "pause" || cmd == "continue" || cmd == "next")
+    return cmd;
+  if (cmd.length() > 0) {
+    deferredCmd = cmd;
+    deferredSeq = cmdSeq;
+  }
+  return "";
+}
+
+// Handle pause/stop requests sent between welds
+// Sets stopped on "stop"; in manual mode waits for "next"
+void pollPause(bool manual = false) {
+  while (Serial.available() || manual) {
+    String cmd = readControl();
+    if (cmd == "stop") {
+      stopped = true;
+      break;
+    }
+    while (cmd == "pause") {
+      while (!Serial.available()) {
+        sendStatus(ST_PAUSED);
+        delay(100);
+      }
+      String next = readControl();
+      if (next == "stop") {
+        stopped = true;
+        break;
+      }
+      if (next != "")
+        cmd = next;
+    }
+    if (manual && cmd == "next")
+      break;
+    delay(20);
+  }
+}
+
+// Weld a single cell of a host-planned sequence
+// Z travels at Z_ZERO between cells like in runSeries, unless it was left lower
+void weldCell(int mRow, int mCell, int mSide) {
+  stopped = false;
+  moveToCell(mRow, mCell, mSide, packType, z.getPosition() > Z_ZERO);
+  delay(cellDelay);
+  zWeld();
+  delay(cellDelay);
+  pollPause();
+}
+
+// Weld at an absolute position from the host's pack geometry, recorded as the given cell
+void weldAt(float px, float py, int mRow, int mCell, int mSide) {
+  stopped = false;
+  row = mRow;
+  cell = mCell;
+  side = mSide;
+  moveToPoint(px, py, z.getPosition() > Z_ZERO);
+  delay(cellDelay);
+  zWeld();
+  delay(cellDelay);
+  pollPause();
+}
+
+// Weld at the current X/Y as part of a blended stream from the host, recorded as the given cell.
+// Waits for X and Y to stop, plunges from wherever Z is to the weld depth, holds for weldTime,
+// then starts the lift to Z_ZERO and returns once Z is above clear, so the next X/Y move
+// overlaps the rest of the lift. X and Y must only move while Z is above clear.
+void zPlunge(float clear, int mRow, int mCell, int mSide) {
+  stopped = false;
+  row = mRow;
+  cell = mCell;
+  side = mSide;
+  while ((x.isRunning() || y.isRunning()) && !stopped) {
+    x.run();
+    y.run();
+    z.run();
+  }
+  if (stopped)
+    return;
+  sendProgress();
+  z.moveTo(Z_ZERO + z.getStepdown());
+  while (z.isRunning() && !stopped) {
+    z.run();
+  }
+  delay(weldTime);
+  if (inPack(row, cell, side)) {
+    int i = (row * packCells + cell) * 2 + side;
+    welded[i >> 3] |= 1 << (i & 7);
+  }
+  z.moveTo(Z_ZERO);
+  while (z.getPosition() > clear && z.isRunning() && !stopped) {
+    z.run();
+  }
+}
+
+// Run every axis until X and Y are within dx and dy of their targets (as GetDistanceToGo
+// reports them), for the host to start the next Z move while X and Y finish
+void xyWaitWithin(float dx, float dy) {
+  while ((fabs(x.getDistanceToGo()) > dx || fabs(y.getDistanceToGo()) > dy) && !stopped) {
+    x.run();
+    y.run();
+    z.run();
+  }
+}
+
+// Run the script to weld a series of cells
 // Returns true if success, false if stopped early
 bool runSeries(int passes = 2, int cells = 24, bool manual = false) {
   stopped = false;
@@ -106,60 +518,37 @@ bool runSeries(int passes = 2, int cells = 24, bool manual = false) {
     side = i;
     for (int j = 0; j < cells && !stopped; j++) {
       cell = (i % 2 == 1) ? (cells - j - 1) : j; // Go back and forth
-      if (welded[row][cell] & (1 << side))
+      if (isWelded(row, cell, side))
         continue;
       moveToCell(row, cell, side, packType, false);
-      delay(100);
+      delay(cellDelay);
       zWeld();
-      delay(100);
-      while (Serial.available() || manual) {
-        String cmd = Serial.readString();
-        cmd.trim();
-        Serial.println("# " + cmd);
-        if (cmd == "stop") {
-          stopped = true;
-          break;
-        }
-        while (cmd == "pause") {
-          while (!Serial.available()) {
-            Serial.println("paused");
-            delay(100);
-          }
-          cmd = Serial.readString();
-          cmd.trim();
-          if (cmd == "stop") {
-            stopped = true;
-            break;
-          }
-        }
-        if (manual && cmd == "next")
-          break;
-        delay(20);
-      }
+      delay(cellDelay);
+      pollPause(manual);
     }
     if (stopped)
       break;
     // y.stepoverBlockingCustom(80, false);
     // y.stepoverBlockingCustom(y.getStepover() * (cells - 1), true);
-    delay(1000);
+    delay(passDelay);
   }
   return !stopped;
 }
 
-// Run a full pack of 16 serieses
-void runPack(int passes = 2, PackType packType = PT_A, int seriesCells = 24) {
+// Run a full pack, one series per row
+void runPack(int passes = 2, PackType packType = PT_A) {
   bool close = !packType;
-  for (int i = 0; i < 16; i++) {
+  for (int i = 0; i < packRows; i++) {
     row = i;
-    if (!runSeries(passes, seriesCells, false))
+    if (!runSeries(passes, packCells, false))
       return;
     y.stepoverBlockingCustom(80*passes, true);
     y.stepoverHalfBlocking(!close);
     close = !close;
     x.stepoverBlocking();
-    delay(3000);
+    delay(rowDelay);
   }
-  Serial.println("finished");
+  sendStatus(ST_FINISHED);
 }
 
 // Run the script to weld a series of N 18650 cells
@@ -168,34 +557,26 @@ void runSeries18650(int cells, int passes = 1) {
   z.setStepdown(250);
   stopped = false;
   for (int i = 0; i < passes && !stopped; i++) {
-    Serial.print("R");
-    Serial.print(i); // Pass count
-    Serial.print(" ");
-    Serial.println(0); // Cell count
+    sendLine("R" + String(i) + " " + String(0)); // Pass count, cell count
     z.stepdownCycle(WELD_TIME);
     for (int j = 0; j < cells && !stopped; j++) {
-      Serial.print("R");
-      Serial.print(i); // Pass count
-      Serial.print(" ");
-      Serial.println(j + 1); // Cell count
+      sendLine("R" + String(i) + " " + String(j + 1)); // Pass count, cell count
       y.stepoverBlocking(true);
       delay(100);
       z.stepdownCycle(WELD_TIME);
       delay(100);
       while (Serial.available()) {
-        String cmd = Serial.readString();
-        cmd.trim();
+        String cmd = readCommand();
         if (cmd == "stop") {
           stopped = true;
           break;
         }
         while (cmd == "pause") {
           while (!Serial.available()) {
-            Serial.println("paused");
+            sendStatus(ST_PAUSED);
             delay(100);
           }
-          cmd = Serial.readString();
-          cmd.trim();
+          cmd = readCommand();
           if (cmd == "stop") {
             stopped = true;
             break;
@@ -209,20 +590,18 @@ void runSeries18650(int cells, int passes = 1) {
     y.stepoverBlockingCustom(y.getStepover() * 6, true);
     delay(1000);
     while (Serial.available()) {
-      String cmd = Serial.readString();
-      cmd.trim();
-      Serial.println(cmd);
+      String cmd = readCommand();
+      sendDebug(cmd);
       if (cmd == "stop") {
         stopped = true;
         break;
       }
       while (cmd == "pause") {
         while (!Serial.available()) {
-          Serial.println("paused");
+          sendStatus(ST_PAUSED);
           delay(100);
         }
-        cmd = Serial.readString();
-        cmd.trim();
+        cmd = readCommand();
         if (cmd == "stop") {
           stopped = true;
           break;
@@ -230,7 +609,7 @@ void runSeries18650(int cells, int passes = 1) {
       }
     }
   }
-  Serial.println("finished");
+  sendStatus(ST_FINISHED);
 }
 
 // Align the welder to the first cell
@@ -262,20 +641,21 @@ void moveToCell(int mRow, int mCell, int mSide, PackType packType, bool retract
   row = mRow;
   cell = mCell;
   side = mSide;
+  float offset = (packType == PT_A) ? (mRow % 2) : ((mRow + 1) % 2);
+  moveToPoint(X_ZERO + mRow * X_STEPOVER,
+              Y_ZERO + offset * Y_STEPOVER / 2 + mCell * Y_STEPOVER + (mSide ? (WELD_SPACE / 2) : (-WELD_SPACE / 2)), retract);
+}
+
+// Move the welder to an absolute X/Y position and lower it to the weld height
+void moveToPoint(float px, float py, bool retract) {
   if (retract) {
     z.moveTo(0);
     while (z.isRunning()) {
       z.run();
     }
   }
-  if (packType == PT_A) {
-    x.moveTo(X_ZERO + mRow * X_STEPOVER);
-    y.moveTo(Y_ZERO + (mRow % 2) * Y_STEPOVER / 2 + mCell * Y_STEPOVER + (mSide ? (WELD_SPACE / 2) : (-WELD_SPACE / 2)));
-  }
-  else if (packType == PT_B) {
-    x.moveTo(X_ZERO + mRow * X_STEPOVER);
-    y.moveTo(Y_ZERO + ((mRow + 1) % 2) * Y_STEPOVER / 2 + mCell * Y_STEPOVER + (mSide ? (WELD_SPACE / 2) : (-WELD_SPACE / 2)));
-  }
+  x.moveTo(px);
+  y.moveTo(py);
   while (x.isRunning() || y.isRunning()) {
     x.run();
     y.run();
@@ -286,8 +666,18 @@ void moveToCell(int mRow, int mCell, int mSide, PackType packType, bool retract
   }
 }
 
+// Parse a "row_cell_side" argument
+void parseCell(String arg, int &mRow, int &mCell, int &mSide) {
+  String cellSide = arg.substring(arg.indexOf("_") + 1);
+  mRow = arg.substring(0, arg.indexOf("_")).toInt();
+  mCell = cellSide.substring(0, cellSide.indexOf("_")).toInt();
+  mSide = cellSide.substring(cellSide.indexOf("_") + 1).toInt();
+}
+
 void parseCommand(String cmd, String cmd2 = "") {
-  Serial.println("# " + cmd + " " + cmd2);
+  // Control words read during a job overwrite cmdSeq
+  uint8_t seq = cmdSeq;
+  sendDebug("# " + cmd + " " + cmd2);
   if (cmd == "runSeries") {
     runSeries(2);
   }
@@ -303,8 +693,11 @@ void parseCommand(String cmd, String cmd2 = "") {
       packType = PT_A;
     else if (cmd2 == "B")
       packType = PT_B;
-    else
-      Serial.println("# Unknown pack type " + cmd2);
+    else {
+      sendDebug("# Unknown pack type " + cmd2);
+      sendAck(cmd, false, seq);
+      return;
+    }
   }
   else if (cmd == "align") {
     align(packType);
@@ -323,33 +716,59 @@ void parseCommand(String cmd, String cmd2 = "") {
   }
   else if (cmd == "xStepover") {
     x.stepover();
+    xAwaiting = true;
   }
   else if (cmd == "xStepback") {
     x.stepover(true);
+    xAwaiting = true;
   }
   else if (cmd == "yStepover") {
     y.stepover();
+    yAwaiting = true;
   }
   else if (cmd == "yStepback") {
     y.stepover(true);
+    yAwaiting = true;
   }
   else if (cmd == "zStepdown") {
     z.stepdown();
+    zAwaiting = true;
   }
   else if (cmd == "zStepup") {
     z.stepup();
+    zAwaiting = true;
   }
   else if (cmd == "zStepCycle") {
-    z.stepdownCycle(WELD_TIME);
+    z.stepdownCycle(weldTime);
   }
   else if (cmd == "zWeld") {
     zWeld();
   }
   else if (cmd == "resetWelds") {
-    for (int i = 0; i < 16; i++) {
-      for (int j = 0; j < 24; j++) {
-        welded[i][j] = 0;
-      }
+    memset(welded, 0, sizeof(welded));
+  }
+  else if (cmd == "packShape") {
+    // rows_cells, clears the weld mask
+    int rows = cmd2.substring(0, cmd2.indexOf("_")).toInt();
+    int cells = cmd2.substring(cmd2.indexOf("_") + 1).toInt();
+    if (cmd2.indexOf("_") < 0 || rows <= 0 || cells <= 0 || rows * cells * 2 > MAX_WELD_BYTES * 8) {
+      sendDebug("# Bad pack shape " + cmd2);
+      sendAck(cmd, false, seq);
+      return;
+    }
+    if (rows != packRows || cells != packCells)
+      memset(welded, 0, sizeof(welded));
+    packRows = rows;
+    packCells = cells;
+  }
+  else if (cmd == "getWelds") {
+    sendWelds();
+  }
+  else if (cmd == "setWelds") {
+    if (!loadWelds(cmd2)) {
+      sendDebug("# Bad weld mask");
+      sendAck(cmd, false, seq);
+      return;
     }
   }
   else if (cmd == "xHome") {
@@ -368,33 +787,36 @@ void parseCommand(String cmd, String cmd2 = "") {
   }
   else if (cmd == "xMove") {
     float distance = cmd2.toFloat();
-    Serial.print("# xMove ");
-    Serial.println(distance);
+    sendDebug("# xMove " + String(distance));
     x.move(distance);
+    xAwaiting = true;
   }
   else if (cmd == "yMove") {
     float distance = cmd2.toFloat();
-    Serial.print("# yMove ");
-    Serial.println(distance);
+    sendDebug("# yMove " + String(distance));
     y.move(distance);
+    yAwaiting = true;
   }
   else if (cmd == "zMove") {
     float distance = cmd2.toFloat();
-    Serial.print("# zMove ");
-    Serial.println(distance);
+    sendDebug("# zMove " + String(distance));
     z.move(distance);
+    zAwaiting = true;
   }
   else if (cmd == "xMoveTo") {
     float position = cmd2.toFloat();
     x.moveTo(position);
+    xAwaiting = true;
   }
   else if (cmd == "yMoveTo") {
     float position = cmd2.toFloat();
     y.moveTo(position);
+    yAwaiting = true;
   }
   else if (cmd == "zMoveTo") {
     float position = cmd2.toFloat();
     z.moveTo(position);
+    zAwaiting = true;
   }
   else if (cmd == "xRunMs") {
     float targTime = millis() + cmd2.toFloat();
@@ -414,6 +836,22 @@ void parseCommand(String cmd, String cmd2 = "") {
       z.run();
     }
   }
+  else if (cmd == "xJog" || cmd == "yJog" || cmd == "zJog") {
+    Axis &axis = cmd[0] == 'x' ? (Axis &)x : cmd[0] == 'y' ? (Axis &)y : (Axis &)z;
+    if (!jog(axis, cmd2.toFloat())) {
+      sendAck(cmd, false, seq);
+      return;
+    }
+  }
+  else if (cmd == "xJogStop") {
+    jogStop(x, xAwaiting);
+  }
+  else if (cmd == "yJogStop") {
+    jogStop(y, yAwaiting);
+  }
+  else if (cmd == "zJogStop") {
+    jogStop(z, zAwaiting);
+  }
   else if (cmd == "xStop") {
     x.stop();
   }
@@ -429,53 +867,102 @@ void parseCommand(String cmd, String cmd2 = "") {
     z.eStop();
   }
   else if (cmd == "moveToCell") {
-    String row = cmd2.substring(0, cmd2.indexOf("_"));
-    String cell = cmd2.substring(cmd2.indexOf("_") + 1);
-    String side = cell.substring(cell.indexOf("_") + 1);
-    cell = cell.substring(0, cell.indexOf("_"));
-    Serial.println("# " + row + " " + cell + " " + side);
-    moveToCell(row.toInt(), cell.toInt(), side.toInt(), packType);
+    int mRow, mCell, mSide;
+    parseCell(cmd2, mRow, mCell, mSide);
+    sendDebug("# " + String(mRow) + " " + String(mCell) + " " + String(mSide));
+    moveToCell(mRow, mCell, mSide, packType);
+  }
+  else if (cmd == "weldCell") {
+    int mRow, mCell, mSide;
+    parseCell(cmd2, mRow, mCell, mSide);
+    if (!inPack(mRow, mCell, mSide)) {
+      sendDebug("# Cell outside the pack");
+      sendAck(cmd, false, seq);
+      return;
+    }
+    weldCell(mRow, mCell, mSide);
+  }
+  else if (cmd == "weldAt" || cmd == "moveToPoint") {
+    // x_y_row_cell_side
+    int first = cmd2.indexOf("_");
+    int second = cmd2.indexOf("_", first + 1);
+    int mRow, mCell, mSide;
+    parseCell(cmd2.substring(second + 1), mRow, mCell, mSide);
+    if (first < 0 || second < 0 || !inPack(mRow, mCell, mSide)) {
+      sendDebug("# Bad weld point " + cmd2);
+      sendAck(cmd, false, seq);
+      return;
+    }
+    float px = cmd2.substring(0, first).toFloat();
+    float py = cmd2.substring(first + 1, second).toFloat();
+    if (cmd == "weldAt") {
+      weldAt(px, py, mRow, mCell, mSide);
+    }
+    else {
+      row = mRow;
+      cell = mCell;
+      side = mSide;
+      moveToPoint(px, py);
+    }
+  }
+  else if (cmd == "zPlunge") {
+    // clear_row_cell_side
+    int mRow, mCell, mSide;
+    parseCell(cmd2.substring(cmd2.indexOf("_") + 1), mRow, mCell, mSide);
+    if (cmd2.indexOf("_") < 0 || !inPack(mRow, mCell, mSide)) {
+      sendDebug("# Bad plunge " + cmd2);
+      sendAck(cmd, false, seq);
+      return;
+    }
+    zPlunge(cmd2.substring(0, cmd2.indexOf("_")).toFloat(), mRow, mCell, mSide);
+  }
+  else if (cmd == "xyWaitWithin") {
+    // dx_dy
+    xyWaitWithin(cmd2.substring(0, cmd2.indexOf("_")).toFloat(), cmd2.substring(cmd2.indexOf("_") + 1).toFloat());
   }
   else if (cmd == "resetEStop") {
     x.resetEStop();
     y.resetEStop();
     z.resetEStop();
   }
+  else if (cmd == "status") {
+    sendAxes();
+  }
   else if (cmd == "xIsRunning") {
-    Serial.println(x.isRunning());
+    sendLine(String(x.isRunning()));
   }
   else if (cmd == "yIsRunning") {
-    Serial.println(y.isRunning());
+    sendLine(String(y.isRunning()));
   }
   else if (cmd == "zIsRunning") {
-    Serial.println(z.isRunning());
+    sendLine(String(z.isRunning()));
   }
   else if (cmd == "xGetPosition") {
-    Serial.println(x.getPosition());
+    sendLine(String(x.getPosition()));
   }
   else if (cmd == "yGetPosition") {
-    Serial.println(y.getPosition());
+    sendLine(String(y.getPosition()));
   }
   else if (cmd == "zGetPosition") {
-    Serial.println(z.getPosition());
+    sendLine(String(z.getPosition()));
   }
   else if (cmd == "xGetTargetPosition") {
-    Serial.println(x.getTargetPosition());
+    sendLine(String(x.getTargetPosition()));
   }
   else if (cmd == "yGetTargetPosition") {
-    Serial.println(y.getTargetPosition());
+    sendLine(String(y.getTargetPosition()));
   }
   else if (cmd == "zGetTargetPosition") {
-    Serial.println(z.getTargetPosition());
+    sendLine(String(z.getTargetPosition()));
   }
   else if (cmd == "xGetDistanceToGo") {
-    Serial.println(x.getDistanceToGo());
+    sendLine(String(x.getDistanceToGo()));
   }
   else if (cmd == "yGetDistanceToGo") {
-    Serial.println(y.getDistanceToGo());
+    sendLine(String(y.getDistanceToGo()));
   }
   else if (cmd == "zGetDistanceToGo") {
-    Serial.println(z.getDistanceToGo());
+    sendLine(String(z.getDistanceToGo()));
   }
   else if (cmd == "xSetMaxSpeed") {
     float speed = cmd2.toFloat();
@@ -489,33 +976,128 @@ void parseCommand(String cmd, String cmd2 = "") {
     float speed = cmd2.toFloat();
     z.setMaxSpeed(speed);
   }
+  else if (cmd == "xSetAcceleration") {
+    float acceleration = cmd2.toFloat();
+    x.setAcceleration(acceleration);
+  }
+  else if (cmd == "ySetAcceleration") {
+    float acceleration = cmd2.toFloat();
+    y.setAcceleration(acceleration);
+  }
+  else if (cmd == "zSetAcceleration") {
+    float acceleration = cmd2.toFloat();
+    z.setAcceleration(acceleration);
+  }
+  else if (cmd == "setTiming") {
+    // weld_cell_pass_row in ms
+    long values[4];
+    String rest = cmd2;
+    for (int i = 0; i < 4; i++) {
+      int split = rest.indexOf('_');
+      values[i] = rest.substring(0, split).toInt();
+      rest = split < 0 ? "" : rest.substring(split + 1);
+    }
+    if (values[0] <= 0 || values[1] < 0 || values[2] < 0 || values[3] < 0) {
+      sendDebug("# Bad timing " + cmd2);
+      sendAck(cmd, false, seq);
+      return;
+    }
+    weldTime = values[0];
+    cellDelay = values[1];
+    passDelay = values[2];
+    rowDelay = values[3];
+  }
   else if (cmd == "ping") {
-    Serial.println("pong");
+    sendStatus(ST_PONG);
+  }
+  else if (cmd == "heartbeat") {
+    beatInterval = cmd2.toInt();
+    lastBeat = millis();
+  }
+  else if (cmd == "binary") {
+    // Switch to frames at the given baud rate once the ok has gone out in text
+    long baud = cmd2.toInt();
+    if (baud <= 0) {
+      sendDebug("# Bad baud rate " + cmd2);
+      sendAck(cmd, false, seq);
+      return;
+    }
+    sendAck(cmd, true, seq);
+    Serial.flush();
+    Serial.begin(baud);
+    binaryMode = true;
+    lastFrame = millis();
+    return;
+  }
+  else if (cmd == "stop") {
+    // Outside of a run there is nothing to abort but motion
+    x.stop();
+    y.stop();
+    z.stop();
+  }
+  else if (cmd == "pause" || cmd == "continue") {
+    // Only meaningful while welding, ignore late requests
   }
   else {
-    Serial.println("# Unknown command " + cmd + ".");
+    sendDebug("# Unknown command " + cmd + ".");
+    sendAck(cmd, false, seq);
+    return;
+  }
+  // Blocking commands are complete here, non-blocking moves report "done <axis>" later
+  sendAck(cmd, true, seq);
+}
+
+// Report the end of a non-blocking move once the axis is idle
+void reportDone(Axis &axis, bool &awaiting, const char *name) {
+  if (awaiting && axis.getDistanceToGo() == 0) {
+    sendDone(name);
+    awaiting = false;
   }
 }
 
 void loop() {
-  if (Serial.available()) {
-    String cmd = Serial.readString();
-    cmd.trim();
+  if (deferredCmd.length() > 0 || Serial.available()) {
+    String cmd = deferredCmd;
+    deferredCmd = "";
+    if (cmd.length() > 0)
+      cmdSeq = deferredSeq;
+    else
+      cmd = readCommand();
     String cmd2;
     if (cmd.indexOf(" ") != -1) {
       cmd2 = cmd.substring(cmd.indexOf(" ") + 1);
       cmd = cmd.substring(0, cmd.indexOf(" "));
     }
-    parseCommand(cmd, cmd2);
+    // Pings and corrupted frames read as nothing. A long command counts as link
+    // activity, so the link doesn't drop while the host's frames wait to be read.
+    if (cmd.length() > 0) {
+      parseCommand(cmd, cmd2);
+      lastFrame = millis();
+    }
+  }
+  // Drop back to text when the host stops talking in frames
+  if (binaryMode && !Serial.available() && millis() - lastFrame > LINK_TIMEOUT) {
+    Serial.flush();
+    Serial.begin(TEXT_BAUD);
+    binaryMode = false;
+  }
+  if (jogAxis != NULL && millis() - lastJog > JOG_TIMEOUT) {
+    jogAxis->stop();
+    jogAxis = NULL;
   }
+  reportEStop();
+  beat();
   x.run();
   y.run();
   z.run();
+  reportDone(x, xAwaiting, "x");
+  reportDone(y, yAwaiting, "y");
+  reportDone(z, zAwaiting, "z");
   if (millis() > lastPrint + 1000) {
     if (x.getDistanceToGo() == 0 && y.getDistanceToGo() == 0 && z.getDistanceToGo() == 0)
-      Serial.println("idle");
+      sendStatus(ST_IDLE);
     else
-      Serial.println("moving");
+      sendStatus(ST_MOVING);
     lastPrint = millis();
   }
 }
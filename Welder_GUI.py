@@ -1,14 +1,39 @@
-import serial, serial.tools.list_ports
 import time
-import threading
-from PIL import Image
+STARTED = time.perf_counter()
+import queue, sys, threading
+import serial
 import tkinter as tk
 import customtkinter as ctk
-
-finished = True
-paused = False
-
-ser = serial.Serial(baudrate=9600)
+from welder.client import WelderClient
+from welder.packview import PackViewer
+from welder.journal import DEFAULT_PATH, Journal, shapePath
+from welder.weldmask import WeldMask
+from welder import firmware as fw
+from welder import geometry
+from welder import planner
+from welder import recording
+from welder import assets
+from welder import calibration
+from welder import history
+from welder import tuning
+from welder.estimate import formatDuration
+from welder.jog import JOG_TICK, Jogger
+from welder.ports import PortMonitor
+
+# How often the Tk thread handles serial events, in ms
+EVENT_POLL_MS = 5
+# Least time between redraws for serial events, in ms; events in between are folded together
+FRAME_MS = 16
+# How often the time left is counted down between welds, in ms
+PROGRESS_UPDATE_MS = 1000
+# How often the Tk thread checks for port list changes from the port monitor, in ms
+PORT_POLL_MS = 50
+# How often the Tk thread checks whether a job's plan is ready, in ms
+PLAN_POLL_MS = 50
+# Hold-to-jog keys: (axis, direction), the directions of the step buttons
+JOG_KEYS = {"a": ("x", 1), "d": ("x", -1), "w": ("y", 1), "s": ("y", -1), "r": ("z", -1), "f": ("z", 1)}
+# Seconds from launch until the window is drawn that `--startup-benchmark` allows
+STARTUP_BUDGET = 1.0
 
 ########################################################################
 class GUI(ctk.CTk):
@@ -29,8 +54,7 @@ class GUI(ctk.CTk):
         self.titleLeftSpacer = ctk.CTkFrame(self.titleFrame, fg_color="#08003A", width=30, height=50)
         self.titleLeftSpacer.pack(side=tk.LEFT, expand=False, anchor=tk.E)
 
-        self.logoImg = Image.open("assets/logo.png")
-        self.logoImg = ctk.CTkImage(self.logoImg, size=(75, 75))
+        self.logoImg = assets.image("logo", (75, 75))
         self.logo = ctk.CTkLabel(self.titleFrame, image=self.logoImg, text="", anchor=tk.W)
         self.logo.pack(side=tk.LEFT, anchor=tk.W)
 
@@ -57,6 +81,14 @@ class GUI(ctk.CTk):
         self.statusCurrent = ctk.CTkLabel(self.statusFrame, text="Disconnected", text_color="orange", font=("Berlin Sans FB", 18))
         self.statusCurrent.pack(side=tk.LEFT)
 
+        # Axis readout, positions in steps from the client's status queries
+        self.droValues = {}
+        for axis in "zyx":
+            self.droValues[axis] = ctk.CTkLabel(self.statusFrame, text="-", width=60, anchor=tk.W)
+            self.droValues[axis].pack(side=tk.RIGHT)
+            ctk.CTkLabel(self.statusFrame, text=axis.upper() + ":").pack(side=tk.RIGHT, padx=(10, 2))
+        self.droColor = self.droValues["x"].cget("text_color")
+
 
         ########################################################################
         # Permanent body frame
@@ -77,8 +109,6 @@ class GUI(ctk.CTk):
         self.xStepSize.grid(column=1, row=3, pady=10, padx=2)
         self.xSetStepSize = ctk.CTkButton(self.controlFrame, text="Set Step", command=self.xSetStep, corner_radius=999, width=50, height=25)
         self.xSetStepSize.grid(column=1, row=4, pady=10, padx=2)
-        self.root.bind("a", self.xBackwards)
-        self.root.bind("d", self.xForwards)
         
         self.placeholder0 = ctk.CTkFrame(self.controlFrame, fg_color="#08003A", width=10, height=50)
         self.placeholder0.grid(column=2, row=0, rowspan=3, padx=2, pady=2)
@@ -92,8 +122,6 @@ class GUI(ctk.CTk):
         self.yStepSize.grid(column=3, columnspan=2, row=3, pady=10, padx=2)
         self.ySetStepSize = ctk.CTkButton(self.controlFrame, text="Set Step", command=self.ySetStep, corner_radius=999, width=50, height=25)
         self.ySetStepSize.grid(column=3, columnspan=2, row=4, pady=10, padx=2)
-        self.root.bind("s", self.yRight)
-        self.root.bind("w", self.yLeft)
 
         self.placeholder1 = ctk.CTkFrame(self.controlFrame, fg_color="#08003A", width=10, height=50)
         self.placeholder1.grid(column=5, row=0, rowspan=3, padx=2, pady=2)
@@ -108,8 +136,11 @@ class GUI(ctk.CTk):
         self.zSetStepSize = ctk.CTkButton(self.controlFrame, text="Set Step", command=self.zSetStep, corner_radius=999, width=50, height=25)
         self.zSetStepSize.grid(column=6, row=4, pady=10, padx=2)
         self.root.bind("<space>", self.zWeld)
-        self.root.bind("r", self.zUp)
-        self.root.bind("f", self.zDown)
+        # Holding a jog key runs the axis until it is released (welder/jog.py)
+        for key, (axis, direction) in JOG_KEYS.items():
+            self.root.bind(f"<KeyPress-{key}>", lambda event, axis=axis, direction=direction: self.jogPress(axis, direction))
+            self.root.bind(f"<KeyRelease-{key}>", lambda event, axis=axis, direction=direction: self.jogger.release(axis, direction))
+        self.root.bind("<FocusOut>", lambda event: self.jogger.releaseAll())
 
         self.placeholder2 = ctk.CTkFrame(self.controlFrame, fg_color="#08003A", width=10, height=50)
         self.placeholder2.grid(column=7, row=0, rowspan=3, padx=2, pady=2)
@@ -142,17 +173,27 @@ class GUI(ctk.CTk):
         self.pauseButton.grid(column=0, row=1, padx=10, pady=10)
         self.stopButton = ctk.CTkButton(self.controlButtonsFrame, text="Stop", text_color="#08003A", command=self.stop, state=tk.DISABLED, corner_radius=999, height=35, width=75)
         self.stopButton.grid(column=1, row=1, padx=10, pady=10)
+        self.optimizeOrder = tk.BooleanVar(value=False)
+        self.optimizeCheck = ctk.CTkCheckBox(self.controlButtonsFrame, text="Optimize order", variable=self.optimizeOrder)
+        self.optimizeCheck.grid(column=0, row=2, columnspan=2, padx=10, pady=5)
+        # Overlap Z with X/Y travel (welder/motion.py), welds in the optimised order
+        self.blendMoves = tk.BooleanVar(value=False)
+        self.blendCheck = ctk.CTkCheckBox(self.controlButtonsFrame, text="Blend moves", variable=self.blendMoves)
+        self.blendCheck.grid(column=0, row=3, columnspan=2, padx=10, pady=5)
+        self.resumeButton = ctk.CTkButton(self.controlButtonsFrame, text="Resume Pack", text_color="#08003A", command=self.resumePack, state=tk.DISABLED, corner_radius=999, height=35, width=120)
+        self.resumeButton.grid(column=0, row=4, columnspan=2, padx=10, pady=10)
+        # Fits the layout to reference cells jogged to by hand (welder/calibration.py)
+        self.calibrateButton = ctk.CTkButton(self.controlButtonsFrame, text="Calibrate", text_color="#08003A", command=self.calibrate, state=tk.DISABLED, corner_radius=999, height=35, width=120)
+        self.calibrateButton.grid(column=0, row=5, columnspan=2, padx=10, pady=10)
 
         self.arrangementFrame = ctk.CTkFrame(self.runControlFrame, fg_color="#08003A", height=75)
         self.arrangementFrame.pack(side=tk.TOP, fill=tk.X, expand=True)
 
         imgSize = 100
-        self.packTypeImgA = Image.open("assets/typeA.png")
-        self.packTypeImgA = ctk.CTkImage(self.packTypeImgA, size=(imgSize, imgSize * 120/222.5))
+        self.packTypeImgA = assets.image("typeA", (imgSize, round(imgSize * 120/222.5)))
         self.packTypeImgALabel = ctk.CTkLabel(self.arrangementFrame, image=self.packTypeImgA, text="")
         self.packTypeImgALabel.grid(column=0, row=0, padx=10, pady=10)
-        self.packTypeImgB = Image.open("assets/typeB.png")
-        self.packTypeImgB = ctk.CTkImage(self.packTypeImgB, size=(imgSize, imgSize * 120/222.5))
+        self.packTypeImgB = assets.image("typeB", (imgSize, round(imgSize * 120/222.5)))
         self.packTypeImgBLabel = ctk.CTkLabel(self.arrangementFrame, image=self.packTypeImgB, text="")
         self.packTypeImgBLabel.grid(column=1, row=0, padx=10, pady=10)
 
@@ -161,38 +202,100 @@ class GUI(ctk.CTk):
         self.packTypeSelectA.grid(column=0, row=1, padx=10, pady=10)
         self.packTypeSelectB = ctk.CTkRadioButton(self.arrangementFrame, text="B", variable=self.packType, value="B", command=self.selectPackType, state=tk.DISABLED)
         self.packTypeSelectB.grid(column=1, row=1, padx=10, pady=10)
+        # Any layout from layouts.json, A and B are the firmware's pack types
+        self.layoutName = tk.StringVar(value=geometry.DEFAULT_LAYOUT)
+        self.layoutSelect = ctk.CTkComboBox(self.arrangementFrame, variable=self.layoutName, values=sorted(geometry.layouts()), command=self.selectLayout, state=tk.DISABLED, width=120)
+        self.layoutSelect.grid(column=0, row=2, columnspan=2, padx=10, pady=10)
 
         self.expanderFrame = ctk.CTkFrame(self.runningWindow, fg_color="#08003A")
         self.expanderFrame.pack(side=tk.BOTTOM, fill=tk.X, padx=30, pady=10)
 
-        # self.progressFrame = ctk.CTkFrame(self.runningWindow, fg_color="#08003A")
-
-        # self.progressText = ctk.CTkLabel(self.progressFrame, text="Progress:")
-        # self.progressRowLabel = ctk.CTkLabel(self.progressFrame, text="Current Row:")
-        # self.progressRow = ctk.CTkLabel(self.progressFrame, text="0")
-        # self.progressPassLabel = ctk.CTkLabel(self.progressFrame, text="Current Pass:")
-        # self.progressPass = ctk.CTkLabel(self.progressFrame, text="0")
-        # self.progressCellLabel = ctk.CTkLabel(self.progressFrame, text="Current Cell:")
-        # self.progressCell = ctk.CTkLabel(self.progressFrame, text="0")
-        # self.vertSpacer = ctk.CTkFrame(self.progressFrame, fg_color="#08003A", width=10, height=50)
-
-        # self.progressText.grid(column=0, row=0, columnspan=2, padx=2, pady=2)
-        # self.progressRowLabel.grid(column=0, row=1, padx=2, pady=2)
-        # self.progressRow.grid(column=1, row=1, padx=2, pady=2)
-        # self.vertSpacer.grid(column=2, row=0, rowspan=3, padx=2, pady=2)
-        # self.progressPassLabel.grid(column=3, row=0, padx=2, pady=2)
-        # self.progressPass.grid(column=4, row=0, padx=2, pady=2)
-        # self.progressCellLabel.grid(column=3, row=1, padx=2, pady=2)
-        # self.progressCell.grid(column=4, row=1, padx=2, pady=2)
+        self.progressFrame = ctk.CTkFrame(self.runningWindow, fg_color="#08003A")
+
+        self.progressText = ctk.CTkLabel(self.progressFrame, text="Progress:")
+        self.progressRowLabel = ctk.CTkLabel(self.progressFrame, text="Current Row:")
+        self.progressRow = ctk.CTkLabel(self.progressFrame, text="0")
+        self.progressPassLabel = ctk.CTkLabel(self.progressFrame, text="Current Pass:")
+        self.progressPass = ctk.CTkLabel(self.progressFrame, text="0")
+        self.progressCellLabel = ctk.CTkLabel(self.progressFrame, text="Current Cell:")
+        self.progressCell = ctk.CTkLabel(self.progressFrame, text="0")
+        self.vertSpacer = ctk.CTkFrame(self.progressFrame, fg_color="#08003A", width=10, height=50)
+        self.progressPercentLabel = ctk.CTkLabel(self.progressFrame, text="Complete:")
+        self.progressPercent = ctk.CTkLabel(self.progressFrame, text="0%")
+        self.progressRateLabel = ctk.CTkLabel(self.progressFrame, text="Welds/min:")
+        self.progressRate = ctk.CTkLabel(self.progressFrame, text="-")
+        self.progressEtaLabel = ctk.CTkLabel(self.progressFrame, text="Time Left:")
+        self.progressEta = ctk.CTkLabel(self.progressFrame, text="-")
+        self.vertSpacer2 = ctk.CTkFrame(self.progressFrame, fg_color="#08003A", width=10, height=50)
+
+        self.progressText.grid(column=0, row=0, columnspan=2, padx=2, pady=2)
+        self.progressRowLabel.grid(column=0, row=1, padx=2, pady=2)
+        self.progressRow.grid(column=1, row=1, padx=2, pady=2)
+        self.vertSpacer.grid(column=2, row=0, rowspan=3, padx=2, pady=2)
+        self.progressPassLabel.grid(column=3, row=0, padx=2, pady=2)
+        self.progressPass.grid(column=4, row=0, padx=2, pady=2)
+        self.progressCellLabel.grid(column=3, row=1, padx=2, pady=2)
+        self.progressCell.grid(column=4, row=1, padx=2, pady=2)
+        self.vertSpacer2.grid(column=5, row=0, rowspan=3, padx=2, pady=2)
+        self.progressPercentLabel.grid(column=6, row=0, padx=2, pady=2)
+        self.progressPercent.grid(column=7, row=0, padx=2, pady=2)
+        self.progressRateLabel.grid(column=6, row=1, padx=2, pady=2)
+        self.progressRate.grid(column=7, row=1, padx=2, pady=2)
+        self.progressEtaLabel.grid(column=6, row=2, padx=2, pady=2)
+        self.progressEta.grid(column=7, row=2, padx=2, pady=2)
 
         self.expandButton = ctk.CTkButton(self.expanderFrame, text="Expand", corner_radius=999, command=self.expand, width=80, height=35)
         self.expandButton.pack(side=tk.TOP, padx=10, pady=10)
 
-        self.green_r_semi = ctk.CTkImage(Image.open("assets/green-r-semi.png"), size=(10, 20))
-        self.red_r_semi = ctk.CTkImage(Image.open("assets/red-r-semi.png"), size=(10, 20))
-        self.green_l_semi = ctk.CTkImage(Image.open("assets/green-l-semi.png"), size=(10, 20))
-        self.red_l_semi = ctk.CTkImage(Image.open("assets/red-l-semi.png"), size=(10, 20))
-        self.cellStates = [[[0, 0] for i in range(24)] for j in range(16)]
+        # Weld progress is journaled to disk so it survives a crash or reboot mid-pack
+        layout = calibration.calibratedLayout()
+        # Every session is recorded so incidents can be replayed (python -m welder.recording),
+        # the tuned motion profile (python -m welder.tuning) is sent on connect
+        self.client = WelderClient(journal=self.openJournal(layout), echo=True, geometry=layout, record=recording.DEFAULT_DIR,
+                                   profile=tuning.loadProfile())
+        self.client.listeners.append(self.handleEvent)
+        # Every weld and job event goes to the SQLite history, written off this thread
+        self.history = history.History()
+        self.client.listeners.append(self.history.handleEvent)
+        # Feeds the axis readout
+        self.client.trackAxes = True
+        # Reconnect after a lost link, and connect to the welder once the monitor finds it
+        self.client.autoConnect = True
+        self.jogger = Jogger(self.client)
+        # Handlers for the client's events, by kind. Most only note what changed;
+        # render() draws it once per frame.
+        self.eventHandlers = {
+            'finished': self.onFinished,
+            'failed': self.onFailed,
+            'welded': self.onWelded,
+            'reset': self.onReset,
+            'layout': self.onLayout,
+            'progress': self.onProgress,
+            'paused': lambda event: self.setStatus("Paused", "orange"),
+            'estop': self.onEstop,
+            'idle': lambda event: self.setStatus("Idle", "yellow"),
+            'moving': lambda event: self.setStatus("Moving", "green"),
+            'lost': self.onLost,
+            'ready': self.onReady,
+            'position': self.onAxes,
+            'axes': self.onAxes,
+        }
+        self.shownStatus = ("Disconnected", "orange")
+        self.pendingStatus = None
+        self.pendingProgress = None
+        self.pendingWelds = {}
+        self.pendingReset = False
+        self.pendingAxes = False
+        self.lastRender = 0.0
+        self.packViewer = None
+        # calibration.CalibrationRun in progress, and its status query
+        self.calibrationRun = None
+        self.calibrationQuery = None
+        # A job's order is being planned off the Tk thread, see planJob()
+        self.planning = False
+        self.selectedRow = 0
+        self.selectedCol = 0
+        self.selectedSide = 0
 
 
         ########################################################################
@@ -202,7 +305,8 @@ class GUI(ctk.CTk):
         self.connectionRefreshButton = ctk.CTkButton(self.connectFrame, text="Refresh", command=self.refreshConnections, corner_radius=999, width=50, fg_color="green")
         self.connectionRefreshButton.pack(side=tk.LEFT, padx=5)
         self.connectTargText = tk.StringVar()
-        self.connectTarget = ctk.CTkComboBox(self.connectFrame, variable=self.connectTargText, values=[port.name for port in serial.tools.list_ports.comports()])
+        # Filled in by the port monitor once the window is up
+        self.connectTarget = ctk.CTkComboBox(self.connectFrame, variable=self.connectTargText, values=[])
         self.connectTarget.pack(side=tk.LEFT, padx=5)
         self.connectionButton = ctk.CTkButton(self.connectFrame, text="Connect", command=self.connect, width=80, corner_radius=999, fg_color="green")
         self.connectionButton.pack(side=tk.LEFT, padx=5)
@@ -214,7 +318,18 @@ class GUI(ctk.CTk):
         self.startButton.configure(state=tk.DISABLED)
         self.pauseButton.configure(state=tk.DISABLED)
         self.stopButton.configure(state=tk.DISABLED)
-        root.bind_all('<Button>', self.change_focus)
+        self.resumeButton.configure(state=tk.DISABLED)
+        self.root.bind_all('<Button>', self.change_focus)
+
+        ########################################################################
+        # Serial events are read on a worker thread and handled here on the Tk thread
+        self.root.after(EVENT_POLL_MS, self.processEvents)
+        self.root.after(round(JOG_TICK * 1000), self.jogTick)
+        # Listing and probing ports can take a while, the monitor runs off the Tk thread
+        self.ports = queue.Queue()
+        self.portMonitor = PortMonitor(self.client, self.ports.put)
+        self.portMonitor.start()
+        self.root.after(PORT_POLL_MS, self.showPorts)
     
     def change_focus(self, event):
         event.widget.focus_set()
@@ -222,6 +337,7 @@ class GUI(ctk.CTk):
     def enableControl(self):
         self.controlFrame.pack(side=tk.TOP, pady=20, padx=20, fill=tk.NONE, anchor=tk.NW)
         self.alignButton.configure(state=tk.NORMAL)
+        self.calibrateButton.configure(state=tk.NORMAL)
         self.yLeftButton.configure(state=tk.NORMAL)
         self.yRightButton.configure(state=tk.NORMAL)
         self.zUpButton.configure(state=tk.NORMAL)
@@ -231,11 +347,14 @@ class GUI(ctk.CTk):
         self.homeAllButton.configure(state=tk.NORMAL)
         self.packTypeSelectA.configure(state=tk.NORMAL)
         self.packTypeSelectB.configure(state=tk.NORMAL)
+        self.layoutSelect.configure(state=tk.NORMAL)
         self.controlAllowed = True
 
     def disableControl(self):
         self.controlFrame.pack_forget()
         self.alignButton.configure(state=tk.DISABLED)
+        self.calibrateButton.configure(state=tk.DISABLED)
+        self.cancelCalibration()
         self.yLeftButton.configure(state=tk.DISABLED)
         self.yRightButton.configure(state=tk.DISABLED)
         self.zUpButton.configure(state=tk.DISABLED)
@@ -245,412 +364,607 @@ class GUI(ctk.CTk):
         self.homeAllButton.configure(state=tk.DISABLED)
         self.packTypeSelectA.configure(state=tk.DISABLED)
         self.packTypeSelectB.configure(state=tk.DISABLED)
+        self.layoutSelect.configure(state=tk.DISABLED)
         self.controlAllowed = False
+        self.jogger.releaseAll()
 
-    def xForwards(self, args=0):
-        global ser
-        if not ser.is_open or not self.yRightButton.cget('state') == tk.NORMAL:
-            return
-        if (self.xStepSize.get() == ""):
+    # Step size from entry, or None after telling the user what is wrong with it
+    def stepSize(self, entry):
+        if (entry.get() == ""):
             tk.messagebox.showerror("Error", "No step size selected")
-            return
-        elif (not self.xStepSize.get().isdigit()):
+            return None
+        elif (not entry.get().isdigit()):
             tk.messagebox.showerror("Error", "Step size must be a whole number")
+            return None
+        return entry.get()
+
+    def xForwards(self, args=0):
+        if not self.client.isConnected() or not self.yRightButton.cget('state') == tk.NORMAL:
             return
-        self.xStepSizeVal = self.xStepSize.get()
-        ser.write(f'xMove -{self.xStepSizeVal}\n'.encode('utf-8'))
-    
-    def xBackwards(self, args=0):
-        global ser
-        if not ser.is_open or not self.yLeftButton.cget('state') == tk.NORMAL:
+        steps = self.stepSize(self.xStepSize)
+        if steps is None:
             return
-        if (self.xStepSize.get() == ""):
-            tk.messagebox.showerror("Error", "No step size selected")
+        self.xStepSizeVal = steps
+        self.client.move('x', f'-{steps}')
+
+    def xBackwards(self, args=0):
+        if not self.client.isConnected() or not self.yLeftButton.cget('state') == tk.NORMAL:
             return
-        elif (not self.xStepSize.get().isdigit()):
-            tk.messagebox.showerror("Error", "Step size must be a whole number")
+        steps = self.stepSize(self.xStepSize)
+        if steps is None:
             return
-        self.xStepSizeVal = self.xStepSize.get()
-        ser.write(f'xMove {self.xStepSizeVal}\n'.encode('utf-8'))
-    
+        self.xStepSizeVal = steps
+        self.client.move('x', steps)
+
     def yLeft(self, args=0):
-        global ser
-        if not ser.is_open or not self.yLeftButton.cget('state') == tk.NORMAL:
+        if not self.client.isConnected() or not self.yLeftButton.cget('state') == tk.NORMAL:
             return
-        if (self.yStepSize.get() == ""):
-            tk.messagebox.showerror("Error", "No step size selected")
+        steps = self.stepSize(self.yStepSize)
+        if steps is None:
             return
-        elif (not self.yStepSize.get().isdigit()):
-            tk.messagebox.showerror("Error", "Step size must be a whole number")
-            return
-        self.yStepSizeVal = self.yStepSize.get()
-        ser.write(f'yMove {self.yStepSizeVal}\n'.encode('utf-8'))
+        self.yStepSizeVal = steps
+        self.client.move('y', steps)
 
     def yRight(self, args=0):
-        global ser
-        if not ser.is_open or not self.yRightButton.cget('state') == tk.NORMAL:
-            return
-        if (self.yStepSize.get() == ""):
-            tk.messagebox.showerror("Error", "No step size selected")
+        if not self.client.isConnected() or not self.yRightButton.cget('state') == tk.NORMAL:
             return
-        elif (not self.yStepSize.get().isdigit()):
-            tk.messagebox.showerror("Error", "Step size must be a whole number")
+        steps = self.stepSize(self.yStepSize)
+        if steps is None:
             return
-        self.yStepSizeVal = self.yStepSize.get()
-        ser.write(f'yMove -{self.yStepSizeVal}\n'.encode('utf-8'))
+        self.yStepSizeVal = steps
+        self.client.move('y', f'-{steps}')
 
     def zUp(self, args=0):
-        global ser
-        if not ser.is_open or not self.zUpButton.cget('state') == tk.NORMAL:
+        if not self.client.isConnected() or not self.zUpButton.cget('state') == tk.NORMAL:
             return
-        if (self.zStepSize.get() == ""):
-            tk.messagebox.showerror("Error", "No step size selected")
-            return
-        elif (not self.zStepSize.get().isdigit()):
-            tk.messagebox.showerror("Error", "Step size must be a whole number")
+        steps = self.stepSize(self.zStepSize)
+        if steps is None:
             return
-        self.zStepSizeVal = self.zStepSize.get()
-        ser.write(f'zMove -{self.zStepSizeVal}\n'.encode('utf-8'))
+        self.zStepSizeVal = steps
+        self.client.move('z', f'-{steps}')
 
     def zDown(self, args=0):
-        global ser
-        if not ser.is_open or not self.zDownButton.cget('state') == tk.NORMAL:
+        if not self.client.isConnected() or not self.zDownButton.cget('state') == tk.NORMAL:
             return
-        if (self.zStepSize.get() == ""):
-            tk.messagebox.showerror("Error", "No step size selected")
+        steps = self.stepSize(self.zStepSize)
+        if steps is None:
             return
-        elif (not self.zStepSize.get().isdigit()):
-            tk.messagebox.showerror("Error", "Step size must be a whole number")
+        self.zStepSizeVal = steps
+        self.client.move('z', steps)
+
+    def jogPress(self, axis, direction):
+        # Typing a step size isn't jogging
+        if isinstance(self.root.focus_get(), tk.Entry):
             return
-        self.zStepSizeVal = self.zStepSize.get()
-        ser.write(f'zMove {self.zStepSizeVal}\n'.encode('utf-8'))
-    
+        if not self.client.isConnected() or not self.controlAllowed:
+            return
+        self.jogger.press(axis, direction)
+
+    # Key repeats in between are folded into one jog command per tick at most
+    def jogTick(self):
+        self.jogger.tick()
+        self.root.after(round(JOG_TICK * 1000), self.jogTick)
+
     def zWeld(self, args=0):
-        global ser
-        if not ser.is_open or not self.zUpButton.cget('state') == tk.NORMAL:
+        if not self.client.isConnected() or not self.zUpButton.cget('state') == tk.NORMAL:
             return
-        ser.write(b'zStepCycle\n')
-    
+        self.client.stepCycle()
+
     def zWeldExpanded(self, args=0):
-        global ser
-        if not ser.is_open or not self.zUpButton.cget('state') == tk.NORMAL:
+        if not self.client.isConnected() or not self.zUpButton.cget('state') == tk.NORMAL:
             return
-        ser.write(f'zWeld {self.selectedRow}_{self.selectedCol}_{self.selectedSide}\n'.encode('utf-8'))
-    
-    def setWelded(self, row, col, side):
-        self.cellStates[row][col][side] = 1
-        try:
-            if (self.packViewer.winfo_ismapped()):
-                if (side == 0):
-                    self.packButtons[row][col][side].configure(image=self.red_l_semi)
-                else:
-                    self.packButtons[row][col][side].configure(image=self.red_r_semi)
-        except:
-            pass
-        
+        self.client.zWeld(self.selectedRow, self.selectedCol, self.selectedSide)
+
     def resetWelds(self):
-        global ser
-        if not ser.is_open:
-            return
-        ser.write(b'resetWelds\n')
-        for i in range(16):
-            for j in range(24):
-                for k in range(2):
-                    self.cellStates[i][j][k] = 0
-                    if (k == 0):
-                        self.packButtons[i][j][k].configure(image=self.green_l_semi)
-                    else:
-                        self.packButtons[i][j][k].configure(image=self.green_r_semi)
+        if not self.client.isConnected():
+            return
+        self.client.resetWelds()
 
     def xSetStep(self):
-        global ser
-        if not ser.is_open:
+        if not self.client.isConnected():
             return
-        if (self.xStepSize.get() == ""):
-            tk.messagebox.showerror("Error", "No step size selected")
-            return
-        elif (not self.xStepSize.get().isdigit()):
-            tk.messagebox.showerror("Error", "Step size must be a whole number")
-            return
-        ser.write(f'xSetStepSize {self.xStepSize.get()}\n'.encode('utf-8'))
-    
+        steps = self.stepSize(self.xStepSize)
+        if steps is not None:
+            self.client.setStepSize('x', steps)
+
     def ySetStep(self):
-        global ser
-        if not ser.is_open:
-            return
-        if (self.yStepSize.get() == ""):
-            tk.messagebox.showerror("Error", "No step size selected")
-            return
-        elif (not self.yStepSize.get().isdigit()):
-            tk.messagebox.showerror("Error", "Step size must be a whole number")
+        if not self.client.isConnected():
             return
-        ser.write(f'ySetStepSize {self.yStepSize.get()}\n'.encode('utf-8'))
-    
+        steps = self.stepSize(self.yStepSize)
+        if steps is not None:
+            self.client.setStepSize('y', steps)
+
     def zSetStep(self):
-        global ser
-        if not ser.is_open:
-            return
-        if (self.zStepSize.get() == ""):
-            tk.messagebox.showerror("Error", "No step size selected")
+        if not self.client.isConnected():
             return
-        elif (not self.zStepSize.get().isdigit()):
-            tk.messagebox.showerror("Error", "Step size must be a whole number")
-            return
-        ser.write(f'zSetStepSize {self.zStepSize.get()}\n'.encode('utf-8'))
+        steps = self.stepSize(self.zStepSize)
+        if steps is not None:
+            self.client.setStepSize('z', steps)
 
     def selectPackType(self):
-        global ser
-        if not ser.is_open:
+        if not self.client.isConnected():
             return
-        if (self.packType.get() == "A"):
-            ser.write(b'packType A\n')
-        elif (self.packType.get() == "B"):
-            ser.write(b'packType B\n')
+        if self.packType.get() in geometry.layouts():
+            self.selectLayout(self.packType.get())
+        elif self.packType.get() in fw.PACK_TYPES:
+            self.client.setPackType(self.packType.get())
+
+    def selectLayout(self, name):
+        try:
+            layout = calibration.calibratedLayout(name)
+        except ValueError as error:
+            tk.messagebox.showerror("Pack Layout", str(error))
+            return
+        self.cancelCalibration()
+        journal = self.client.journal
+        if layout.shape != self.client.geometry.shape:
+            journal = self.openJournal(layout)
+        self.client.setGeometry(layout, journal)
+        self.layoutName.set(name)
+        self.packType.set(layout.packType or "")
+
+    # Journal of the layout's shape, or None if it can't be opened
+    def openJournal(self, layout):
+        try:
+            journal = Journal(shapePath(DEFAULT_PATH, layout.rows, layout.cells), WeldMask(*layout.shape))
+            print(f"Restored {journal.mask.count()} welds from the journal ({journal.replayed} records replayed)")
+        except (OSError, ValueError) as error:
+            print(f"Weld journal unavailable: {error}")
+            journal = None
+        return journal
 
     def refreshConnections(self):
-        self.connectTarget.configure(values = [port.name for port in serial.tools.list_ports.comports()])
+        self.portMonitor.rescan()
+
+    # Port list changes from the monitor, as adapters are plugged in and out
+    def showPorts(self):
+        try:
+            while True:
+                self.connectTarget.configure(values=self.ports.get_nowait())
+        except queue.Empty:
+            pass
+        self.root.after(PORT_POLL_MS, self.showPorts)
 
     def connect(self):
-        global ser
-        global safeDisconnect
-        if (ser.is_open):
-            safeDisconnect = True
-            ser.close()
+        if self.client.isConnected():
+            # The operator disconnected, don't connect again behind their back
+            self.client.autoConnect = False
+            self.client.disconnect()
             self.connectionButton.configure(text="Connect", fg_color="green")
-            self.statusCurrent.configure(text="Disconnected", text_color="orange")
+            self.showStatus("Disconnected", "orange")
             self.disableControl()
             return
-        safeDisconnect = False
-        ser.port = self.connectTargText.get()
-        if (ser.port == ""):
+        port = self.connectTargText.get()
+        if (port == ""):
             tk.messagebox.showerror("Connection Error", "No port selected")
             return
         try:
-            ser.open()
+            self.client.connect(port)
         except serial.SerialException:
             print("Could not open port")
             tk.messagebox.showerror("Connection Error", "Could not open port")
             return
-        # print(ser.is_open)
+        self.client.autoConnect = True
+        self.showConnected()
+
+    def showConnected(self):
         self.connectionButton.configure(text="Disconnect", fg_color="red")
         self.startButton.configure(state=tk.NORMAL)
+        self.resumeButton.configure(state=tk.NORMAL)
         self.enableControl()
 
     def homeX(self):
-        global finished
-        global ser
-        if not finished:
-            return
-        ser.write(b'xHome\n')
+        if self.client.finished:
+            self.client.home('x')
 
     def homeY(self):
-        global finished
-        global ser
-        if not finished:
-            return
-        ser.write(b'yHome\n')
+        if self.client.finished:
+            self.client.home('y')
 
     def homeZ(self):
-        global finished
-        global ser
-        if not finished:
-            return
-        ser.write(b'zHome\n')
+        if self.client.finished:
+            self.client.home('z')
 
     def homeAll(self):
-        global finished
-        global ser
-        if not finished:
-            return
-        ser.write(b'homeAll\n')
+        if self.client.finished:
+            self.client.home()
 
     def cellSelect(self, row, col, side):
-        global finished
-        global ser
-        if not finished:
+        if not self.client.finished:
             return
         if not self.controlAllowed:
             return
-        ser.write(f"moveToCell {row}_{col}_{side}".encode('utf-8'))
+        self.client.moveToCell(row, col, side)
         self.selectedRow = row
         self.selectedCol = col
         self.selectedSide = side
+        return True
 
-    def cellButtons(self, row, col):
-        cellButtonsLocal = [ctk.CTkButton(self.packViewerMain, image=self.green_l_semi, text="", command=lambda: self.cellSelect(row, col, 0), corner_radius=0, width=10, height=20, fg_color="#08003A"),
-                            ctk.CTkButton(self.packViewerMain, image=self.green_r_semi, text="", command=lambda: self.cellSelect(row, col, 1), corner_radius=0, width=10, height=20, fg_color="#08003A")]
-        if (self.cellStates[row][col][0] == 1):
-            cellButtonsLocal[0].configure(image=self.red_l_semi)
-        if (self.cellStates[row][col][1] == 1):
-            cellButtonsLocal[1].configure(image=self.red_r_semi)
-        return cellButtonsLocal
-    
     def expand(self):
-        self.packViewer = ctk.CTkToplevel(self.root, fg_color="#08003A")
-        self.packViewer.title("Pack Viewer")
-        self.packViewer.geometry("800x575")
-        self.packViewer.bind("<space>", self.zWeldExpanded)
+        # The viewer is built once and only hidden when closed
+        if self.packViewer is None:
+            self.packViewer = PackViewer(self.root, self.client.geometry, lambda row, col, side: self.client.welds[row, col, side] == 1,
+                                         self.cellSelect, self.zWeldExpanded, self.resetWelds, self.weldBatch)
+        self.packViewer.show(self.client.geometry)
 
-        self.packViewerMain = ctk.CTkFrame(self.packViewer, fg_color="#08003A")
-        self.packViewerMain.pack(side=tk.TOP, fill=tk.BOTH, expand=True, padx=10, pady=10)
-        
-        self.selectedRow = 0
-        self.selectedCol = 0
-        self.selectedSide = 0
-        
-        # Pack viewer
-        self.packButtons = [[self.cellButtons(j, i) for i in range(24)] for j in range(16)]
-        for i in range(16):
-            for j in range(24):
-                colOffset = ((i + 1) % 2) + (i % 2) * (2 * (self.packType.get() == "A"))
-                self.packButtons[i][j][0].grid(column=j*2 + colOffset, row=i, pady=2)
-                self.packButtons[i][j][1].grid(column=j*2 + colOffset + 1, row=i, pady=2)
-        
-        self.packViewFooter = ctk.CTkFrame(self.packViewer, fg_color="#08003A")
-        self.packViewFooter.pack(side=tk.BOTTOM, fill=tk.X, expand=True, padx=10, pady=10)
+    def start(self):
+        message = "Are you sure you want to start welding?"
+        # Layouts without a firmware pack type can only be welded point by point
+        if self.optimizeOrder.get() or self.blendMoves.get() or self.client.geometry.packType is None:
+            if self.allWelded():
+                return
+            blend = self.blendMoves.get()
+            self.planJob(lambda: self.planRemaining(blend=blend), "Start Welding", message)
+        else:
+            self.planJob(self.planPattern, "Start Welding", message)
+
+    # Weld only the cells the journal has not seen welded, in travel-optimised order
+    def resumePack(self):
+        if self.allWelded():
+            return
+        blend = self.blendMoves.get()
+        self.planJob(lambda: self.planRemaining(blend=blend), "Resume Pack", "Resume welding the remaining cells?")
+
+    # Weld the cells gathered in the pack viewer as one job, welded ones again, in
+    # travel-optimised order. Pause and stop work as for a pack.
+    def weldBatch(self, cells):
+        if not self.client.isConnected() or not self.client.finished or not self.controlAllowed:
+            return False
+        welded = sum(self.client.welds[cell] for cell in cells)
+        message = f"Weld the {len(cells)} selected welds?" + (f" {welded} of them are welded already." if welded else "")
+        blend = self.blendMoves.get()
+        return self.planJob(lambda: self.planRemaining(cells, blend), "Weld Selected", message, f"{len(cells)} selected welds")
+
+    def allWelded(self):
+        if self.client.welds.unwelded():
+            return False
+        tk.messagebox.showinfo("Start Welding", "All cells are already welded")
+        return True
+
+    # Planning a pack takes a second or two, so plan() runs on a worker thread with the
+    # start buttons disabled. Back on the Tk thread the operator confirms the plan with
+    # message and the job runs. Returns False if a job is being planned or running.
+    def planJob(self, plan, title, message, name=None):
+        if self.planning or not self.client.finished:
+            return False
+        self.planning = True
+        self.startButton.configure(state=tk.DISABLED)
+        self.resumeButton.configure(state=tk.DISABLED)
+        results = queue.Queue()
+        geometry = self.client.geometry
 
-        self.reset = ctk.CTkButton(self.packViewFooter, text="Reset", command=self.resetWelds, corner_radius=999, width=50, height=25)
-        self.reset.pack(side=tk.TOP, padx=10, pady=10)
+        def work():
+            try:
+                results.put((plan(), None))
+            except Exception as error:
+                results.put((None, error))
 
-    def start(self):
-        global finished
-        global paused
-        global ser
-        if not tk.messagebox.askokcancel("Start Welding", "Are you sure you want to start welding?"):
-            return
+        threading.Thread(target=work, daemon=True).start()
+        self.root.after(PLAN_POLL_MS, lambda: self.awaitPlan(results, geometry, title, message, name))
+        return True
+
+    def awaitPlan(self, results, geometry, title, message, name):
+        try:
+            result, error = results.get_nowait()
+        except queue.Empty:
+            self.root.after(PLAN_POLL_MS, lambda: self.awaitPlan(results, geometry, title, message, name))
+            return
+        self.planning = False
+        connected = self.client.isConnected() and self.client.finished
+        self.startButton.configure(state=tk.NORMAL if connected else tk.DISABLED)
+        self.resumeButton.configure(state=tk.NORMAL if connected else tk.DISABLED)
+        if error is not None:
+            tk.messagebox.showerror(title, f"Could not plan the job: {error}")
+            return
+        if self.client.geometry is not geometry:
+            tk.messagebox.showinfo(title, "The pack layout changed while the job was planned, start it again")
+            return
+        order, jobEstimate, summary = result
+        if connected and tk.messagebox.askokcancel(title, message + summary):
+            self.runJob(order, jobEstimate, name)
+
+    # runPack's own pattern: (None, estimate, summary), on the planning thread
+    def planPattern(self):
+        jobEstimate = self.client.estimateJob()
+        return None, jobEstimate, f"\n\n{jobEstimate.count} welds, predicted {formatDuration(jobEstimate.total)}"
+
+    # Plan cells, the unwelded ones by default: (order, estimate, summary), on the planning
+    # thread. Tk variables can't be read there, so blend is passed in.
+    def planRemaining(self, cells=None, blend=False):
+        layout = self.client.geometry
+        order = self.client.planRemaining(cells)
+        jobEstimate = self.client.estimateJob(order, blend)
+        summary = f"\n\n{len(order)} welds, predicted {formatDuration(jobEstimate.total)}"
+        if cells is None and layout.packType is not None:
+            baseline = planner.baselineTime(self.client.welds.unwelded(), fw.PACK_TYPES[layout.packType], layout, self.client.profile)
+            summary += f" (fixed pattern {formatDuration(baseline)})"
+        return order, jobEstimate, summary
+
+    # Run runPack, or stream order with weldAt when given. Returns True if the job started.
+    def runJob(self, order=None, jobEstimate=None, name=None):
         if not tk.messagebox.askyesno("Check Alignment", "Have you checked alignment?"):
-            return
+            return False
         if not tk.messagebox.askyesno("Check Pack Type", "Have you selected the correct pack type?"):
-            return
-        if not finished:
-            return
-        finished = False
+            return False
+        if not self.client.runPack(order, jobEstimate, order is not None and self.blendMoves.get(), name):
+            return False
         self.stopButton.configure(state=tk.NORMAL)
         self.pauseButton.configure(state=tk.NORMAL)
         self.startButton.configure(state=tk.DISABLED)
-        # self.progressFrame.pack(side=tk.BOTTOM, fill=tk.X, padx=30, pady=10)
+        self.resumeButton.configure(state=tk.DISABLED)
+        self.progressFrame.pack(side=tk.BOTTOM, fill=tk.X, padx=30, pady=10)
         self.disableControl()
-        ser.write(b'runPack\n')
-    
+        self.updateProgress()
+        return True
+
+    # Completion, weld rate and time left from the client's job estimate
+    def showEstimate(self):
+        estimate = self.client.estimate
+        if estimate is None:
+            return
+        rate = estimate.rate()
+        self.progressPercent.configure(text=f"{estimate.percent():.0f}%")
+        self.progressRate.configure(text=f"{rate:.1f}" if rate is not None else "-")
+        self.progressEta.configure(text=formatDuration(estimate.remaining()))
+
+    def updateProgress(self):
+        if self.client.finished:
+            return
+        self.showEstimate()
+        self.root.after(PROGRESS_UPDATE_MS, self.updateProgress)
+
     def align(self):
-        global finished
-        global paused
-        global ser
+        # Commands run in order, so align waits for homing to finish
         if tk.messagebox.askyesno("Home First", "Would you like to home first?"):
             self.homeAll()
-            time.sleep(2)
-        ser.write(b'align\n')
+        self.client.align()
+
+    # First press moves to the first reference cell; jog onto its weld point and press
+    # again to record it. The correction is fitted after the last one.
+    def calibrate(self):
+        if not self.client.isConnected() or not self.client.finished or self.calibrationQuery is not None:
+            return
+        if self.calibrationRun is None:
+            if not tk.messagebox.askokcancel("Calibrate", "Jog the electrodes onto each reference weld point and press Record.\n\nStart calibrating?"):
+                return
+            self.calibrationRun = calibration.CalibrationRun(self.client)
+            self.nextCalibrationCell()
+            return
+        self.calibrationQuery = self.client.queryAxes()
+        self.root.after(EVENT_POLL_MS, self.recordCalibration)
+
+    def nextCalibrationCell(self):
+        run = self.calibrationRun
+        run.moveToCurrent()
+        row, cell, side = run.current
+        self.calibrateButton.configure(text=f"Record {row}_{cell}_{side} ({len(run.measured) + 1}/{len(run.references)})")
+
+    def recordCalibration(self):
+        query = self.calibrationQuery
+        if query is None or self.calibrationRun is None:
+            return
+        if not query.done():
+            self.root.after(EVENT_POLL_MS, self.recordCalibration)
+            return
+        self.calibrationQuery = None
+        if query.exception() is not None:
+            self.cancelCalibration()
+            tk.messagebox.showerror("Calibrate", f"Could not read the head position: {query.exception()}")
+            return
+        # The answer is an event of its own, queued before the reply that resolved the query
+        self.client.poll()
+        run = self.calibrationRun
+        if not run.record():
+            tk.messagebox.showerror("Calibrate", "The head is still moving, record again once it stops")
+            return
+        if not run.done:
+            self.nextCalibrationCell()
+            return
+        self.cancelCalibration()
+        try:
+            transform = run.fit()
+        except ValueError as error:
+            tk.messagebox.showerror("Calibrate", str(error))
+            return
+        if tk.messagebox.askyesno("Calibrate", f"{run.summary(transform)}\n\nUse this calibration for layout {run.nominal.name}?"):
+            run.apply()
+
+    def cancelCalibration(self):
+        self.calibrationRun = None
+        self.calibrationQuery = None
+        self.calibrateButton.configure(text="Calibrate")
 
     def stop(self):
-        global finished
-        global paused
-        global ser
-        finished = True
-        paused = False
         self.stopButton.configure(state=tk.DISABLED)
         self.pauseButton.configure(state=tk.DISABLED)
         self.startButton.configure(state=tk.NORMAL)
-        # self.progressFrame.pack_forget()
+        self.resumeButton.configure(state=tk.NORMAL)
+        self.progressFrame.pack_forget()
         self.enableControl()
-        ser.write(b'stop\n')
+        self.client.stop()
 
     def pause(self):
-        global paused
-        global ser
-        if paused:
+        if self.client.paused:
             if not tk.messagebox.askokcancel("Continue Welding", "Are you sure you want to resume welding?"):
                 return
-            paused = False
             self.pauseButton.configure(text="Pause")
             self.disableControl()
-            ser.write(b'continue\n')
+            self.client.resume()
             return
-        paused = True
         self.pauseButton.configure(text="Resume")
         self.enableControl()
-        ser.write(b'pause\n')
-    
+        self.client.pause()
+
     def lostConnection(self):
         self.disableControl()
         self.startButton.configure(state=tk.DISABLED)
+        self.resumeButton.configure(state=tk.DISABLED)
         self.pauseButton.configure(state=tk.DISABLED)
         self.stopButton.configure(state=tk.DISABLED)
+        self.progressFrame.pack_forget()
+        if self.client.status == "Reconnecting":
+            # Comes back by itself after a USB glitch; the job stops and is resumed by hand
+            self.showStatus("Reconnecting", "orange")
+            return
         self.connectionButton.configure(text="Connect", fg_color="green")
-        self.statusCurrent.configure(text="Lost Connection", text_color="red")
+        self.showStatus("Lost Connection", "red")
         tk.messagebox.showerror("Connection Error", "Connection lost")
 
     def finish(self):
-        global finished
-        finished = True
+        self.exportMetrics()
         self.stopButton.configure(state=tk.DISABLED)
         self.pauseButton.configure(state=tk.DISABLED)
         self.startButton.configure(state=tk.NORMAL)
-        # self.progressFrame.pack_forget()
-    
-root = ctk.CTk()
-app = GUI(root)
-
-end = False
-wasOpen = False
-safeDisconnect = False
-
-def checkFinish():
-    global end
-    global wasOpen
-    global safeDisconnect
-    while not end:
-        time.sleep(0.1)
-        try:
-            if not ser.is_open:
-                if wasOpen:
-                    if not safeDisconnect:
-                        app.lostConnection()
-                    wasOpen = False
-                continue
-            wasOpen = True
-            while (ser.in_waiting > 0 and not end):
-                line = ser.readline()
-                line = line.decode('ascii')
-                if (line[-2:] == '\r\n'):
-                    line = line[:-2]
-                elif (line[-1] == '\n'):
-                    line = line[:-1]
-                print(line)
-                if (line == ''):
-                    continue
-                elif (line[0] == '#'):
-                    continue
-                elif (line == 'finished'):
-                    print("done")
-                    app.finish()
-                elif (line[0] == 'R'):
-                    app.statusCurrent.configure(text="Running", text_color="green")
-                    try:
-                        state = line[1:].split(' ')
-                    except:
-                        continue
-                    # app.progressRow.configure(text=state[0])
-                    # app.progressPass.configure(text=state[1])
-                    # app.progressCell.configure(text=state[2])
-                    app.setWelded(int(state[0]), int(state[2]), int(state[1]))
-                elif (line == 'paused'):
-                    app.statusCurrent.configure(text="Paused", text_color="orange")
-                elif (line == 'ESTOP'):
-                    app.statusCurrent.configure(text="Emergency Stop", text_color="red")
-                    tk.messagebox.showerror("Emergency Stop", "Emergency Stop Activated")
-                elif (line == 'idle'):
-                    app.statusCurrent.configure(text="Idle", text_color="yellow")
-                elif (line == 'moving'):
-                    app.statusCurrent.configure(text="Moving", text_color="green")
-                    # print('yippeee')
-        except serial.SerialException:
-            app.lostConnection()
-            wasOpen = False
-            ser.close()
-    ser.close()
-
-finishThread = threading.Thread(target=checkFinish)
+        self.resumeButton.configure(state=tk.NORMAL)
+        self.progressFrame.pack_forget()
 
-finishThread.start()
-root.mainloop()
-end = True
\ No newline at end of file
+    # Timing of the last jobs, for finding where pack time goes
+    def exportMetrics(self):
+        try:
+            self.client.metrics.export()
+        except OSError as error:
+            print(f"Could not write metrics: {error}")
+
+    def processEvents(self):
+        self.client.poll()
+        if self.renderPending() and time.perf_counter() - self.lastRender >= FRAME_MS / 1000:
+            self.render()
+        self.root.after(EVENT_POLL_MS, self.processEvents)
+
+    # Called by the client after it has handled each event
+    def handleEvent(self, event):
+        handler = self.eventHandlers.get(event.kind)
+        if handler is not None:
+            handler(event)
+
+    def renderPending(self):
+        return (self.pendingStatus is not None or self.pendingProgress is not None
+                or self.pendingReset or bool(self.pendingWelds) or self.pendingAxes)
+
+    # Draw what the events since the last frame changed
+    def render(self):
+        self.lastRender = time.perf_counter()
+        if self.pendingStatus is not None:
+            self.showStatus(*self.pendingStatus)
+        if self.pendingProgress is not None:
+            row, cell, side = self.pendingProgress
+            self.progressRow.configure(text=row)
+            self.progressPass.configure(text=side)
+            self.progressCell.configure(text=cell)
+            self.showEstimate()
+            self.pendingProgress = None
+        if self.packViewer is not None:
+            if self.pendingReset:
+                self.packViewer.resetAll()
+            for point in self.pendingWelds:
+                self.packViewer.setWelded(*point)
+        self.pendingReset = False
+        self.pendingWelds.clear()
+        if self.pendingAxes:
+            self.showAxes()
+            self.pendingAxes = False
+
+    # Each axis's position, and where it is going while it moves
+    def showAxes(self):
+        client = self.client
+        for index, axis in enumerate("xyz"):
+            text = "-" if client.position is None else str(client.position[index])
+            running = client.running is not None and client.running[index]
+            if running:
+                text += f" > {client.target[index]}"
+            self.droValues[axis].configure(text=text, text_color="green" if running else self.droColor)
+
+    # Status label now, left alone when it already shows this
+    def showStatus(self, text, color):
+        self.pendingStatus = None
+        if (text, color) != self.shownStatus:
+            self.shownStatus = (text, color)
+            self.statusCurrent.configure(text=text, text_color=color)
+
+    # Status for the next frame, the last one set wins
+    def setStatus(self, text, color):
+        self.pendingStatus = None if (text, color) == self.shownStatus else (text, color)
+
+    def onFinished(self, event):
+        print("done")
+        self.render()
+        self.finish()
+
+    # The firmware rejected a weld of the job, what is left can be resumed
+    def onFailed(self, event):
+        self.setStatus("Job Failed", "red")
+        self.render()
+        self.finish()
+        tk.messagebox.showerror("Job Failed", f"{event.args[0]}. Resume Pack welds the rest.")
+
+    def onWelded(self, event):
+        # A dict keeps the order the welds came in
+        self.pendingWelds[event.args] = None
+
+    def onReset(self, event):
+        self.pendingWelds.clear()
+        self.pendingReset = True
+
+    def onLayout(self, event):
+        # The viewer redraws every cell from the client's mask
+        self.pendingWelds.clear()
+        self.pendingReset = False
+        if self.packViewer is not None:
+            self.packViewer.setGeometry(self.client.geometry)
+
+    def onProgress(self, event):
+        self.setStatus("Running", "green")
+        self.pendingProgress = event.args
+
+    def onAxes(self, event):
+        self.pendingAxes = True
+
+    def onEstop(self, event):
+        self.setStatus("Emergency Stop", "red")
+        self.render()
+        tk.messagebox.showerror("Emergency Stop", "Emergency Stop Activated")
+
+    def onLost(self, event):
+        self.render()
+        self.lostConnection()
+
+    # The firmware answers, also after a reconnect or when the monitor found the welder
+    def onReady(self, event):
+        self.connectTargText.set(self.client.port)
+        self.setStatus("Connected", "green")
+        self.showConnected()
+
+
+# Time from launch until the window is drawn, against STARTUP_BUDGET
+def startupBenchmark():
+    imported = time.perf_counter()
+    root = ctk.CTk()
+    app = GUI(root)
+    built = time.perf_counter()
+    root.update()
+    drawn = time.perf_counter()
+    print(f"imports {(imported - STARTED) * 1000:6.0f} ms")
+    print(f"widgets {(built - imported) * 1000:6.0f} ms")
+    print(f"drawing {(drawn - built) * 1000:6.0f} ms")
+    print(f"total   {(drawn - STARTED) * 1000:6.0f} ms (budget {STARTUP_BUDGET * 1000:.0f} ms)")
+    app.portMonitor.stop()
+    app.client.close()
+    app.history.close()
+    root.destroy()
+    return drawn - STARTED <= STARTUP_BUDGET
+
+
+def main():
+    if "--startup-benchmark" in sys.argv:
+        sys.exit(0 if startupBenchmark() else 1)
+    root = ctk.CTk()
+    app = GUI(root)
+    root.mainloop()
+    app.exportMetrics()
+    app.portMonitor.stop()
+    app.client.close()
+    app.history.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+"""Host-side tooling for the CNC Spot Welder (simulator, protocol and planning helpers)."""
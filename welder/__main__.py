@@ -0,0 +1,206 @@
+"""Command line control of the welder without the GUI.
+
+    python -m welder --port /dev/ttyUSB0 status
+    python -m welder --port COM3 run-pack --type B --optimize
+    python -m welder --port COM3 --layout B weld-cell 3 12 0
+    python -m welder --port COM3 weld-cells 3_12_0 3_13_1 --row 5 --unwelded
+    python -m welder --port auto status
+
+Exits with status 1 when the welder rejects a command, stops or can't be reached.
+"""
+import argparse
+
+import serial
+
+from . import firmware as fw
+from . import geometry
+from . import history
+from . import ports
+from . import tuning
+from .calibration import calibratedLayout
+from .client import WelderClient
+from .commands import CommandError
+from .estimate import formatDuration
+from .journal import DEFAULT_PATH, Journal, shapePath
+from .weldmask import WeldMask
+
+
+def showProgress(client, event):
+    if event.kind == "welded":
+        row, cell, side = event.args
+        eta = f", {client.estimate.summary()}" if client.estimate is not None and not client.finished else ""
+        print(f"welded {row}_{cell}_{side} ({client.welds.count()}/{client.welds.size}{eta})")
+    elif event.kind == "estop":
+        print("Emergency stop")
+
+
+def connect(client, args):
+    print(f"{args.port}: {client.welds.count()}/{client.welds.size} welded")
+
+
+def home(client, args):
+    client.wait(client.home(args.axis))
+
+
+# --type, or the firmware pack type of the layout
+def packType(client, args):
+    name = args.type or client.geometry.packType
+    if name is None:
+        raise SystemExit(f"Layout {client.geometry.name} has no firmware pack type, use --type or --optimize")
+    return name
+
+
+def align(client, args):
+    client.wait(client.setPackType(packType(client, args)))
+    client.wait(client.align())
+
+
+def status(client, args):
+    # The firmware reports idle/moving every STATUS_PERIOD ms
+    client.waitFor(lambda: client.status not in ("Connecting", "Connected"), 2 * fw.STATUS_PERIOD / 1000)
+    print(f"{client.status}, {client.welds.count()}/{client.welds.size} welded")
+    try:
+        client.wait(client.queryAxes(), 2)
+    except CommandError:
+        return  # Firmware without status
+    for axis, position, target, running in zip("xyz", client.position, client.target, client.running):
+        print(f"{axis} {position:8d}" + (f" -> {target}" if running else ""))
+
+
+def runPack(client, args):
+    order = None
+    if args.optimize or args.blend:
+        order = client.planRemaining()
+        if not order:
+            print("All cells are already welded")
+            return
+    else:
+        client.wait(client.setPackType(packType(client, args)))
+    runJob(client, order, args.blend)
+
+
+# Run a job and follow its progress until it finishes
+def runJob(client, order, blend, name=None):
+    jobEstimate = client.estimateJob(order, blend)
+    print(f"Predicted {formatDuration(jobEstimate.total)} for {jobEstimate.count} welds")
+    client.listeners.append(lambda event: showProgress(client, event))
+    client.runPack(order, jobEstimate, blend, name)
+    try:
+        client.waitFor(lambda: client.finished or client.status == "Emergency Stop")
+    except KeyboardInterrupt:
+        client.stop()
+        raise SystemExit("Stopped")
+    if not client.finished:
+        raise SystemExit("Emergency stop")
+    if client.failure is not None:
+        raise SystemExit(f"{client.failure}, job stopped at {client.welds.count()}/{client.welds.size} welded")
+    print(f"Finished, {client.welds.count()}/{client.welds.size} welded")
+    print(client.metrics.summary())
+
+
+# Weld the given cells and rows as one job, welded ones again, in travel-optimised order
+def weldCells(client, args):
+    rows, cells, sides = client.geometry.shape
+    selected = set()
+    for text in args.cells:
+        try:
+            selected.add(tuple(int(value) for value in text.split("_")))
+        except ValueError:
+            raise SystemExit(f"Cells are row_cell_side, not {text}")
+    for row in args.row:
+        selected.update((row, cell, side) for cell in range(cells) for side in range(sides))
+    for point in selected:
+        if len(point) != 3 or not client.geometry.contains(*point):
+            raise SystemExit(f"No cell {'_'.join(map(str, point))} in layout {client.geometry.name}")
+    if args.unwelded:
+        selected = [point for point in selected if not client.welds[point]]
+    if not selected:
+        print("Nothing to weld")
+        return
+    runJob(client, client.planRemaining(selected), args.blend, f"{len(selected)} selected welds")
+
+
+def weldCell(client, args):
+    client.listeners.append(lambda event: showProgress(client, event))
+    if not client.geometry.contains(args.row, args.cell, args.side):
+        raise SystemExit(f"No cell {args.row}_{args.cell}_{args.side} in layout {client.geometry.name}")
+    client.wait(client.weldAt(args.row, args.cell, args.side))
+    client.poll()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m welder", description="Drive the CNC spot welder without the GUI.")
+    parser.add_argument("--port", required=True, help="serial port of the welder, or auto to probe the USB serial ports")
+    parser.add_argument("--baud", type=int, default=fw.BAUD)
+    parser.add_argument("--journal", default=DEFAULT_PATH, help="weld journal, shared with the GUI")
+    parser.add_argument("--no-journal", action="store_true", help="don't read or write the weld journal")
+    parser.add_argument("--layout", default=geometry.DEFAULT_LAYOUT, help="pack layout from layouts.json")
+    parser.add_argument("--text", action="store_true", help="stay on the text protocol instead of switching to frames")
+    parser.add_argument("--echo", action="store_true", help="print every line from the firmware")
+    parser.add_argument("--history", default=history.DEFAULT_PATH, help="weld history database, shared with the GUI")
+    parser.add_argument("--no-history", action="store_true", help="don't record welds in the history")
+    parser.add_argument("--metrics", metavar="DIR", help="write timing metrics (Prometheus textfile and CSV) here")
+    parser.add_argument("--record", metavar="DIR", help="record every byte sent and received to a session file here")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("connect", help="check the welder answers").set_defaults(run=connect)
+    command = commands.add_parser("home", help="home one axis or all of them")
+    command.add_argument("axis", nargs="?", choices=["x", "y", "z"])
+    command.set_defaults(run=home)
+    command = commands.add_parser("align", help="move to the first cell of the pack")
+    command.add_argument("--type", choices=sorted(fw.PACK_TYPES), help="pack type, by default the layout's")
+    command.set_defaults(run=align)
+    commands.add_parser("status", help="print machine status and weld count").set_defaults(run=status)
+    command = commands.add_parser("run-pack", help="weld every remaining cell")
+    command.add_argument("--type", choices=sorted(fw.PACK_TYPES), help="pack type for runPack, by default the layout's")
+    command.add_argument("--optimize", action="store_true", help="stream a travel-optimised order")
+    command.add_argument("--blend", action="store_true", help="stream the optimised order as blended moves (implies --optimize)")
+    command.set_defaults(run=runPack)
+    command = commands.add_parser("weld-cells", help="weld several cells as one job, welded ones again")
+    command.add_argument("cells", nargs="*", metavar="ROW_CELL_SIDE")
+    command.add_argument("--row", type=int, action="append", default=[], help="add every weld point of this row")
+    command.add_argument("--unwelded", action="store_true", help="leave out the points already welded")
+    command.add_argument("--blend", action="store_true", help="stream as blended moves")
+    command.set_defaults(run=weldCells)
+    command = commands.add_parser("weld-cell", help="move to one cell and weld it")
+    command.add_argument("row", type=int)
+    command.add_argument("cell", type=int)
+    command.add_argument("side", type=int, choices=range(fw.PACK_SIDES))
+    command.set_defaults(run=weldCell)
+    args = parser.parse_args()
+
+    try:
+        layout = calibratedLayout(args.layout)
+    except ValueError as error:
+        raise SystemExit(str(error))
+    journal = None
+    if not args.no_journal:
+        journal = Journal(shapePath(args.journal, layout.rows, layout.cells), WeldMask(*layout.shape))
+    client = WelderClient(journal=journal, echo=args.echo, baud=args.baud, binary=not args.text, geometry=layout,
+                          record=args.record, profile=tuning.loadProfile())
+    weldHistory = None
+    if not args.no_history:
+        weldHistory = history.History(args.history)
+        client.listeners.append(weldHistory.handleEvent)
+    try:
+        if args.port == "auto":
+            args.port = ports.findWelder([device for device, description, usb in ports.listPorts() if usb])
+            if args.port is None:
+                raise SystemExit("No welder answers on the USB serial ports")
+        client.connect(args.port)
+        if not client.waitReady():
+            raise SystemExit(f"No answer from the welder on {args.port}")
+        args.run(client, args)
+    except serial.SerialException as error:
+        raise SystemExit(f"Could not open {args.port}: {error}")
+    except (CommandError, ConnectionError, TimeoutError) as error:
+        raise SystemExit(str(error))
+    finally:
+        if args.metrics:
+            client.metrics.export(args.metrics)
+        client.close()
+        if weldHistory is not None:
+            weldHistory.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""Images for the GUI, loaded on first use and cached by size.
+
+The pack type pictures are drawn at a fraction of their source size. image() decodes
+and scales each (name, size) once per process, and keeps the scaled PNG in
+CACHE_DIR so later starts read a small file instead of decoding and resampling the
+original; a cached file is rebuilt when the source is newer. Paths are relative to
+this package, not the working directory, so the GUI starts from anywhere.
+"""
+import functools
+import os
+
+ASSETS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "assets")
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cnc-spot-welder", "cache", "assets")
+# Pixels kept per displayed pixel, so display scaling up to 200% stays sharp
+OVERSAMPLE = 2
+
+
+def assetPath(name):
+    return os.path.join(ASSETS_DIR, name + ".png")
+
+
+# PIL image of the asset scaled to size (width, height in pixels)
+@functools.lru_cache(maxsize=None)
+def scaled(name, size):
+    from PIL import Image
+    size = (round(size[0]), round(size[1]))
+    source = assetPath(name)
+    cached = os.path.join(CACHE_DIR, f"{name}-{size[0]}x{size[1]}.png")
+    try:
+        if os.path.getmtime(cached) >= os.path.getmtime(source):
+            with Image.open(cached) as image:
+                image.load()
+                return image
+    except OSError:
+        pass
+    with Image.open(source) as image:
+        # Never scaled up, the display scales a small source itself
+        if size[0] >= image.width and size[1] >= image.height:
+            result = image.copy()
+        else:
+            result = image.resize(size, Image.LANCZOS)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        result.save(cached)
+    except OSError:
+        pass  # Only the next start gets slower
+    return result
+
+
+# CTkImage of the asset shown at size, shared by every widget that asks for the same size
+@functools.lru_cache(maxsize=None)
+def image(name, size):
+    import customtkinter as ctk
+    return ctk.CTkImage(scaled(name, (size[0] * OVERSAMPLE, size[1] * OVERSAMPLE)), size=size)
@@ -0,0 +1,297 @@
+"""Alignment calibration against reference cells measured on the machine.
+
+The firmware's pattern and a layout's weld points assume the pack sits exactly where
+X_ZERO/Y_ZERO and the nominal pitches put it. A fixture that has drifted, or a pack
+that sits skewed, is corrected here instead of by re-jogging and re-aligning every
+pack: the head is jogged onto three or more reference weld points with the usual
+xMove/yMove controls, the positions are read back with status, and fitAffine() finds
+the least-squares affine map (offset, rotation, scale and shear) from the nominal
+points to the measured ones. The map is saved per layout in CALIBRATION_PATH and
+calibratedLayout() applies it to the layout's table of weld points, so moveToCell,
+weldAt and blended moves all go to the corrected positions.
+
+    python -m welder.calibration --port /dev/ttyUSB0 --layout A measure
+    python -m welder.calibration --layout A show
+    python -m welder.calibration --layout A clear
+
+With four or more reference cells the fit is over-determined, and the residuals show
+how well the pack matches its layout. Z is not calibrated.
+"""
+import argparse
+import json
+import math
+import os
+import time
+
+import serial
+
+from . import firmware as fw
+from .geometry import DEFAULT_LAYOUT, layout
+
+CALIBRATION_PATH = os.path.join(os.path.expanduser("~"), ".cnc-spot-welder", "calibration.json")
+# Reference points closer to a line than this, relative to their spread, can't fix a rotation
+MIN_SPREAD = 1e-6
+
+
+# Weld points measured by default: the first and last cell of the first and last row
+def defaultReferences(geometry):
+    last = geometry.sides - 1
+    return [(0, 0, 0), (0, geometry.cells - 1, last),
+            (geometry.rows - 1, 0, 0), (geometry.rows - 1, geometry.cells - 1, last)]
+
+
+########################################################################
+# Fitting
+# Solve the 3x3 system matrix * v = rhs by Gaussian elimination with partial pivoting
+def _solve(matrix, rhs):
+    rows = [list(row) + [value] for row, value in zip(matrix, rhs)]
+    for column in range(3):
+        pivot = max(range(column, 3), key=lambda row: abs(rows[row][column]))
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+        for row in range(column + 1, 3):
+            factor = rows[row][column] / rows[column][column]
+            rows[row] = [value - factor * top for value, top in zip(rows[row], rows[column])]
+    solution = [0.0] * 3
+    for row in range(2, -1, -1):
+        solution[row] = (rows[row][3] - sum(rows[row][k] * solution[k] for k in range(row + 1, 3))) / rows[row][row]
+    return solution
+
+
+# Least-squares (a, b, c, d, e, f) with measured ~ (a x + b y + c, d x + e y + f) for
+# every nominal (x, y). Needs three or more points that are not in a line.
+def fitAffine(nominal, measured):
+    if len(nominal) != len(measured):
+        raise ValueError("Every reference point needs a measurement")
+    if len(nominal) < 3:
+        raise ValueError("Calibration needs at least three reference points")
+    # Centred on the nominal mean, which keeps the normal equations well conditioned
+    meanX = sum(x for x, y in nominal) / len(nominal)
+    meanY = sum(y for x, y in nominal) / len(nominal)
+    centred = [(x - meanX, y - meanY) for x, y in nominal]
+    sxx = sum(x * x for x, y in centred)
+    syy = sum(y * y for x, y in centred)
+    sxy = sum(x * y for x, y in centred)
+    if sxx * syy - sxy * sxy <= MIN_SPREAD * (sxx + syy) ** 2:
+        raise ValueError("Reference points must not lie in a line")
+    matrix = ((sxx, sxy, 0.0), (sxy, syy, 0.0), (0.0, 0.0, float(len(nominal))))
+    coefficients = []
+    for axis in range(2):
+        values = [point[axis] for point in measured]
+        rhs = (sum(x * value for (x, y), value in zip(centred, values)),
+               sum(y * value for (x, y), value in zip(centred, values)),
+               sum(values))
+        a, b, c = _solve(matrix, rhs)
+        coefficients += [a, b, c - a * meanX - b * meanY]
+    return tuple(coefficients)
+
+
+def apply(transform, x, y):
+    a, b, c, d, e, f = transform
+    return a * x + b * y + c, d * x + e * y + f
+
+
+# Distance from each measured point to where transform puts its nominal point
+def residuals(transform, nominal, measured):
+    return [math.hypot(mx - x, my - y) for (x, y), (mx, my) in
+            ((apply(transform, *point), actual) for point, actual in zip(nominal, measured))]
+
+
+# (offset x, offset y, rotation in degrees, scale x, scale y) of transform, in firmware
+# units; the offset is the shift at the nominal origin
+def describe(transform, origin=(0.0, 0.0)):
+    a, b, c, d, e, f = transform
+    x, y = apply(transform, *origin)
+    return x - origin[0], y - origin[1], math.degrees(math.atan2(d, a)), math.hypot(a, d), math.hypot(b, e)
+
+
+########################################################################
+# Saved calibrations, by layout name
+def loadCalibrations(path=CALIBRATION_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+
+def saveCalibrations(calibrations, path=CALIBRATION_PATH):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temporary = path + ".tmp"
+    with open(temporary, "w") as file:
+        json.dump(calibrations, file, indent=2)
+    os.replace(temporary, path)
+
+
+# Save transform for layoutName with the points it was fitted to
+def saveCalibration(layoutName, transform, references, measured, path=CALIBRATION_PATH):
+    calibrations = loadCalibrations(path)
+    calibrations[layoutName] = {"transform": list(transform), "time": time.time(),
+                                "points": [list(cell) + list(point) for cell, point in zip(references, measured)]}
+    saveCalibrations(calibrations, path)
+
+
+def clearCalibration(layoutName, path=CALIBRATION_PATH):
+    calibrations = loadCalibrations(path)
+    if calibrations.pop(layoutName, None) is not None:
+        saveCalibrations(calibrations, path)
+
+
+# The layout with its saved calibration applied, or as it is when it has none
+def calibratedLayout(name=DEFAULT_LAYOUT, path=CALIBRATION_PATH):
+    geometry = layout(name)
+    try:
+        calibration = loadCalibrations(path).get(name)
+    except (OSError, ValueError):
+        calibration = None
+    if calibration is None:
+        return geometry
+    return geometry.calibrated(calibration["transform"])
+
+
+########################################################################
+# Measuring
+class CalibrationRun:
+    # Measures references (row, cell, side) of client's layout one after the other
+    def __init__(self, client, references=None):
+        self.client = client
+        self.nominal = layout(client.geometry.name)
+        self.references = references or defaultReferences(self.nominal)
+        for cell in self.references:
+            if not self.nominal.contains(*cell):
+                raise ValueError(f"No cell {cell[0]}_{cell[1]}_{cell[2]} in layout {self.nominal.name}")
+        self.measured = []
+
+    @property
+    def current(self):
+        return self.references[len(self.measured)] if not self.done else None
+
+    @property
+    def done(self):
+        return len(self.measured) == len(self.references)
+
+    # Move the head to where the layout, as calibrated so far, puts the current reference
+    def moveToCurrent(self):
+        return self.client.moveToCell(*self.current)
+
+    # Record the head's position from the client's last status answer as the current
+    # reference. Returns False while an axis is still moving.
+    def record(self):
+        client = self.client
+        if client.position is None or client.running is None or any(client.running[:2]):
+            return False
+        self.measured.append((fw.positionUnits(client.position[0], fw.X_MULTIPLIER),
+                              fw.positionUnits(client.position[1], fw.Y_MULTIPLIER)))
+        return True
+
+    def nominalPoints(self):
+        return [self.nominal.point(*cell) for cell in self.references]
+
+    def fit(self):
+        return fitAffine(self.nominalPoints(), self.measured)
+
+    # Fit, save and switch the client to the calibrated layout; returns the transform
+    def apply(self, path=CALIBRATION_PATH):
+        transform = self.fit()
+        saveCalibration(self.nominal.name, transform, self.references, self.measured, path)
+        self.client.setGeometry(self.nominal.calibrated(transform), self.client.journal)
+        return transform
+
+    def summary(self, transform):
+        x, y, rotation, scaleX, scaleY = describe(transform, self.nominal.point(0, 0, 0))
+        errors = residuals(transform, self.nominalPoints(), self.measured)
+        return (f"offset {x:+.1f}, {y:+.1f}, rotation {rotation:+.3f} deg, scale {scaleX:.4f} x {scaleY:.4f}, "
+                f"largest residual {max(errors):.2f}")
+
+
+########################################################################
+# Command line
+def showCalibration(args):
+    calibration = loadCalibrations(args.file).get(args.layout)
+    if calibration is None:
+        print(f"Layout {args.layout} is not calibrated")
+        return
+    geometry = layout(args.layout)
+    transform = tuple(calibration["transform"])
+    x, y, rotation, scaleX, scaleY = describe(transform, geometry.point(0, 0, 0))
+    print(f"Layout {args.layout}, calibrated {time.strftime('%Y-%m-%d %H:%M', time.localtime(calibration['time']))}")
+    print(f"offset {x:+.1f}, {y:+.1f}, rotation {rotation:+.3f} deg, scale {scaleX:.4f} x {scaleY:.4f}")
+    for row, cell, side, mx, my in calibration["points"]:
+        px, py = apply(transform, *geometry.point(row, cell, side))
+        print(f"{row}_{cell}_{side}: measured {mx:.1f}, {my:.1f}, fitted {px:.1f}, {py:.1f}")
+
+
+# Jog the head with "x 5", "y -2" (xMove/yMove units), Enter records the point
+def jogTo(client, run):
+    while True:
+        text = input(f"Reference {run.current[0]}_{run.current[1]}_{run.current[2]} "
+                     f"({len(run.measured) + 1}/{len(run.references)}): x/y distance to jog, Enter to record, q to stop: ").strip()
+        if text == "q":
+            return False
+        if text:
+            axis, _, distance = text.partition(" ")
+            try:
+                float(distance)
+            except ValueError:
+                distance = None
+            if axis not in ("x", "y") or distance is None:
+                print("Jog with x or y and a distance, e.g. y -2.5")
+                continue
+            client.wait(client.move(axis, distance))
+            continue
+        client.wait(client.queryAxes(), 2)
+        # The answer is an event of its own, handled after the reply that resolved the future
+        client.poll()
+        if run.record():
+            return True
+        print("The head is still moving")
+
+
+def measure(args):
+    from .client import WelderClient
+    client = WelderClient(echo=args.echo, baud=args.baud, binary=not args.text,
+                          geometry=calibratedLayout(args.layout, args.file))
+    try:
+        client.connect(args.port)
+        if not client.waitReady():
+            raise SystemExit(f"No answer from the welder on {args.port}")
+        references = [tuple(int(value) for value in cell.split("_")) for cell in args.cells] or None
+        run = CalibrationRun(client, references)
+        while not run.done:
+            client.wait(run.moveToCurrent())
+            if not jogTo(client, run):
+                raise SystemExit("Stopped, nothing saved")
+        transform = run.apply(args.file)
+        print(f"Saved for layout {args.layout}: {run.summary(transform)}")
+    except EOFError:
+        raise SystemExit("Stopped, nothing saved")
+    except serial.SerialException as error:
+        raise SystemExit(f"Could not open {args.port}: {error}")
+    finally:
+        client.close()
+
+
+def main():
+    from .commands import CommandError
+    parser = argparse.ArgumentParser(prog="python -m welder.calibration", description="Calibrate a layout's weld points against measured reference cells.")
+    parser.add_argument("--layout", default=DEFAULT_LAYOUT, help="pack layout from layouts.json")
+    parser.add_argument("--file", default=CALIBRATION_PATH, help="calibrations, by layout")
+    commands = parser.add_subparsers(dest="command", required=True)
+    command = commands.add_parser("measure", help="jog to reference cells and fit the correction")
+    command.add_argument("--port", required=True, help="serial port of the welder")
+    command.add_argument("--baud", type=int, default=fw.BAUD)
+    command.add_argument("--text", action="store_true", help="stay on the text protocol instead of switching to frames")
+    command.add_argument("--echo", action="store_true", help="print every line from the firmware")
+    command.add_argument("cells", nargs="*", metavar="ROW_CELL_SIDE", help="reference weld points, by default the four corners")
+    command.set_defaults(run=measure)
+    commands.add_parser("show", help="print the saved calibration").set_defaults(run=showCalibration)
+    commands.add_parser("clear", help="go back to the nominal layout").set_defaults(
+        run=lambda args: clearCalibration(args.layout, args.file))
+    args = parser.parse_args()
+
+    try:
+        args.run(args)
+    except (ValueError, OSError, CommandError, ConnectionError, TimeoutError) as error:
+        raise SystemExit(str(error))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,706 @@
+"""Headless client for the CNC Spot Welder.
+
+WelderClient owns the serial port, the reader thread, the command queue, the weld
+mask and the job state, so the welder can be driven from scripts and line
+controllers without a display. The GUI is a thin layer on top of it.
+
+Events are handled on whichever thread calls poll(): the GUI calls it from
+root.after(), scripts call wait()/waitFinished(), which poll while they wait. After
+the client has updated its state each event is passed to the listeners, together
+with the client's own events:
+
+- "ready" once the firmware answers after connecting (and the link has switched to
+  the framed protocol, or stayed in text), also after reconnecting
+- "welded" (row, cell, side) for every cell newly marked welded, from progress lines
+  or from syncing with the firmware's mask
+- "reset" when the weld mask is cleared
+- "layout" after setGeometry() or loadPack()
+- "finished" when a streamed weld order completes
+- "failed" (reason,) when the firmware rejects a weld of a streamed order. The job
+  stops there, failure keeps the reason and the cells left can be resumed.
+- "lost" when the port fails or the firmware's heartbeat stops; with autoConnect set
+  the client then reopens the port until the firmware answers again
+- "job" ("start", layout, mode, pack name) when runPack() starts a job, and
+  ("pause",), ("resume",) or ("stop",) when the job is paused, resumed or stopped
+"""
+import functools
+import queue
+import time
+
+import serial
+
+from . import firmware as fw
+from .commands import CommandQueue, encodeLine
+from .geometry import layout
+from .metrics import Metrics
+from .protocol import BINARY_BAUD, LINK_TIMEOUT, FrameDecoder, FrameEncoder
+from .reader import Event, SerialReader
+from .recording import Recorder, RecordingSerial, sessionPath
+from .weldmask import WeldMask
+
+# Seconds between pings while waiting for the Nano to boot after the port opens
+PING_INTERVAL = 0.25
+# Seconds to wait for the firmware to answer after connecting
+READY_TIMEOUT = 5.0
+# Seconds to wait for the firmware to answer a framed ping after agreeing to switch
+LINK_CONFIRM_TIMEOUT = 1.0
+# Seconds between heartbeat pings on the framed link, well inside LINK_TIMEOUT
+HEARTBEAT_INTERVAL = 0.5
+# The firmware's heartbeat: a pong every BEAT_INTERVAL ms, even mid-job. Once it has
+# agreed, a link without a pong for BEAT_TIMEOUT seconds is lost.
+BEAT_INTERVAL = 100
+BEAT_TIMEOUT = 0.5
+# Seconds between attempts to reopen the port after the link was lost
+RECONNECT_INTERVAL = 0.5
+
+# Seconds between status queries for the axis readout while an axis moves, and otherwise
+AXES_FAST_INTERVAL = 0.2
+AXES_SLOW_INTERVAL = 1.0
+
+# Status shown for each status event
+STATUS_TEXT = {
+    "progress": "Running",
+    "paused": "Paused",
+    "estop": "Emergency Stop",
+    "idle": "Idle",
+    "moving": "Moving",
+}
+
+
+# Command asking the firmware to switch to the framed protocol at BINARY_BAUD
+BINARY_COMMAND = f"binary {BINARY_BAUD}"
+
+
+# Follow the firmware onto the framed protocol after "ok binary": ser switches to
+# BINARY_BAUD. Returns the frame decoder for the reader and the encode function for
+# the commands written from now on.
+def framedLink(ser):
+    encoder = FrameEncoder()
+    ser.baudrate = BINARY_BAUD
+    return FrameDecoder(encoder), encoder.encode
+
+
+# Back to text lines at baud, e.g. when the framed link wasn't confirmed. Returns the
+# encode function.
+def textLink(ser, baud):
+    ser.baudrate = baud
+    return encodeLine
+
+
+# Merge the firmware's weld mask with ours after connecting. Welds are never undone
+# outside resetWelds, so the union is right whichever side missed progress (the
+# client restarted, or the Nano reset when the port was opened). Records the union in
+# journal and returns it, the cells it adds to welds, and the setWelds command the
+# firmware needs, None if it has every weld already.
+def mergeWelds(welds, firmwareWelds, journal=None):
+    merged = welds | firmwareWelds
+    changed = merged.diff(welds)
+    if changed and journal is not None:
+        journal.setMask(merged)
+    command = "setWelds " + merged.toHex() if merged != firmwareWelds else None
+    return merged, changed, command
+
+
+class WelderClient:
+    # geometry is the pack layout (geometry.PackGeometry), the journal's mask must have its shape.
+    # With record set to a directory, every connection is recorded to a session file there.
+    # profile (fw.Profile, e.g. tuning.loadProfile()) is sent on every connect.
+    def __init__(self, journal=None, echo=False, baud=fw.BAUD, binary=True, geometry=None, record=None, profile=None):
+        self.ser = RecordingSerial(baudrate=baud) if record is not None else serial.Serial(baudrate=baud)
+        self.record = record
+        self.baud = baud
+        self.binary = binary
+        self.echo = echo
+        self.geometry = geometry or layout()
+        self.profile = profile
+        self.journal = journal
+        self.welds = journal.mask.copy() if journal is not None else WeldMask(*self.geometry.shape)
+        self.events = queue.Queue()
+        self.metrics = Metrics()
+        self.listeners = []
+        self.reader = None
+        self.commands = None
+        self.planRunner = None
+        # estimate.JobEstimate of the running or last job
+        self.estimate = None
+        self.ready = False
+        self.synced = False
+        self.finished = True
+        self.paused = False
+        # Why the last job failed, None unless it did
+        self.failure = None
+        self.status = "Disconnected"
+        # Last axis positions in steps, reported with idle/moving on the framed link and
+        # with the targets and running flags (x, y, z) in answer to status
+        self.position = None
+        self.target = None
+        self.running = None
+        # Query status for the axis readout between jobs, see _pollAxes()
+        self.trackAxes = False
+        self._axesQuery = None
+        self._axesSent = 0.0
+        self.framed = False
+        self._nextPing = None
+        self._tryBinary = False
+        self._linkDeadline = None
+        self._switchedAt = None
+        # Port last connected to. With autoConnect, a lost link is reopened every
+        # RECONNECT_INTERVAL, and a port found by ports.PortMonitor is connected to.
+        self.port = None
+        self.autoConnect = False
+        self._reconnectAt = None
+        self._connectedAt = None
+        # Lines from the firmware that looked like progress but didn't parse
+        self.malformed = 0
+        # Handlers for the event kinds the client acts on, by kind
+        self._handlers = {
+            "pong": self._onPong,
+            "err": self._onErr,
+            "gap": self._onGap,
+            "position": self._onPosition,
+            "axes": self._onAxes,
+            "finished": self._onFinished,
+            "progress": self._onProgress,
+            "welds": self._onWelds,
+            "malformed": self._onMalformed,
+            "lost": self._onLost,
+            "found": self._onFound,
+        }
+
+    ########################################################################
+    # Connection
+    def isConnected(self):
+        return self.ser.is_open
+
+    # Open port, raises serial.SerialException if it can't be opened. The firmware may
+    # still be booting; "ready" is posted once it answers.
+    def connect(self, port):
+        self.ser.port = port
+        self.ser.open()
+        self.port = port
+        self._connectedAt = time.monotonic()
+        if self.record is not None:
+            self.ser.recorder = Recorder(sessionPath(port, self.record))
+        self.commands = CommandQueue(self.ser, metrics=self.metrics)
+        self.reader = SerialReader(self.ser, self.events, echo=self.echo,
+                                   listeners=[self._switchLink, self.commands.handleEvent, self.metrics.handleEvent])
+        self.reader.start()
+        self.ready = False
+        self.synced = False
+        self.framed = False
+        self.position = None
+        self.target = None
+        self.running = None
+        self._axesQuery = None
+        self._axesSent = 0.0
+        self._tryBinary = self.binary
+        self._linkDeadline = None
+        self._switchedAt = None
+        self.status = "Connecting"
+        self._nextPing = time.monotonic()
+        self._ping()
+
+    def disconnect(self, status="Disconnected"):
+        if self.reader is not None:
+            self.reader.stop()
+            self.reader = None
+        if self.commands is not None:
+            self.commands.close()
+            self.commands = None
+        if self.ser.is_open:
+            self.ser.close()
+        if self.record is not None and self.ser.recorder is not None:
+            self.ser.recorder.close()
+            self.ser.recorder = None
+        self.ser.baudrate = self.baud
+        self.framed = False
+        self._linkDeadline = None
+        self.planRunner = None
+        self.ready = False
+        self.finished = True
+        self.paused = False
+        self.status = status
+        self._nextPing = None
+        self._reconnectAt = None
+
+    def close(self):
+        self.disconnect()
+        if self.journal is not None:
+            self.journal.close()
+
+    def _ping(self):
+        self._reconnect()
+        if self._nextPing is not None and time.monotonic() >= self._nextPing:
+            self.sendUrgent("ping")
+            self._nextPing = time.monotonic() + PING_INTERVAL
+        if self._linkDeadline is not None and time.monotonic() >= self._linkDeadline:
+            self._fallBack("Framed link failed")
+
+    # Ask the firmware to switch to the framed protocol at BINARY_BAUD. Old firmware
+    # answers "err binary" and the link stays in text.
+    def _negotiate(self):
+        self._linkDeadline = time.monotonic() + LINK_CONFIRM_TIMEOUT
+        self.commands.send(BINARY_COMMAND)
+
+    # Reader listener: the firmware switches right after "ok binary", so the port,
+    # the decoder and the encoder must follow before the next byte is handled
+    def _switchLink(self, event):
+        if event.kind == "ok" and event.args[0] == "binary" and self.reader.frames is None:
+            decoder, encode = framedLink(self.ser)
+            self.reader.useFrames(decoder)
+            self.commands.setEncoder(encode)
+            self._switchedAt = event.time
+            # Confirmed by the pong
+            self.commands.sendUrgent("ping")
+
+    # Go back to text and wait for the firmware to do the same, then carry on in text
+    def _fallBack(self, reason):
+        print(f"{reason}, using text")
+        self._linkDeadline = None
+        self._tryBinary = False
+        self.framed = False
+        self.ready = False
+        self.status = "Connecting"
+        self.commands.setHeartbeat(None)
+        self.commands.abandon("binary", ConnectionError(reason))
+        self.reader.useLines()
+        self.commands.setEncoder(textLink(self.ser, self.baud))
+        self._nextPing = time.monotonic() + LINK_TIMEOUT / 1000
+
+    # With trackAxes set, query status every AXES_FAST_INTERVAL while an axis moves or
+    # a command is outstanding, and every AXES_SLOW_INTERVAL otherwise. Only between
+    # jobs, when the firmware answers at once, and one query at a time. Firmware
+    # without status rejects it and isn't asked again.
+    def _pollAxes(self):
+        if not self.trackAxes or not self.ready or not self.finished or self.commands is None:
+            return
+        if self._axesQuery is not None and not self._axesQuery.done():
+            return
+        moving = self.commands.pending() > 0 or (self.running is not None and any(self.running))
+        now = time.monotonic()
+        if now < self._axesSent + (AXES_FAST_INTERVAL if moving else AXES_SLOW_INTERVAL):
+            return
+        self._axesSent = now
+        self._axesQuery = self.queryAxes()
+
+    def _linkUp(self):
+        self.ready = True
+        self.status = "Connected"
+        self._reconnectAt = None
+        if self.framed:
+            self.commands.setHeartbeat(HEARTBEAT_INTERVAL)
+        # Older firmware rejects heartbeat and its link is only watched for port errors
+        self.send(f"heartbeat {BEAT_INTERVAL}").add_done_callback(self._watchHeartbeat)
+        # The firmware may have been reset since the last connection: the pack shape,
+        # type, motion profile and weld mask go out again
+        self.send(self._packShapeCommand())
+        if self.geometry.packType is not None:
+            self.setPackType(self.geometry.packType)
+        if self.profile is not None:
+            self.setProfile(self.profile)
+        self.send("getWelds")
+        self._notify("ready")
+
+    # On the reader thread, when the firmware answers heartbeat
+    def _watchHeartbeat(self, future):
+        reader = self.reader
+        if reader is not None and not future.cancelled() and future.exception() is None:
+            reader.lastPong = time.monotonic()
+            reader.silence = BEAT_TIMEOUT
+
+    # With autoConnect, after a lost link reopen the port every RECONNECT_INTERVAL until
+    # the firmware answers; a port that opens but stays silent for READY_TIMEOUT is
+    # closed and tried again
+    def _reconnect(self):
+        if self._reconnectAt is None or time.monotonic() < self._reconnectAt:
+            return
+        if self.isConnected():
+            if time.monotonic() < self._connectedAt + READY_TIMEOUT:
+                return
+            self.disconnect("Reconnecting")
+        self._retry(self.port)
+
+    def _retry(self, port):
+        self.status = "Reconnecting"
+        self._reconnectAt = time.monotonic() + RECONNECT_INTERVAL
+        try:
+            self.connect(port)
+        except serial.SerialException:
+            pass
+
+    ########################################################################
+    # Commands, each returns the Future from CommandQueue.send or None when not connected
+    def send(self, command):
+        if self.commands is None:
+            return None
+        if self.journal is not None:
+            self.journal.command(command)
+        return self.commands.send(command)
+
+    # Write a job control word (pause, continue, stop, ping) ahead of queued commands
+    def sendUrgent(self, command):
+        if self.commands is None:
+            return
+        if self.journal is not None:
+            self.journal.command(command)
+        self.commands.sendUrgent(command)
+
+    # Ask for every axis's position, target and running flag in one message; the
+    # answer updates position, target and running
+    def queryAxes(self):
+        if self.commands is None:
+            return None
+        # Polled, so not journaled
+        return self.commands.send("status")
+
+    # Hold-to-jog (jog.py): run axis towards the sign of direction until jogStop, or
+    # until the firmware's JOG_TIMEOUT passes without another jog. Renewed several times
+    # a second while a key is held, so neither is journaled.
+    def jog(self, axis, direction):
+        if self.commands is None:
+            return None
+        return self.commands.send(f"{axis}Jog {direction}")
+
+    # Resolves once the axis stands
+    def jogStop(self, axis):
+        if self.commands is None:
+            return None
+        return self.commands.send(f"{axis}JogStop")
+
+    # Home one axis ("x", "y" or "z"), or all of them
+    def home(self, axis=None):
+        return self.send(f"{axis}Home" if axis else "homeAll")
+
+    # The firmware aligns to its nominal first cell; a calibrated layout moves to its own
+    def align(self):
+        if self.geometry.transform is not None:
+            return self.moveToCell(0, 0, 0)
+        return self.send("align")
+
+    def setPackType(self, packType):
+        return self.send(f"packType {packType}")
+
+    # Set the axis speeds, accelerations and weld timing to profile (fw.Profile), or
+    # back to the firmware's defaults with None. Returns the last command's future.
+    def setProfile(self, profile):
+        self.profile = profile
+        future = None
+        for command in fw.profileCommands(profile or fw.DEFAULT_PROFILE):
+            future = self.send(command)
+        return future
+
+    # Switch pack layout. A layout of another shape has a weld mask of its own, kept in
+    # journal when given (see journal.shapePath). Returns the packType future for layouts
+    # the firmware has a pattern for.
+    def setGeometry(self, geometry, journal=None):
+        if geometry.shape != self.geometry.shape:
+            if self.journal is not None:
+                self.journal.close()
+            self.journal = journal
+            self.welds = journal.mask.copy() if journal is not None else WeldMask(*geometry.shape)
+            self.geometry = geometry
+            if self.ready:
+                # The firmware clears its mask when the shape changes
+                self.send(self._packShapeCommand())
+                if self.welds.count():
+                    self.send("setWelds " + self.welds.toHex())
+        self.geometry = geometry
+        self._notify("layout")
+        if geometry.packType is not None:
+            return self.setPackType(geometry.packType)
+        return None
+
+    # Switch to another pack in the jig: its layout and its own journal, whose mask
+    # replaces ours and the firmware's. Returns the packType future like setGeometry.
+    def loadPack(self, geometry, journal):
+        if self.journal is not None and self.journal is not journal:
+            self.journal.close()
+        shapeChanged = geometry.shape != self.geometry.shape
+        self.journal = journal
+        self.welds = journal.mask.copy()
+        self.geometry = geometry
+        if self.ready:
+            if shapeChanged:
+                self.send(self._packShapeCommand())
+            self.send("setWelds " + self.welds.toHex())
+        self._notify("layout")
+        if geometry.packType is not None:
+            return self.setPackType(geometry.packType)
+        return None
+
+    def _packShapeCommand(self):
+        return f"packShape {self.geometry.rows}_{self.geometry.cells}"
+
+    def move(self, axis, steps):
+        return self.send(f"{axis}Move {steps}")
+
+    def setStepSize(self, axis, steps):
+        return self.send(f"{axis}SetStepSize {steps}")
+
+    # Move to a weld point of the layout, zWeld then records it as that cell
+    def moveToCell(self, row, cell, side):
+        x, y = self.geometry.point(row, cell, side)
+        return self.send(f"moveToPoint {x:.2f}_{y:.2f}_{row}_{cell}_{side}")
+
+    # Weld at the current position
+    def stepCycle(self):
+        return self.send("zStepCycle")
+
+    # Weld at the current position and record it as (row, cell, side)
+    def zWeld(self, row, cell, side):
+        return self.send(f"zWeld {row}_{cell}_{side}")
+
+    # Move to a cell and weld it, with the firmware's pack type pattern
+    def weldCell(self, row, cell, side):
+        return self.send(f"weldCell {row}_{cell}_{side}")
+
+    # Move to a cell's position in the layout and weld it
+    def weldAt(self, row, cell, side):
+        from . import planner
+        return self.send(planner.weldAtCommand(self.geometry, row, cell, side))
+
+    def resetWelds(self):
+        future = self.send("resetWelds")
+        self.welds.clear()
+        if self.journal is not None:
+            self.journal.reset()
+        self._notify("reset")
+        return future
+
+    ########################################################################
+    # Jobs
+    # Cells still to weld, or the given cells whether welded or not (a re-weld), in
+    # travel-optimised order
+    def planRemaining(self, cells=None):
+        from . import planner
+        return planner.planOrder(self.welds.unwelded() if cells is None else cells, geometry=self.geometry,
+                                 profile=self.profile)
+
+    # The order a job streams. runPack only knows the nominal positions, so a
+    # calibrated layout streams its pattern as weldAt commands instead.
+    def _jobOrder(self, order):
+        from . import planner
+        if order is None and self.geometry.transform is not None:
+            return planner.patternOrder(self.welds.unwelded())
+        return order
+
+    # Predicted estimate.JobEstimate for runPack, or for streaming order
+    def estimateJob(self, order=None, blend=False):
+        from . import estimate
+        return estimate.jobEstimate(self.welds, self.geometry, self._jobOrder(order), blend, self.profile)
+
+    # Run runPack, or stream order as weldAt commands when given, or as blended moves
+    # (motion.py) with blend. Returns False if a job is already running. The ETA follows
+    # jobEstimate, made here when not given. name names the pack in the history.
+    def runPack(self, order=None, jobEstimate=None, blend=False, name=None):
+        from . import motion, planner
+        if not self.finished:
+            return False
+        # A calibrated layout's pattern is streamed, but still welded row by row
+        mode = "pattern" if order is None else "blend" if blend else "optimize"
+        order = self._jobOrder(order)
+        self.finished = False
+        self.paused = False
+        self.failure = None
+        self.estimate = jobEstimate or self.estimateJob(order, blend)
+        self.estimate.start()
+        self.metrics.startJob(mode)
+        if self.record is not None and self.ser.recorder is not None:
+            # Replay hands the mode to its metrics from here
+            self.ser.recorder.mark(f"job {mode}")
+        self._notify("job", ("start", self.geometry.name, mode, name))
+        if order is not None and blend:
+            # One weld queued ahead, so the next X/Y move starts as soon as Z is clear
+            self.planRunner = planner.PlanRunner(self.send, order, motion.blendedCommand(self.geometry, order, profile=self.profile), lookahead=1)
+            self.planRunner.start()
+        elif order is not None:
+            self.planRunner = planner.PlanRunner(self.send, order, functools.partial(planner.weldAtCommand, self.geometry))
+            self.planRunner.start()
+        else:
+            self.send("runPack")
+        return True
+
+    def pause(self):
+        self.paused = True
+        if self.estimate is not None:
+            self.estimate.pause()
+        if self.planRunner is not None:
+            self.planRunner.pause()
+        self.sendUrgent("pause")
+        self._notify("job", ("pause",))
+
+    def resume(self):
+        self.paused = False
+        if self.estimate is not None:
+            self.estimate.resume()
+        self.sendUrgent("continue")
+        if self.planRunner is not None:
+            self.planRunner.resume()
+        self._notify("job", ("resume",))
+
+    def stop(self):
+        self.finished = True
+        self.paused = False
+        if self.planRunner is not None:
+            self.planRunner.stop()
+            self.planRunner = None
+        self.sendUrgent("stop")
+        self._notify("job", ("stop",))
+
+    ########################################################################
+    # Events
+    # Handle pending events on this thread, waiting up to timeout for the first one
+    def poll(self, timeout=0):
+        self._ping()
+        self._pollAxes()
+        try:
+            event = self.events.get(timeout=timeout) if timeout else self.events.get_nowait()
+        except queue.Empty:
+            return 0
+        count = 0
+        while True:
+            self.handleEvent(event)
+            count += 1
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                return count
+
+    # Poll until future resolves, returns its result or raises its exception
+    def wait(self, future, timeout=None):
+        if future is None:
+            raise ConnectionError("Not connected")
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not future.done():
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError("No reply from the welder")
+            self.poll(0.05)
+        return future.result()
+
+    # Poll until condition() is true, returns False on timeout
+    def waitFor(self, condition, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not condition():
+            # A client that is reconnecting is still worth waiting for
+            connected = self.isConnected() or self._reconnectAt is not None
+            if not connected or (deadline is not None and time.monotonic() >= deadline):
+                return False
+            self.poll(0.05)
+        return True
+
+    def waitReady(self, timeout=READY_TIMEOUT):
+        return self.waitFor(lambda: self.ready and self.synced, timeout)
+
+    def waitFinished(self, timeout=None):
+        return self.waitFor(lambda: self.finished, timeout)
+
+    def handleEvent(self, event):
+        if event.kind == "progress" and not self.geometry.contains(*event.args):
+            # A weld outside the pack is a corrupt line, not progress
+            event = event._replace(kind="malformed")
+        if self.planRunner is not None and self.planRunner.handleEvent(event):
+            runner, self.planRunner = self.planRunner, None
+            self.finished = True
+            if runner.error is None:
+                self._notify("finished")
+            else:
+                self._fail(runner.error)
+        handler = self._handlers.get(event.kind)
+        if handler is not None:
+            handler(event)
+        if event.kind in STATUS_TEXT:
+            self.status = STATUS_TEXT[event.kind]
+        for listener in self.listeners:
+            listener(event)
+
+    def _onPong(self, event):
+        # Only a pong received after the switch confirms the framed link
+        if self._linkDeadline is not None and self._switchedAt is not None and event.time > self._switchedAt:
+            self._linkDeadline = None
+            self.framed = True
+            self._linkUp()
+        elif not self.ready and self._nextPing is not None:
+            self._nextPing = None
+            if self._tryBinary:
+                self._negotiate()
+            else:
+                self._linkUp()
+
+    def _onErr(self, event):
+        if event.args[0] == "binary":
+            self._linkDeadline = None
+            self._linkUp()
+        elif event.args[0] == "status":
+            self.trackAxes = False
+
+    def _onGap(self, event):
+        # Frames were lost, progress among them may be missing
+        self.send("getWelds")
+
+    def _onPosition(self, event):
+        self.position = event.args
+
+    def _onAxes(self, event):
+        self.position, self.target, self.running = event.args
+
+    def _onFinished(self, event):
+        self.finished = True
+        self.paused = False
+        self.planRunner = None
+
+    def _onProgress(self, event):
+        if self.estimate is not None and not self.finished:
+            self.estimate.progress(event.time)
+        self.markWelded(*event.args)
+
+    def _onWelds(self, event):
+        try:
+            self.syncWelds(WeldMask.fromHex(event.args[0], *self.geometry.shape))
+        except ValueError:
+            print("Bad weld mask from firmware")
+
+    def _onMalformed(self, event):
+        self.malformed += 1
+        print(f"Ignored malformed line from firmware: {event.line}")
+
+    def _onLost(self, event):
+        self.disconnect("Lost Connection")
+        if self.autoConnect and self.port is not None:
+            self.status = "Reconnecting"
+            self._reconnectAt = time.monotonic() + RECONNECT_INTERVAL
+
+    # ports.PortMonitor found the welder on port while we were disconnected
+    def _onFound(self, event):
+        if self.autoConnect and not self.isConnected():
+            self._retry(event.args[0])
+
+    # End the running job on an error, e.g. a rejected weld. The weld queued ahead
+    # may already be with the firmware; stop keeps it from going on after that one.
+    def _fail(self, reason):
+        self.finished = True
+        self.paused = False
+        self.planRunner = None
+        self.failure = reason
+        self.sendUrgent("stop")
+        self._notify("failed", (reason,))
+
+    def _notify(self, kind, args=()):
+        event = Event(kind, args, "", time.monotonic())
+        for listener in self.listeners:
+            listener(event)
+
+    def markWelded(self, row, cell, side):
+        self.welds[row, cell, side] = 1
+        if self.journal is not None:
+            self.journal.progress(row, cell, side)
+        self._notify("welded", (row, cell, side))
+
+    # Merge the firmware's weld mask with ours after connecting, see mergeWelds()
+    def syncWelds(self, firmwareWelds):
+        merged, changed, command = mergeWelds(self.welds, firmwareWelds, self.journal)
+        if command is not None:
+            self.send(command)
+        self.welds = merged
+        self.synced = True
+        for cell in changed:
+            self._notify("welded", cell)
@@ -0,0 +1,241 @@
+"""Pipelined command queue for the welder's serial port.
+
+CommandQueue is the only thing that writes to the port. send() queues a command and
+returns a concurrent.futures.Future that resolves with the firmware's completion line:
+"ok <cmd>" for blocking commands, "done <axis>" after the "ok" for non-blocking moves.
+At most `window` commands are unacknowledged at a time, so a burst of commands can't
+overrun the Nano's 64 byte receive buffer, and commands are written in order.
+
+Job control words (pause, continue, stop) are written ahead of everything else with
+sendUrgent(); the firmware reads them between welds. Until the commands in flight
+complete, those words count against the receive buffer like the commands do, and the
+heartbeat holds off, so a long job can't fill the buffer with pings.
+
+Given a Metrics, the queue reports when each command is written and completed.
+"""
+import collections
+import concurrent.futures
+import threading
+import time
+
+from .protocol import FRAME_OVERHEAD
+
+# Commands the firmware acknowledges with "ok" and later completes with "done <axis>"
+MOTION_COMMANDS = {
+    "xMove": "x", "xMoveTo": "x", "xStepover": "x", "xStepback": "x",
+    "yMove": "y", "yMoveTo": "y", "yStepover": "y", "yStepback": "y",
+    "zMove": "z", "zMoveTo": "z", "zStepdown": "z", "zStepup": "z",
+    "xJogStop": "x", "yJogStop": "y", "zJogStop": "z",
+}
+# Unacknowledged commands allowed at once. The firmware keeps one command that arrives
+# during a job for later, so a running job plus one queued command is the safe maximum.
+WINDOW = 2
+# Receive buffer of the Arduino Nano
+RX_BUFFER = 64
+
+
+# Commands that change the link; nothing else is written until they are acknowledged
+BARRIER_COMMANDS = {"binary"}
+
+
+# Text protocol: one line per command
+def encodeLine(text):
+    return (text + "\n").encode("utf-8")
+
+
+class CommandError(Exception):
+    # The firmware rejected a command or could not complete it
+    pass
+
+
+class PendingCommand:
+    def __init__(self, text):
+        self.text = text
+        self.name = text.split(" ", 1)[0]
+        # Bytes on the wire in the framed protocol, which is never shorter than the text line
+        self.size = len(text.encode("utf-8")) + FRAME_OVERHEAD
+        self.future = concurrent.futures.Future()
+        self.sent = None
+
+
+class CommandQueue:
+    def __init__(self, ser, window=WINDOW, rxBuffer=RX_BUFFER, metrics=None):
+        self.ser = ser
+        self.window = window
+        self.rxBuffer = rxBuffer
+        self.metrics = metrics
+        self.encode = encodeLine
+        self.heartbeat = None
+        self._lastWrite = time.monotonic()
+        # Bytes of job control words written since the firmware last read everything
+        self._unread = 0
+        self._queued = collections.deque()
+        self._urgent = collections.deque()
+        self._inFlight = []
+        self._moving = {"x": [], "y": [], "z": []}
+        self._condition = threading.Condition()
+        self._closed = False
+        self._writer = threading.Thread(target=self._writeLoop, daemon=True)
+        self._writer.start()
+
+    ########################################################################
+    # Public API
+    def send(self, text):
+        command = PendingCommand(text)
+        with self._condition:
+            if self._closed:
+                command.future.set_exception(ConnectionError("Not connected"))
+                return command.future
+            self._queued.append(command)
+            self._condition.notify_all()
+        return command.future
+
+    def sendUrgent(self, text):
+        with self._condition:
+            if not self._closed:
+                self._urgent.append(text)
+                self._condition.notify_all()
+
+    # Switch the wire format of commands written from now on, e.g. FrameEncoder.encode
+    def setEncoder(self, encode):
+        with self._condition:
+            self.encode = encode
+
+    # Write a ping whenever nothing has been written for interval seconds, or never
+    # with None. The framed link needs this to stay up while the host is idle. No pings
+    # go out while a command is in flight: the firmware only reads between welds then,
+    # and restarts its link timeout when the command completes.
+    def setHeartbeat(self, interval):
+        with self._condition:
+            self.heartbeat = interval
+            self._condition.notify_all()
+
+    # Fail an in-flight command that will never be answered, e.g. a lost "ok binary"
+    def abandon(self, name, error):
+        self._acknowledge(name, None, error, time.monotonic())
+
+    def pending(self):
+        with self._condition:
+            return self._pending()
+
+    def _pending(self):
+        return len(self._queued) + len(self._inFlight) + sum(len(commands) for commands in self._moving.values())
+
+    # Fail everything queued or in flight, e.g. after an emergency stop
+    def cancelAll(self, error):
+        with self._condition:
+            commands = list(self._queued) + self._inFlight
+            for waiting in self._moving.values():
+                commands += waiting
+                waiting.clear()
+            futures = [command.future for command in commands]
+            self._queued.clear()
+            self._inFlight = []
+            self._unread = 0
+            self._condition.notify_all()
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+
+    def close(self, error=None):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self.cancelAll(error or ConnectionError("Connection closed"))
+        if self._writer is not threading.current_thread():
+            self._writer.join(1)
+
+    ########################################################################
+    # Reader side, called with every Event from the serial reader thread
+    def handleEvent(self, event):
+        if event.kind == "ok":
+            self._acknowledge(event.args[0], event.line, None, event.time)
+        elif event.kind == "err":
+            self._acknowledge(event.args[0], event.line, CommandError(f"Firmware rejected {event.args[0]}"), event.time)
+        elif event.kind == "done":
+            with self._condition:
+                commands = self._moving.get(event.args[0], [])
+                self._moving[event.args[0]] = []
+                pending = self._pending()
+            for command in commands:
+                if self.metrics is not None:
+                    self.metrics.commandCompleted(command.name, command.sent, event.time, pending, moving=True)
+                if not command.future.done():
+                    command.future.set_result(event.line)
+        elif event.kind == "estop":
+            self.cancelAll(CommandError("Emergency stop"))
+        elif event.kind == "lost":
+            self.close()
+
+    def _acknowledge(self, name, line, error, stamp):
+        with self._condition:
+            command = next((command for command in self._inFlight if command.name == name), None)
+            if command is None:
+                return  # Not ours, e.g. a job control word acknowledged outside a job
+            self._inFlight.remove(command)
+            if not self._inFlight:
+                self._unread = 0
+            axis = MOTION_COMMANDS.get(name)
+            if axis is not None and error is None:
+                self._moving[axis].append(command)
+                command = None
+            pending = self._pending()
+            self._condition.notify_all()
+        if command is not None and self.metrics is not None:
+            self.metrics.commandCompleted(name, command.sent, stamp, pending)
+        if command is not None and not command.future.done():
+            if error is None:
+                command.future.set_result(line)
+            else:
+                command.future.set_exception(error)
+
+    ########################################################################
+    # Writer thread
+    def _canSend(self):
+        if not self._queued:
+            return False
+        if not self._inFlight:
+            return True
+        if self._queued[0].name in BARRIER_COMMANDS or any(command.name in BARRIER_COMMANDS for command in self._inFlight):
+            return False
+        inFlightBytes = sum(command.size for command in self._inFlight) + self._unread
+        return len(self._inFlight) < self.window and inFlightBytes + self._queued[0].size <= self.rxBuffer
+
+    def _writeLoop(self):
+        while True:
+            with self._condition:
+                ready = self._closed or self._urgent or self._canSend()
+                if not ready and self._heartbeatWait() != 0:
+                    # Any change wakes the writer, e.g. the last command in flight completing
+                    self._condition.wait(self._heartbeatWait())
+                    continue
+                # Job control words still go out on close, so a final stop reaches the machine
+                if self._urgent:
+                    data = self.encode(self._urgent.popleft())
+                    if self._inFlight:
+                        self._unread += len(data)
+                elif not ready:
+                    data = self.encode("ping")
+                elif self._closed:
+                    return
+                else:
+                    command = self._queued.popleft()
+                    if command.future.cancelled():
+                        continue
+                    command.sent = time.monotonic()
+                    self._inFlight.append(command)
+                    data = self.encode(command.text)
+                    if self.metrics is not None:
+                        self.metrics.commandSent(command.name, command.sent)
+                self._lastWrite = time.monotonic()
+            try:
+                self.ser.write(data)
+            except Exception as error:
+                self.close(ConnectionError(str(error)))
+                return
+
+    # Seconds until the next heartbeat is due, None without one or while a command is in flight
+    def _heartbeatWait(self):
+        if self.heartbeat is None or self._inFlight:
+            return None
+        return max(0, self._lastWrite + self.heartbeat - time.monotonic())
@@ -0,0 +1,147 @@
+"""Pack time prediction and live ETA.
+
+Before a job starts, jobEstimate() runs it on the simulator, which models every move
+with the firmware's trapezoidal axis profiles (max speed, acceleration, the Y
+multiplier), the weld time and the delays, as tuned (welder/tuning.py) or the
+firmware's defaults, and notes when each R line would be sent. During the job
+JobEstimate follows the real R lines: the ratio of observed to predicted time over
+the last WINDOW welds scales the prediction for what is left, so the ETA follows a
+machine that runs slower or faster than the model.
+"""
+import array
+import math
+import time
+
+from . import firmware as fw
+from . import motion
+from . import planner
+from .simulator import WelderSimulator
+
+# Welds the correction and the weld rate are measured over
+WINDOW = 24
+# Correction factors outside this range are a stall or a burst, not a trend
+MIN_FACTOR = 0.25
+MAX_FACTOR = 4.0
+
+
+class TimingSimulator(WelderSimulator):
+    # Notes when each R line would be sent instead of sending it
+    def __init__(self):
+        super().__init__(speed=math.inf)
+        self.stamps = array.array("d")
+
+    def sendProgress(self):
+        self.stamps.append(self.now)
+
+
+# Predicted JobEstimate for welding what is left of welds: runPack's fixed pattern,
+# or order streamed as weldAt commands when given, or as blended moves with blend.
+# profile is the fw.Profile the machine runs, the firmware's defaults when None.
+def jobEstimate(welds, geometry, order=None, blend=False, profile=None):
+    packType = fw.PACK_TYPES.get(geometry.packType, fw.PT_A)
+    sim = planner.alignedSimulator(packType, geometry, TimingSimulator(), profile)
+    if order is None:
+        sim.welded[:len(welds.bits)] = welds.bits
+        sim.runPack(2, packType)
+    elif blend:
+        motion.streamBlended(sim, order, geometry, profile=profile)
+    else:
+        planner.streamOrder(sim, order, geometry)
+    return JobEstimate(sim.stamps, sim.now)
+
+
+class JobEstimate:
+    # stamps are the predicted seconds from the start of the job to each R line,
+    # total the predicted length of the whole job
+    def __init__(self, stamps, total):
+        self.stamps = stamps
+        self.total = total
+        self.observed = array.array("d")
+        self.started = None
+        self.pausedFor = 0.0
+        self.pausedAt = None
+
+    @property
+    def count(self):
+        return len(self.stamps)
+
+    @property
+    def done(self):
+        return min(len(self.observed), self.count)
+
+    def start(self, now=None):
+        self.started = time.monotonic() if now is None else now
+
+    # Time spent paused doesn't count as welding time
+    def pause(self, now=None):
+        if self.pausedAt is None:
+            self.pausedAt = time.monotonic() if now is None else now
+
+    def resume(self, now=None):
+        if self.pausedAt is not None:
+            self.pausedFor += (time.monotonic() if now is None else now) - self.pausedAt
+            self.pausedAt = None
+
+    # Seconds of welding since the start
+    def elapsed(self, now=None):
+        if self.started is None:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        paused = self.pausedFor + (now - self.pausedAt if self.pausedAt is not None else 0.0)
+        return max(0.0, now - self.started - paused)
+
+    # An R line arrived at stamp
+    def progress(self, stamp):
+        self.observed.append(self.elapsed(stamp))
+
+    ########################################################################
+    # Estimates
+    # Observed over predicted time for the last WINDOW welds
+    def factor(self):
+        done = self.done
+        if done == 0:
+            return 1.0
+        first = max(0, done - WINDOW)
+        predicted = self.stamps[done - 1] - (self.stamps[first - 1] if first else 0.0)
+        observed = self.observed[done - 1] - (self.observed[first - 1] if first else 0.0)
+        if predicted <= 0:
+            return 1.0
+        return min(MAX_FACTOR, max(MIN_FACTOR, observed / predicted))
+
+    # Seconds left until the job is done
+    def remaining(self, now=None):
+        elapsed = self.elapsed(now)
+        done = self.done
+        if done == 0:
+            return max(0.0, self.total - elapsed)
+        left = (self.total - self.stamps[done - 1]) * self.factor()
+        # Time since the last R line is already spent on the next weld
+        return max(0.0, left - (elapsed - self.observed[done - 1]))
+
+    def percent(self):
+        return 100.0 * self.done / self.count if self.count else 100.0
+
+    # Welds per minute over the last WINDOW welds, None before two welds
+    def rate(self):
+        done = self.done
+        if done < 2:
+            return None
+        first = max(0, done - WINDOW - 1)
+        seconds = self.observed[done - 1] - self.observed[first]
+        return 60.0 * (done - 1 - first) / seconds if seconds > 0 else None
+
+    # Wall clock time the job should be done
+    def finishTime(self, now=None):
+        return time.time() + self.remaining(now)
+
+    def summary(self, now=None):
+        rate = self.rate()
+        rateText = f"{rate:.1f} welds/min" if rate is not None else "- welds/min"
+        return (f"{self.percent():.0f}%, {rateText}, {formatDuration(self.remaining(now))} left "
+                f"(done at {time.strftime('%H:%M', time.localtime(self.finishTime(now)))})")
+
+
+def formatDuration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
@@ -0,0 +1,138 @@
+"""Constants and motion math mirrored from Spot_Welder/Spot_Welder.ino and Axis.h.
+
+Keep these values in sync with the firmware. Positions are in the same units the
+firmware's moveTo()/move() calls take; speeds and accelerations are in steps.
+"""
+import collections
+import math
+
+########################################################################
+# Serial link
+BAUD = 9600
+SERIAL_TIMEOUT = 1000  # ms, default timeout of Stream::readStringUntil()
+
+########################################################################
+# Timing (ms)
+WELD_TIME = 800
+SERIES_CELL_DELAY = 100  # delay(100) before and after every zWeld() in runSeries
+SERIES_PASS_DELAY = 1000  # delay(1000) after each pass of runSeries
+PACK_ROW_DELAY = 3000  # delay(3000) after each row of runPack
+STATUS_PERIOD = 1000  # idle/moving status print in loop()
+# Hold-to-jog: a jog not renewed for JOG_TIMEOUT ms stops, JOG_DISTANCE is its target
+JOG_TIMEOUT = 300
+JOG_DISTANCE = 10000
+
+########################################################################
+# Axis configuration from setup()
+X_MAX_SPEED = 1000
+X_ACCELERATION = 5000
+X_INVERTED = False
+X_MULTIPLIER = 1.0
+
+Y_MAX_SPEED = 2000
+Y_ACCELERATION = 5000
+Y_INVERTED = True
+Y_MULTIPLIER = 2.0
+
+Z_MAX_SPEED = 1000
+Z_ACCELERATION = 3000
+Z_INVERTED = True
+Z_MULTIPLIER = 1.0
+
+HOME_SPEED = 500  # Axis::home() default
+HOME_BACKOFF = 100
+
+########################################################################
+# Pack geometry
+X_ZERO = 590
+Y_ZERO = 1150
+Z_ZERO = 700
+X_STEPOVER = 25 * 25.4 / 2 * math.sqrt(3)
+Y_STEPOVER = 1016
+Z_STEPDOWN = 400
+WELD_SPACE = 1016.0 * 0.12
+
+# Default pack shape, packShape changes it
+PACK_ROWS = 16
+PACK_CELLS = 24
+PACK_SIDES = 2
+# Weld mask storage, two bits per cell; one frame's payload
+MAX_WELD_BYTES = 120
+
+PT_A = 0
+PT_B = 1
+PACK_TYPES = {"A": PT_A, "B": PT_B}
+
+########################################################################
+# Motion profile: what [xyz]SetMaxSpeed, [xyz]SetAcceleration and setTiming change.
+# A reset brings back DEFAULT_PROFILE.
+Profile = collections.namedtuple("Profile", ["xSpeed", "xAcceleration", "ySpeed", "yAcceleration", "zSpeed",
+                                             "zAcceleration", "weldTime", "cellDelay", "passDelay", "rowDelay"])
+DEFAULT_PROFILE = Profile(X_MAX_SPEED, X_ACCELERATION, Y_MAX_SPEED, Y_ACCELERATION, Z_MAX_SPEED, Z_ACCELERATION,
+                          WELD_TIME, SERIES_CELL_DELAY, SERIES_PASS_DELAY, PACK_ROW_DELAY)
+
+
+# Commands that set the firmware to profile
+def profileCommands(profile):
+    commands = []
+    for axis in "xyz":
+        commands.append(f"{axis}SetMaxSpeed {getattr(profile, axis + 'Speed'):g}")
+        commands.append(f"{axis}SetAcceleration {getattr(profile, axis + 'Acceleration'):g}")
+    commands.append(f"setTiming {profile.weldTime:d}_{profile.cellDelay:d}_{profile.passDelay:d}_{profile.rowDelay:d}")
+    return commands
+
+
+# Time in seconds for an AccelStepper move of the given number of steps
+# Trapezoidal profile starting and ending at rest; triangular if max speed is never reached
+def moveTime(steps, maxSpeed, acceleration):
+    steps = abs(steps)
+    if steps == 0:
+        return 0.0
+    rampSteps = maxSpeed * maxSpeed / acceleration
+    if steps >= rampSteps:
+        return steps / maxSpeed + maxSpeed / acceleration
+    return 2 * math.sqrt(steps / acceleration)
+
+
+# Steps travelled after t seconds of the profile used by moveTime()
+def moveProgress(t, steps, maxSpeed, acceleration):
+    steps = abs(steps)
+    total = moveTime(steps, maxSpeed, acceleration)
+    if t <= 0:
+        return 0.0
+    if t >= total:
+        return float(steps)
+    peak = min(maxSpeed, math.sqrt(steps * acceleration))
+    rampTime = peak / acceleration
+    if t < rampTime:
+        return acceleration * t * t / 2
+    cruiseEnd = total - rampTime
+    rampSteps = peak * rampTime / 2
+    if t < cruiseEnd:
+        return rampSteps + peak * (t - rampTime)
+    left = total - t
+    return steps - acceleration * left * left / 2
+
+
+# Speed in steps/s after t seconds of the profile used by moveTime()
+def moveSpeed(t, steps, maxSpeed, acceleration):
+    steps = abs(steps)
+    total = moveTime(steps, maxSpeed, acceleration)
+    if t <= 0 or t >= total:
+        return 0.0
+    peak = min(maxSpeed, math.sqrt(steps * acceleration))
+    return min(peak, acceleration * t, acceleration * (total - t))
+
+
+# Absolute X/Y target for a weld point, same math as moveToCell() in the firmware
+def cellTarget(row, cell, side, packType=PT_A):
+    x = X_ZERO + row * X_STEPOVER
+    offset = row % 2 if packType == PT_A else (row + 1) % 2
+    y = Y_ZERO + offset * Y_STEPOVER / 2 + cell * Y_STEPOVER + (WELD_SPACE / 2 if side else -WELD_SPACE / 2)
+    return x, y
+
+
+# The moveTo() position for one Axis::getPosition() reports, which applies the
+# multiplier on the way in and again on the way out
+def positionUnits(position, multiplier):
+    return position / (multiplier * multiplier)
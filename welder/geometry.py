@@ -0,0 +1,173 @@
+"""Pack geometry: where every weld point of a pack is.
+
+A layout is plain data (rows, cells, row and cell pitch, stagger, weld spacing and
+the position of the first cell), read from layouts.json next to this file and then
+from ~/.cnc-spot-welder/layouts.json, so a new pack shape is a data change.
+PackGeometry computes the X/Y target of every weld point once, into flat tables in
+weld mask order ((row * cells + cell) * 2 + side); the planner, the pack viewer and
+the weldAt commands streamed to the firmware all read from them.
+
+Positions are in firmware units (what moveTo() takes), like firmware.cellTarget().
+A layout can carry an affine correction measured on the machine (calibration.py),
+which the tables then include.
+"""
+import array
+import json
+import os
+
+from . import firmware as fw
+
+LAYOUTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "layouts.json")
+USER_LAYOUTS_PATH = os.path.join(os.path.expanduser("~"), ".cnc-spot-welder", "layouts.json")
+DEFAULT_LAYOUT = "A"
+STAGGERS = ("hex", "rect")
+
+
+class PackGeometry:
+    # stagger "hex" shifts every other row by half a cell pitch (the odd rows, or the
+    # even rows with shiftEven), "rect" lines the rows up. Rows run along X, cells
+    # along Y, and the two sides of a cell are weldSpace apart in Y. packType names
+    # the firmware pack type whose runPack/align pattern matches, if any. transform
+    # (a, b, c, d, e, f) moves every point to x' = a x + b y + c, y' = d x + e y + f.
+    def __init__(self, name, rows, cells, rowPitch, cellPitch, weldSpace, origin,
+                 stagger="hex", shiftEven=False, packType=None, transform=None):
+        if rows < 1 or cells < 1:
+            raise ValueError(f"Layout {name} needs at least one row and cell")
+        if rows * cells * fw.PACK_SIDES > fw.MAX_WELD_BYTES * 8:
+            raise ValueError(f"Layout {name} has more cells than the firmware's weld mask holds")
+        if stagger not in STAGGERS:
+            raise ValueError(f"Layout {name} has unknown stagger {stagger}")
+        if packType is not None and packType not in fw.PACK_TYPES:
+            raise ValueError(f"Layout {name} has unknown pack type {packType}")
+        self.name = name
+        self.rows = rows
+        self.cells = cells
+        self.sides = fw.PACK_SIDES
+        self.size = rows * cells * self.sides
+        self.rowPitch = float(rowPitch)
+        self.cellPitch = float(cellPitch)
+        self.weldSpace = float(weldSpace)
+        self.origin = (float(origin[0]), float(origin[1]))
+        self.stagger = stagger
+        self.shiftEven = shiftEven
+        self.packType = packType
+        self.transform = tuple(transform) if transform is not None else None
+        # The nominal points, which the pack viewer draws, and the targets the welder moves to
+        self.nominalXs, self.nominalYs = self._table()
+        self.xs, self.ys = self._transformed(self.nominalXs, self.nominalYs)
+
+    @classmethod
+    def fromDict(cls, name, data):
+        return cls(name, **data)
+
+    def toDict(self):
+        return {"rows": self.rows, "cells": self.cells, "stagger": self.stagger, "shiftEven": self.shiftEven,
+                "rowPitch": self.rowPitch, "cellPitch": self.cellPitch, "weldSpace": self.weldSpace,
+                "origin": list(self.origin), "packType": self.packType}
+
+    # X/Y of every weld point. One row of Y offsets is built and shifted per row.
+    def _table(self):
+        rowOffsets = [cell * self.cellPitch + side * self.weldSpace - self.weldSpace / 2
+                      for cell in range(self.cells) for side in range(self.sides)]
+        xs = array.array("d")
+        ys = array.array("d")
+        for row in range(self.rows):
+            x, y = self.rowStart(row)
+            xs.extend([x] * len(rowOffsets))
+            ys.extend([y + offset for offset in rowOffsets])
+        return xs, ys
+
+    # xs, ys moved by the transform
+    def _transformed(self, xs, ys):
+        if self.transform is None:
+            return xs, ys
+        a, b, c, d, e, f = self.transform
+        return (array.array("d", [a * x + b * y + c for x, y in zip(xs, ys)]),
+                array.array("d", [d * x + e * y + f for x, y in zip(xs, ys)]))
+
+    # This layout with the weld points moved by transform, None for the nominal layout
+    def calibrated(self, transform):
+        return PackGeometry(self.name, transform=transform, **self.toDict())
+
+    @property
+    def shape(self):
+        return self.rows, self.cells, self.sides
+
+    ########################################################################
+    # Lookups. point() is where the welder goes, centre() and locate() are in the
+    # nominal layout.
+    def index(self, row, cell, side):
+        return (row * self.cells + cell) * self.sides + side
+
+    def contains(self, row, cell, side):
+        return 0 <= row < self.rows and 0 <= cell < self.cells and 0 <= side < self.sides
+
+    # Centre of the first cell of a row
+    def rowStart(self, row):
+        shifted = self.stagger == "hex" and row % 2 == (0 if self.shiftEven else 1)
+        return (self.origin[0] + row * self.rowPitch,
+                self.origin[1] + (self.cellPitch / 2 if shifted else 0))
+
+    def point(self, row, cell, side):
+        index = self.index(row, cell, side)
+        return self.xs[index], self.ys[index]
+
+    def centre(self, row, cell):
+        x, y = self.rowStart(row)
+        return x, y + cell * self.cellPitch
+
+    # (row, cell, side) of the weld point under a position, or None outside the pack
+    def locate(self, x, y):
+        row = round((x - self.origin[0]) / self.rowPitch)
+        if not 0 <= row < self.rows:
+            return None
+        rowX, rowY = self.rowStart(row)
+        cell = round((y - rowY) / self.cellPitch)
+        if not 0 <= cell < self.cells:
+            return None
+        side = int(y >= rowY + cell * self.cellPitch) if self.sides == 2 else 0
+        return row, cell, side
+
+    # (minX, minY, maxX, maxY) over all nominal weld points
+    def bounds(self):
+        return min(self.nominalXs), min(self.nominalYs), max(self.nominalXs), max(self.nominalYs)
+
+
+########################################################################
+# Layout files
+def readLayouts(path):
+    with open(path) as file:
+        data = json.load(file)
+    return {name: PackGeometry.fromDict(name, layout) for name, layout in data.items()}
+
+
+# Built-in layouts, overridden or extended by the user's file
+def loadLayouts(paths=(LAYOUTS_PATH, USER_LAYOUTS_PATH)):
+    layouts = {}
+    for path in paths:
+        if os.path.exists(path):
+            layouts.update(readLayouts(path))
+    return layouts
+
+
+_layouts = None
+
+
+# Layouts from the default files, read once
+def layouts():
+    global _layouts
+    if _layouts is None:
+        _layouts = loadLayouts()
+    return _layouts
+
+
+def layout(name=DEFAULT_LAYOUT):
+    try:
+        return layouts()[name]
+    except KeyError:
+        raise ValueError(f"Unknown pack layout {name}") from None
+
+
+# Layout for a firmware pack type (fw.PT_A or fw.PT_B), the layouts are named after them
+def layoutFor(packType):
+    return layout(next(name for name, value in fw.PACK_TYPES.items() if value == packType))
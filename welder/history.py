@@ -0,0 +1,370 @@
+"""Weld history: every weld and job event of every pack, in SQLite.
+
+History is a client listener. It turns each R line into a row of the welds table
+(job, row, cell, side, wall time and the cycle time since the job's previous weld)
+and pause, resume, stop, ESTOP, finished and a lost connection into rows of the
+events table; every runPack gets a row in the jobs table with its layout, how it was
+welded, the pack's name when it has one (jobs.py passes the queue job's) and how it
+ended. The listener runs on the client's poll thread, so it only queues the rows:
+HistoryWriter inserts them from a thread of its own, in one transaction per batch of
+up to BATCH_SIZE rows or FLUSH_INTERVAL seconds, with the database in WAL mode so
+queries can read while a pack is welded.
+
+The tables are indexed for the questions asked of them afterwards:
+
+    python -m welder.history jobs
+    python -m welder.history rows --layout A --days 7
+    python -m welder.history shifts
+    python -m welder.history estops
+    python -m welder.history cell 3 12 0
+
+rows prints cycle time percentiles per row, shifts the packs finished per shift,
+estops the cells welded just before each emergency stop and cell when, and in which
+job, a cell was welded. `benchmark` times the listener and the queries on a made-up
+history.
+"""
+import argparse
+import os
+import queue
+import sqlite3
+import tempfile
+import threading
+import time
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".cnc-spot-welder", "history.sqlite3")
+# Most rows inserted in one transaction, and the longest a row waits to be written
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 1.0
+# Hours in a shift, and the hour the first shift of the day starts
+SHIFT_HOURS = 8
+FIRST_SHIFT = 6
+QUANTILES = (0.5, 0.9, 0.99)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY, pack TEXT, layout TEXT, mode TEXT, started REAL, finished REAL, outcome TEXT);
+CREATE TABLE IF NOT EXISTS welds (job INTEGER, row INTEGER, cell INTEGER, side INTEGER, time REAL, cycle REAL);
+CREATE TABLE IF NOT EXISTS events (job INTEGER, kind TEXT, time REAL);
+CREATE INDEX IF NOT EXISTS welds_job_time ON welds (job, time);
+CREATE INDEX IF NOT EXISTS welds_row_cycle ON welds (row, cycle);
+CREATE INDEX IF NOT EXISTS welds_cell ON welds (row, cell, side);
+CREATE INDEX IF NOT EXISTS events_kind_time ON events (kind, time);
+CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished);
+"""
+
+INSERT_JOB = "INSERT OR REPLACE INTO jobs (id, pack, layout, mode, started) VALUES (?, ?, ?, ?, ?)"
+END_JOB = "UPDATE jobs SET finished = ?, outcome = ? WHERE id = ?"
+INSERT_WELD = "INSERT INTO welds VALUES (?, ?, ?, ?, ?, ?)"
+INSERT_EVENT = "INSERT INTO events VALUES (?, ?, ?)"
+
+# Client events recorded in the events table, and the job outcome of those that end it
+EVENT_KINDS = {"estop": "estop", "finished": "finished", "lost": "lost", "failed": "failed"}
+JOB_ACTIONS = {"pause": None, "resume": None, "stop": "stop"}
+
+
+def connect(path=DEFAULT_PATH):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+########################################################################
+# Writing
+class HistoryWriter:
+    # Inserts queued (statement, parameters) rows into the database at path in batches
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self.pending = queue.Queue()
+        self.written = 0
+        self.failed = False
+        self.thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self.thread.start()
+
+    def write(self, statement, parameters):
+        if not self.failed:
+            self.pending.put((statement, parameters))
+
+    # Write everything queued and stop the thread
+    def close(self, timeout=5.0):
+        self.pending.put(None)
+        self.thread.join(timeout)
+
+    def _run(self):
+        try:
+            connection = connect(self.path)
+        except (OSError, sqlite3.Error) as error:
+            self.failed = True
+            print(f"Weld history unavailable: {error}")
+            return
+        closing = False
+        while not closing:
+            batch = [self.pending.get()]
+            deadline = time.monotonic() + FLUSH_INTERVAL
+            while batch[-1] is not None and len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.pending.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                closing = True
+                batch.pop()
+            try:
+                self._insert(connection, batch)
+            except sqlite3.Error as error:
+                print(f"Could not write the weld history: {error}")
+        connection.close()
+
+    # One transaction, with consecutive rows of the same statement in one executemany
+    def _insert(self, connection, batch):
+        with connection:
+            start = 0
+            for end in range(1, len(batch) + 1):
+                if end == len(batch) or batch[end][0] != batch[start][0]:
+                    connection.executemany(batch[start][0], [parameters for statement, parameters in batch[start:end]])
+                    start = end
+        self.written += len(batch)
+
+
+class History:
+    # Records the client's events; append handleEvent to client.listeners
+    def __init__(self, path=DEFAULT_PATH):
+        self.writer = HistoryWriter(path)
+        # Wall clock time of time.monotonic() 0, the events are stamped with the latter
+        self.epoch = time.time() - time.monotonic()
+        self.job = None
+        self.lastJob = 0
+        # Monotonic time of the job's last weld, None after a pause
+        self.lastWeld = None
+        self.estopped = False
+
+    def handleEvent(self, event):
+        if event.kind == "progress":
+            row, cell, side = event.args
+            cycle = event.time - self.lastWeld if self.job is not None and self.lastWeld is not None else None
+            self.lastWeld = event.time
+            self.estopped = False
+            self.writer.write(INSERT_WELD, (self.job, row, cell, side, self.epoch + event.time, cycle))
+        elif event.kind == "job":
+            action = event.args[0]
+            if action == "start":
+                self._start(event)
+            elif action in JOB_ACTIONS and self.job is not None:
+                self._event(action, event.time, JOB_ACTIONS[action])
+        elif event.kind in EVENT_KINDS:
+            # An emergency stop is recorded between jobs too, only once while it is held
+            if event.kind == "estop" and not self.estopped or event.kind != "estop" and self.job is not None:
+                self.estopped = event.kind == "estop"
+                self._event(event.kind, event.time, EVENT_KINDS[event.kind])
+
+    def _start(self, event):
+        layoutName, mode, pack = event.args[1:]
+        # Ids are start times in ms, unique across sessions sharing the database
+        self.job = max(int((self.epoch + event.time) * 1000), self.lastJob + 1)
+        self.lastJob = self.job
+        self.lastWeld = None
+        self.estopped = False
+        self.writer.write(INSERT_JOB, (self.job, pack, layoutName, mode, self.epoch + event.time))
+
+    def _event(self, kind, stamp, outcome):
+        # A pause breaks the cycle; the first weld after it has no cycle time
+        self.lastWeld = None
+        self.writer.write(INSERT_EVENT, (self.job, kind, self.epoch + stamp))
+        if outcome is not None and self.job is not None:
+            self.writer.write(END_JOB, (self.epoch + stamp, outcome, self.job))
+            self.job = None
+
+    def close(self):
+        self.writer.close()
+
+
+########################################################################
+# Queries
+def quantile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+# {row: (welds, mean, p50, p90, p99)} of the cycle times since `since` (wall time), of
+# jobs on layoutName or all layouts
+def rowCycleQuantiles(connection, layoutName=None, since=0.0):
+    statement = "SELECT w.row, w.cycle FROM welds w"
+    parameters = [since]
+    if layoutName is not None:
+        statement += " JOIN jobs j ON j.id = w.job WHERE j.layout = ? AND"
+        parameters.insert(0, layoutName)
+    else:
+        statement += " WHERE"
+    statement += " w.cycle IS NOT NULL AND w.time >= ? ORDER BY w.row, w.cycle"
+    rows = {}
+    for row, cycle in connection.execute(statement, parameters):
+        rows.setdefault(row, []).append(cycle)
+    return {row: (len(cycles), sum(cycles) / len(cycles)) + tuple(quantile(cycles, q) for q in QUANTILES)
+            for row, cycles in rows.items()}
+
+
+# [(shift start, packs finished, packs ended otherwise)] since `since`, shifts of
+# shiftHours starting at firstShift o'clock, local time
+def packsPerShift(connection, since=0.0, shiftHours=SHIFT_HOURS, firstShift=FIRST_SHIFT):
+    shifts = {}
+    for finished, outcome in connection.execute(
+            "SELECT finished, outcome FROM jobs WHERE finished >= ? ORDER BY finished", (since,)):
+        local = time.localtime(finished - firstShift * 3600)
+        day = time.mktime((local.tm_year, local.tm_mon, local.tm_mday, 0, 0, 0, 0, 0, -1))
+        start = day + firstShift * 3600 + (local.tm_hour // shiftHours) * shiftHours * 3600
+        counts = shifts.setdefault(start, [0, 0])
+        counts[0 if outcome == "finished" else 1] += 1
+    return [(start, done, other) for start, (done, other) in sorted(shifts.items())]
+
+
+# [(job, pack, estop time, [(row, cell, side, time) of the last `count` welds before it])]
+def weldsBeforeEstop(connection, count=5, since=0.0):
+    results = []
+    estops = connection.execute(
+        "SELECT e.job, j.pack, e.time FROM events e LEFT JOIN jobs j ON j.id = e.job "
+        "WHERE e.kind = 'estop' AND e.time >= ? ORDER BY e.time", (since,)).fetchall()
+    for job, pack, stamp in estops:
+        welds = connection.execute(
+            "SELECT row, cell, side, time FROM welds WHERE job IS ? AND time <= ? ORDER BY time DESC LIMIT ?",
+            (job, stamp, count)).fetchall()
+        results.append((job, pack, stamp, welds[::-1]))
+    return results
+
+
+# [(time, job, pack, layout)] of every weld of (row, cell, side)
+def cellHistory(connection, row, cell, side):
+    return connection.execute(
+        "SELECT w.time, w.job, j.pack, j.layout FROM welds w LEFT JOIN jobs j ON j.id = w.job "
+        "WHERE w.row = ? AND w.cell = ? AND w.side = ? ORDER BY w.time", (row, cell, side)).fetchall()
+
+
+# [(id, pack, layout, mode, started, finished, outcome, welds)] of the last count jobs
+def recentJobs(connection, count=20):
+    return connection.execute(
+        "SELECT j.id, j.pack, j.layout, j.mode, j.started, j.finished, j.outcome, "
+        "(SELECT COUNT(*) FROM welds w WHERE w.job = j.id) FROM jobs j ORDER BY j.id DESC LIMIT ?",
+        (count,)).fetchall()[::-1]
+
+
+########################################################################
+# Command line
+def formatTime(stamp):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(stamp)) if stamp is not None else "-"
+
+
+def since(args):
+    return time.time() - args.days * 86400 if args.days else 0.0
+
+
+def showJobs(connection, args):
+    for job, pack, layoutName, mode, started, finished, outcome, welds in recentJobs(connection, args.count):
+        print(f"{job}  {formatTime(started)}  {pack or '-':16s} layout {layoutName:4s} {mode:8s} "
+              f"{welds:4d} welds  {outcome or 'running'}")
+
+
+def showRows(connection, args):
+    rows = rowCycleQuantiles(connection, args.layout, since(args))
+    if not rows:
+        print("No cycle times recorded")
+        return
+    print("row  welds   mean    p50    p90    p99 (s)")
+    for row, (count, mean, *quantiles) in sorted(rows.items()):
+        print(f"{row:3d} {count:6d} " + " ".join(f"{value:6.2f}" for value in [mean] + quantiles))
+
+
+def showShifts(connection, args):
+    for start, done, other in packsPerShift(connection, since(args), args.shift_hours, args.first_shift):
+        print(f"{formatTime(start)}  {done:3d} packs finished" + (f", {other} stopped" if other else ""))
+
+
+def showEstops(connection, args):
+    for job, pack, stamp, welds in weldsBeforeEstop(connection, args.welds, since(args)):
+        print(f"{formatTime(stamp)}  emergency stop, job {job} {pack or ''}".rstrip())
+        for row, cell, side, welded in welds:
+            print(f"    {row}_{cell}_{side} welded {stamp - welded:.1f} s before")
+
+
+def showCell(connection, args):
+    welds = cellHistory(connection, args.row, args.cell, args.side)
+    if not welds:
+        print(f"{args.row}_{args.cell}_{args.side} was never welded")
+    for stamp, job, pack, layoutName in welds:
+        print(f"{formatTime(stamp)}  job {job} {pack or '-'} layout {layoutName or '-'}")
+
+
+# Time the listener and the queries on packs made-up packs of 16 x 24 x 2 welds
+def benchmark(connection, args):
+    from .reader import Event
+    with tempfile.TemporaryDirectory() as directory:
+        history = History(os.path.join(directory, "history.sqlite3"))
+        stamp = time.monotonic() - args.packs * 1200.0
+        events = []
+        for pack in range(args.packs):
+            events.append(Event("job", ("start", "A", "pattern", f"pack {pack}"), "", stamp))
+            for row in range(16):
+                for side in range(2):
+                    for cell in range(24):
+                        stamp += 1.4 + 0.1 * (cell % 3)
+                        events.append(Event("progress", (row, cell, side), "", stamp))
+                        if pack % 10 == 9 and row == 8 and side == 1 and cell == 5:
+                            events.append(Event("estop", (), "ESTOP", stamp + 0.2))
+            events.append(Event("finished", (), "finished", stamp))
+        began = time.perf_counter()
+        for event in events:
+            history.handleEvent(event)
+        handled = time.perf_counter() - began
+        history.close()
+        written = time.perf_counter() - began
+        print(f"listener: {handled / len(events) * 1e6:.1f} us per event, {len(events)} events written in {written:.2f} s")
+        reading = sqlite3.connect(history.writer.path)
+        for name, query in (("rows", lambda: rowCycleQuantiles(reading, "A")),
+                            ("shifts", lambda: packsPerShift(reading)),
+                            ("estops", lambda: weldsBeforeEstop(reading)),
+                            ("cell", lambda: cellHistory(reading, 8, 12, 1))):
+            began = time.perf_counter()
+            query()
+            print(f"{name}: {(time.perf_counter() - began) * 1000:.1f} ms")
+        reading.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m welder.history", description="Query the weld history.")
+    parser.add_argument("--db", default=DEFAULT_PATH, help="history database")
+    parser.add_argument("--days", type=float, default=0, help="only the last DAYS days")
+    commands = parser.add_subparsers(dest="command", required=True)
+    command = commands.add_parser("jobs", help="the last jobs and how they ended")
+    command.add_argument("--count", type=int, default=20)
+    command.set_defaults(run=showJobs)
+    command = commands.add_parser("rows", help="cycle time percentiles per row")
+    command.add_argument("--layout", help="only jobs on this layout")
+    command.set_defaults(run=showRows)
+    command = commands.add_parser("shifts", help="packs finished per shift")
+    command.add_argument("--shift-hours", type=int, default=SHIFT_HOURS)
+    command.add_argument("--first-shift", type=int, default=FIRST_SHIFT, help="hour the first shift starts")
+    command.set_defaults(run=showShifts)
+    command = commands.add_parser("estops", help="the cells welded before each emergency stop")
+    command.add_argument("--welds", type=int, default=5, help="welds to show before each stop")
+    command.set_defaults(run=showEstops)
+    command = commands.add_parser("cell", help="when a cell was welded, and in which job")
+    command.add_argument("row", type=int)
+    command.add_argument("cell", type=int)
+    command.add_argument("side", type=int)
+    command.set_defaults(run=showCell)
+    command = commands.add_parser("benchmark", help="time the listener and the queries")
+    command.add_argument("--packs", type=int, default=200)
+    command.set_defaults(run=benchmark)
+    args = parser.parse_args()
+
+    try:
+        connection = connect(args.db)
+        try:
+            args.run(connection, args)
+        finally:
+            connection.close()
+    except (OSError, sqlite3.Error) as error:
+        raise SystemExit(str(error))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,390 @@
+"""Queue of packs welded back to back.
+
+Packs are enqueued with their layout, how to weld them (the firmware's runPack
+pattern, an optimised weldAt stream or blended moves) and any cells already welded.
+The queue is kept in QUEUE_PATH as JSON and rewritten atomically on every change, and
+every pack has a weld journal of its own in JOBS_DIR, so a shift that is interrupted
+(estop, lost connection, Ctrl-C, a reboot) resumes from the exact cell it stopped at.
+
+JobRunner welds the queue in order on a WelderClient. What can be shared between
+packs is done once: the machine is homed once per run, and the head is only aligned
+and checked when the layout changes. Between packs it parks the head up and waits for
+the operator to swap the pack, which is the only pause.
+
+    python -m welder.jobs add A --count 4
+    python -m welder.jobs add B --mode blend --welded-rows 3
+    python -m welder.jobs list
+    python -m welder.jobs run --port /dev/ttyUSB0
+"""
+import argparse
+import json
+import os
+import time
+
+import serial
+
+from . import firmware as fw
+from .calibration import calibratedLayout
+from .commands import CommandError
+from .estimate import formatDuration
+from .geometry import DEFAULT_LAYOUT, layout
+from .history import DEFAULT_PATH as HISTORY_PATH, History
+from .journal import Journal
+from .tuning import loadProfile
+from .weldmask import WeldMask
+
+QUEUE_DIR = os.path.join(os.path.expanduser("~"), ".cnc-spot-welder")
+QUEUE_PATH = os.path.join(QUEUE_DIR, "queue.json")
+JOBS_DIR = os.path.join(QUEUE_DIR, "jobs")
+
+# How a pack is welded
+PATTERN = "pattern"  # the firmware's runPack, needs a layout with a pack type
+OPTIMIZE = "optimize"  # weldAt commands in travel-optimised order
+BLEND = "blend"  # the optimised order as blended moves, see motion.py
+MODES = (PATTERN, OPTIMIZE, BLEND)
+
+# Job states. A running job was interrupted if the runner isn't; its journal has
+# everything welded so far.
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+
+
+class Job:
+    def __init__(self, id, layout, mode=PATTERN, name=None, state=QUEUED, added=None, started=None, finished=None):
+        self.id = id
+        self.layout = layout
+        self.mode = mode
+        self.name = name or f"Pack {id}"
+        self.state = state
+        # Unix times
+        self.added = time.time() if added is None else added
+        self.started = started
+        self.finished = finished
+
+    @classmethod
+    def fromDict(cls, data):
+        return cls(**data)
+
+    def toDict(self):
+        return dict(id=self.id, layout=self.layout, mode=self.mode, name=self.name, state=self.state,
+                    added=self.added, started=self.started, finished=self.finished)
+
+
+class JobQueue:
+    def __init__(self, path=QUEUE_PATH, jobsDir=None):
+        self.path = path
+        self.jobsDir = jobsDir or os.path.join(os.path.dirname(os.path.abspath(path)), "jobs")
+        self.jobs = []
+        self.nextId = 1
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as file:
+            data = json.load(file)
+        self.jobs = [Job.fromDict(job) for job in data["jobs"]]
+        self.nextId = data.get("nextId", max((job.id for job in self.jobs), default=0) + 1)
+
+    # Write the queue to a temporary file and replace the old one, so a crash leaves one or the other
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as file:
+            json.dump({"nextId": self.nextId, "jobs": [job.toDict() for job in self.jobs]}, file, indent=2)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.path)
+
+    ########################################################################
+    # Jobs
+    # Enqueue a pack of layoutName. welded is a WeldMask of the cells already welded.
+    def add(self, layoutName, mode=PATTERN, name=None, welded=None):
+        geometry = layout(layoutName)
+        if mode not in MODES:
+            raise ValueError(f"Unknown mode {mode}, expected one of {', '.join(MODES)}")
+        if mode == PATTERN and geometry.packType is None:
+            raise ValueError(f"Layout {layoutName} has no firmware pack type, use mode {OPTIMIZE} or {BLEND}")
+        if welded is not None and (welded.rows, welded.cells, welded.sides) != geometry.shape:
+            raise ValueError(f"Weld mask is {welded.rows}x{welded.cells}, layout {layoutName} is {geometry.rows}x{geometry.cells}")
+        job = Job(self.nextId, layoutName, mode, name)
+        self.nextId += 1
+        # A journal left over from a removed job with this id would resume the wrong pack
+        self._removeJournal(job)
+        journal = self.openJournal(job)
+        if welded is not None and welded.count():
+            journal.setMask(welded)
+        journal.close()
+        self.jobs.append(job)
+        self.save()
+        return job
+
+    def get(self, jobId):
+        for job in self.jobs:
+            if job.id == jobId:
+                return job
+        raise KeyError(f"No job {jobId} in the queue")
+
+    def remove(self, jobId):
+        job = self.get(jobId)
+        self.jobs.remove(job)
+        self._removeJournal(job)
+        self.save()
+
+    # Drop the finished jobs
+    def clearDone(self):
+        done = [job for job in self.jobs if job.state == DONE]
+        for job in done:
+            self.jobs.remove(job)
+            self._removeJournal(job)
+        self.save()
+        return len(done)
+
+    # The job to weld next: an interrupted one, or the first queued
+    def next(self):
+        for job in self.jobs:
+            if job.state != DONE:
+                return job
+        return None
+
+    def start(self, job):
+        job.state = RUNNING
+        if job.started is None:
+            job.started = time.time()
+        self.save()
+
+    def finish(self, job):
+        job.state = DONE
+        job.finished = time.time()
+        self.save()
+
+    ########################################################################
+    # Journals
+    def journalPath(self, job):
+        return os.path.join(self.jobsDir, f"{job.id}.journal")
+
+    def openJournal(self, job):
+        geometry = layout(job.layout)
+        return Journal(self.journalPath(job), WeldMask(*geometry.shape))
+
+    def _removeJournal(self, job):
+        path = self.journalPath(job)
+        for name in (path, path + ".snap"):
+            if os.path.exists(name):
+                os.remove(name)
+
+    # Welded sides of job, without opening its journal for writing
+    def weldedCount(self, job):
+        if not os.path.exists(self.journalPath(job)):
+            return 0
+        journal = self.openJournal(job)
+        try:
+            return journal.mask.count()
+        finally:
+            journal.close()
+
+
+class JobRunner:
+    # Welds jobQueue on client, which must be connected. confirm(message) asks the
+    # operator to do something and returns False to stop the queue there.
+    def __init__(self, client, jobQueue, confirm, log=print):
+        self.client = client
+        self.queue = jobQueue
+        self.confirm = confirm
+        self.log = log
+        self.homed = False
+        # Layout the head was last aligned for
+        self.aligned = None
+        self.job = None
+        # Set when the welder reports the running job finished
+        self.completed = False
+        client.listeners.append(self._handleEvent)
+
+    def _handleEvent(self, event):
+        if event.kind == "finished" and self.client.isConnected():
+            self.completed = True
+
+    # Weld every job left, returns True once the queue is empty. Returns False, with
+    # the current job left running to resume later, when the operator stops, the
+    # welder stops or goes away, or the job fails.
+    def run(self):
+        while True:
+            job = self.queue.next()
+            if job is None:
+                return True
+            if not self._runJob(job) or not self.client.isConnected():
+                return False
+
+    def _runJob(self, job):
+        client = self.client
+        geometry = calibratedLayout(job.layout)
+        journal = self.queue.openJournal(job)
+        self.job = job
+        remaining = journal.mask.remainingCount()
+        if remaining == 0:
+            journal.close()
+            self.queue.finish(job)
+            return True
+        resuming = job.state == RUNNING
+        self._parkForSwap()
+        future = client.loadPack(geometry, journal)
+        if future is not None:
+            client.wait(future)
+        if resuming:
+            message = f"Resuming {job.name} (layout {job.layout}), {remaining} welds left. Check the pack is still in the jig"
+        else:
+            message = f"Load {job.name} (layout {job.layout}), {remaining} welds"
+        if not self.confirm(message):
+            return False
+        if job.layout != self.aligned and geometry.packType is not None:
+            # The jig changed: show where the first cell is before welding
+            client.wait(client.align())
+            if not self.confirm(f"Check the head is over the first cell of layout {job.layout}"):
+                return False
+            self.aligned = job.layout
+        self.queue.start(job)
+        order = None
+        if job.mode != PATTERN:
+            order = client.planRemaining()
+        jobEstimate = client.estimateJob(order, job.mode == BLEND)
+        self.log(f"{job.name}: predicted {formatDuration(jobEstimate.total)} for {jobEstimate.count} welds")
+        self.completed = False
+        client.runPack(order, jobEstimate, job.mode == BLEND, job.name)
+        client.waitFor(lambda: client.finished or client.status == "Emergency Stop")
+        # A lost link ends the wait as well: the pack is only done if the welder said so,
+        # or its journal has nothing left. Otherwise it stays running, to resume.
+        if not client.finished or not (self.completed or journal.mask.remainingCount() == 0):
+            return False
+        self.queue.finish(job)
+        self.log(f"{job.name}: finished, {client.welds.count()}/{client.welds.size} welded")
+        return True
+
+    # Home once per run; later packs are swapped with the head lifted clear
+    def _parkForSwap(self):
+        if not self.homed:
+            self.client.wait(self.client.home())
+            self.homed = True
+        else:
+            self.client.wait(self.client.send("zMoveTo 0"))
+
+    def stop(self):
+        self.client.stop()
+
+
+########################################################################
+# Command line
+def listJobs(jobQueue, args):
+    if not jobQueue.jobs:
+        print("The queue is empty")
+        return
+    for job in jobQueue.jobs:
+        geometry = layout(job.layout)
+        welded = jobQueue.weldedCount(job)
+        print(f"{job.id:4d}  {job.state:8s} {job.name:16s} layout {job.layout:4s} {job.mode:8s} "
+              f"{welded}/{geometry.rows * geometry.cells * geometry.sides} welded")
+
+
+def addJobs(jobQueue, args):
+    geometry = layout(args.layout)
+    welded = None
+    if args.welded is not None:
+        welded = WeldMask.fromHex(args.welded, geometry.rows, geometry.cells, geometry.sides)
+    elif args.welded_rows:
+        welded = WeldMask(*geometry.shape)
+        for row, cell, side in welded.unwelded():
+            if row < args.welded_rows:
+                welded[row, cell, side] = 1
+    for i in range(args.count):
+        job = jobQueue.add(args.layout, args.mode, args.name, welded)
+        print(f"Added job {job.id}, {job.name}")
+
+
+def removeJobs(jobQueue, args):
+    if args.done:
+        print(f"Removed {jobQueue.clearDone()} finished jobs")
+    for jobId in args.ids:
+        jobQueue.remove(jobId)
+        print(f"Removed job {jobId}")
+
+
+def ask(message):
+    try:
+        return input(f"{message}. Enter to continue, q to stop: ").strip().lower() != "q"
+    except EOFError:
+        return False
+
+
+def runJobs(jobQueue, args):
+    from .client import WelderClient
+    if jobQueue.next() is None:
+        print("The queue is empty")
+        return
+    job = jobQueue.next()
+    client = WelderClient(echo=args.echo, baud=args.baud, binary=not args.text, geometry=calibratedLayout(job.layout),
+                          record=args.record, profile=loadProfile())
+    runner = JobRunner(client, jobQueue, (lambda message: True) if args.yes else ask)
+    weldHistory = History(args.history)
+    client.listeners.append(weldHistory.handleEvent)
+    try:
+        client.connect(args.port)
+        if not client.waitReady():
+            raise SystemExit(f"No answer from the welder on {args.port}")
+        if runner.run():
+            print("Queue done")
+        elif client.status == "Emergency Stop":
+            raise SystemExit(f"Emergency stop, run again to resume {runner.job.name}")
+        elif not client.isConnected():
+            raise SystemExit(f"{client.status}, run again to resume {runner.job.name}")
+        elif client.failure is not None:
+            raise SystemExit(f"{client.failure}, run again to resume {runner.job.name}")
+        else:
+            print("Stopped")
+    except KeyboardInterrupt:
+        runner.stop()
+        raise SystemExit(f"Stopped, run again to resume {runner.job.name if runner.job else 'the queue'}")
+    except serial.SerialException as error:
+        raise SystemExit(f"Could not open {args.port}: {error}")
+    except (CommandError, ConnectionError, TimeoutError) as error:
+        raise SystemExit(str(error))
+    finally:
+        client.close()
+        weldHistory.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m welder.jobs", description="Queue packs and weld them back to back.")
+    parser.add_argument("--queue", default=QUEUE_PATH, help="queue file, pack journals are kept next to it")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="show the queue").set_defaults(run=listJobs)
+    command = commands.add_parser("add", help="enqueue packs")
+    command.add_argument("layout", nargs="?", default=DEFAULT_LAYOUT, help="pack layout from layouts.json")
+    command.add_argument("--mode", choices=MODES, default=PATTERN, help="how to weld the pack")
+    command.add_argument("--name", help="name shown to the operator")
+    command.add_argument("--count", type=int, default=1, help="number of packs to add")
+    command.add_argument("--welded", metavar="HEX", help="weld mask of the cells already welded, as setWelds takes it")
+    command.add_argument("--welded-rows", type=int, default=0, help="rows already welded")
+    command.set_defaults(run=addJobs)
+    command = commands.add_parser("remove", help="drop jobs and their journals")
+    command.add_argument("ids", type=int, nargs="*")
+    command.add_argument("--done", action="store_true", help="drop every finished job")
+    command.set_defaults(run=removeJobs)
+    command = commands.add_parser("run", help="weld the queue, resuming an interrupted pack")
+    command.add_argument("--port", required=True, help="serial port of the welder")
+    command.add_argument("--baud", type=int, default=fw.BAUD)
+    command.add_argument("--text", action="store_true", help="stay on the text protocol instead of switching to frames")
+    command.add_argument("--echo", action="store_true", help="print every line from the firmware")
+    command.add_argument("--record", metavar="DIR", help="record every byte sent and received to a session file here")
+    command.add_argument("--history", default=HISTORY_PATH, help="weld history database, shared with the GUI")
+    command.add_argument("--yes", action="store_true", help="don't wait for the operator between packs")
+    command.set_defaults(run=runJobs)
+    args = parser.parse_args()
+
+    try:
+        args.run(JobQueue(args.queue), args)
+    except (KeyError, ValueError, OSError) as error:
+        raise SystemExit(str(error))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""Hold-to-jog: a key held down runs an axis, releasing it stops the axis.
+
+The firmware's xJog/yJog/zJog run an axis towards one end at its full speed for
+JOG_TIMEOUT ms, and every further jog renews that; xJogStop decelerates it and
+answers "done x" once it stands. Jogger turns key presses and releases into those
+commands. Keyboard auto-repeat (and the release/press pairs X11 sends for it) only
+updates which keys are held; tick(), called every JOG_TICK, sends at most one
+command: a jog when the held key changed or the last jog is due a renewal, or the
+stop once a release has lasted RELEASE_GRACE. So a held key costs JOG_RENEW
+commands a second however fast the keyboard repeats, nothing queues up in the
+firmware, and the stop goes out at most JOG_TICK + RELEASE_GRACE after the release.
+The time from release to "done" is recorded as jog_stop_seconds.
+
+    python -m welder.jog --port /dev/ttyUSB0 --hold 1.5
+
+holds a key on the welder (or the simulator) both ways, as jogs and as the one
+xMove per key event the GUI used to send, and reports the commands sent and how
+long the axis kept moving after the release.
+"""
+import argparse
+import time
+
+from .client import WelderClient
+
+# Seconds between control ticks
+JOG_TICK = 0.05
+# Seconds between renewals of a held jog, well inside the firmware's JOG_TIMEOUT
+JOG_RENEW = 0.1
+# Seconds a release must last to count; auto-repeat presses the key again at once
+RELEASE_GRACE = 0.03
+# Seconds between auto-repeat events of a held key, and the step each sent as xMove
+REPEAT = 0.033
+STEP = 10
+
+
+class Jogger:
+    def __init__(self, client):
+        self.client = client
+        # (axis, direction) of the keys held, in the order pressed, with the time of a
+        # release that hasn't lasted RELEASE_GRACE yet
+        self.held = {}
+        # (axis, direction) jogging, and when its jog was last sent
+        self.jogging = None
+        self.lastSent = 0.0
+        self.releasedAt = None
+        self.sent = 0
+
+    def press(self, axis, direction):
+        self.held[axis, direction] = None
+
+    def release(self, axis, direction, now=None):
+        if self.held.get((axis, direction), 0) is None:
+            self.held[axis, direction] = time.monotonic() if now is None else now
+
+    # Everything released, e.g. when the window loses focus or control is taken away
+    def releaseAll(self, now=None):
+        for key in self.held:
+            self.release(*key, now)
+
+    # The most recently pressed key still held
+    def _wanted(self, now):
+        for key, released in list(self.held.items()):
+            if released is not None and now - released >= RELEASE_GRACE:
+                del self.held[key]
+                self.releasedAt = released
+        return next(reversed(self.held), None)
+
+    # Send what the keys held now call for, at most one command
+    def tick(self, now=None):
+        now = time.monotonic() if now is None else now
+        wanted = self._wanted(now)
+        if wanted is not None:
+            if wanted != self.jogging or now - self.lastSent >= JOG_RENEW:
+                # A jog on another axis stops the last one, in the firmware
+                self.client.jog(*wanted)
+                self.jogging = wanted
+                self.lastSent = now
+                self.sent += 1
+        elif self.jogging is not None:
+            future = self.client.jogStop(self.jogging[0])
+            self.jogging = None
+            self.sent += 1
+            if future is not None:
+                releasedAt = self.releasedAt if self.releasedAt is not None else now
+                future.add_done_callback(lambda done: self._stopped(done, releasedAt))
+
+    def _stopped(self, future, releasedAt):
+        if future.exception() is None:
+            now = time.monotonic()
+            self.client.metrics.observe("jog_stop_seconds", now - releasedAt, stamp=now)
+
+
+########################################################################
+# Benchmark
+# Seconds until the client reads axis as standing
+def _waitStopped(client, index, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        client.wait(client.queryAxes(), 2)
+        client.poll()
+        if not client.running[index]:
+            return
+    raise TimeoutError("The axis kept moving")
+
+
+# Hold a key on axis for hold seconds, auto-repeating every REPEAT, then release it.
+# Returns (commands sent, seconds from the release until the axis stands).
+def holdKey(client, axis, direction, hold, jogging):
+    jogger = Jogger(client)
+    start = time.monotonic()
+    nextRepeat = start
+    sent = 0
+    if jogging:
+        jogger.press(axis, direction)
+    while time.monotonic() - start < hold:
+        now = time.monotonic()
+        if now >= nextRepeat:
+            nextRepeat += REPEAT
+            if jogging:
+                jogger.release(axis, direction, now)
+                jogger.press(axis, direction)
+            else:
+                client.move(axis, STEP * direction)
+                sent += 1
+        if jogging:
+            jogger.tick(now)
+        client.poll(0.005)
+    released = time.monotonic()
+    if jogging:
+        jogger.release(axis, direction, released)
+        while jogger.jogging is not None:
+            jogger.tick()
+            client.poll(0.005)
+        sent = jogger.sent
+    _waitStopped(client, "xyz".index(axis))
+    return sent, time.monotonic() - released
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m welder.jog", description="Compare hold-to-jog with a move per key event.")
+    parser.add_argument("--port", required=True, help="serial port of the welder or the simulator")
+    parser.add_argument("--axis", choices=["x", "y", "z"], default="x")
+    parser.add_argument("--hold", type=float, default=1.5, help="seconds the key is held")
+    parser.add_argument("--repeats", type=int, default=3, help="holds per mode")
+    parser.add_argument("--text", action="store_true", help="stay on the text protocol instead of switching to frames")
+    args = parser.parse_args()
+
+    client = WelderClient(binary=not args.text)
+    try:
+        client.connect(args.port)
+        if not client.waitReady():
+            raise SystemExit(f"No answer from the welder on {args.port}")
+        for jogging in (False, True):
+            results = []
+            for i in range(args.repeats):
+                # Back and forth, so the axis stays near where it started
+                results.append(holdKey(client, args.axis, 1 if i % 2 == 0 else -1, args.hold, jogging))
+            sent = sum(count for count, stop in results) / len(results)
+            stops = sorted(stop for count, stop in results)
+            name = "jog" if jogging else f"{args.axis}Move {STEP} per key event"
+            print(f"{name}: {sent:.0f} commands per {args.hold:g} s hold, "
+                  f"stopped {stops[len(stops) // 2] * 1000:.0f} ms after release (worst {stops[-1] * 1000:.0f} ms)")
+    except (ConnectionError, TimeoutError) as error:
+        raise SystemExit(str(error))
+    finally:
+        client.close()
+    histogram = client.metrics.histograms.get(("jog_stop_seconds", None))
+    if histogram is not None and histogram.count:
+        print(f"jog_stop_seconds: mean {histogram.mean() * 1000:.0f} ms, max {histogram.maximum() * 1000:.0f} ms "
+              f"over {histogram.count} stops")
+
+
+if __name__ == "__main__":
+    main()
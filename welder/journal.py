@@ -0,0 +1,157 @@
+"""Crash-safe append-only journal of weld progress and commands.
+
+Every progress line and command is appended as a small checksummed record, so the
+welded cells survive the GUI dying or the PC rebooting mid-pack. A snapshot of the
+weld mask and the journal offset it covers is written next to the journal every
+SNAPSHOT_EVERY records; on startup the journal is memory-mapped and only the records
+after the snapshot are replayed, so recovery stays in the milliseconds however long
+the history is. A torn record at the end (crash mid-write) is dropped.
+
+Records are flushed as they are written, which survives a crash of the process, and
+synced to disk at least every SYNC_INTERVAL seconds and at every snapshot, which
+bounds what a power loss can take.
+"""
+import mmap
+import os
+import struct
+import time
+import zlib
+
+from . import firmware as fw
+from .weldmask import WeldMask
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".cnc-spot-welder", "weld.journal")
+MAGIC = b"WELDJRN1"
+# crc32 of everything after it, time, kind, payload length
+RECORD = struct.Struct("<IdBH")
+# magic, journal offset covered, crc32 of the mask
+SNAPSHOT = struct.Struct("<8sQI")
+SNAPSHOT_EVERY = 256
+SYNC_INTERVAL = 1.0
+
+# Record kinds
+PROGRESS = 1  # row, cell, side
+COMMAND = 2  # command text
+RESET = 3  # weld mask cleared
+MASK = 4  # whole weld mask, after a sync with the firmware
+
+
+# Journal for a pack shape: the default shape uses path, others get a file of their own
+def shapePath(path, rows, cells):
+    if (rows, cells) == (fw.PACK_ROWS, fw.PACK_CELLS):
+        return path
+    root, extension = os.path.splitext(path)
+    return f"{root}-{rows}x{cells}{extension}"
+
+
+class Journal:
+    def __init__(self, path=DEFAULT_PATH, mask=None):
+        self.path = path
+        self.snapshotPath = path + ".snap"
+        self.mask = mask if mask is not None else WeldMask()
+        self.replayed = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        end = self._replay()
+        self.file = open(path, "r+b" if os.path.exists(path) else "w+b")
+        if end == 0:
+            self.file.write(MAGIC)
+            end = len(MAGIC)
+        self.file.truncate(end)
+        self.file.seek(end)
+        self.file.flush()
+        self.sinceSnapshot = 0
+        self.lastSync = time.monotonic()
+
+    ########################################################################
+    # Recovery
+    def _readSnapshot(self, size):
+        try:
+            with open(self.snapshotPath, "rb") as snapshot:
+                data = snapshot.read()
+        except OSError:
+            return len(MAGIC)
+        if len(data) != SNAPSHOT.size + len(self.mask.bits):
+            return len(MAGIC)
+        magic, offset, crc = SNAPSHOT.unpack_from(data)
+        bits = data[SNAPSHOT.size:]
+        if magic != MAGIC or zlib.crc32(bits) != crc or offset > size:
+            return len(MAGIC)
+        self.mask.load(bits)
+        return offset
+
+    # Rebuild the mask from the snapshot and the records after it, returns the end of the valid journal
+    def _replay(self):
+        if not os.path.exists(self.path) or os.path.getsize(self.path) < len(MAGIC):
+            return 0
+        with open(self.path, "rb") as journal:
+            view = mmap.mmap(journal.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if view[:len(MAGIC)] != MAGIC:
+                    raise ValueError(f"{self.path} is not a weld journal")
+                offset = self._readSnapshot(len(view))
+                while offset + RECORD.size <= len(view):
+                    crc, stamp, kind, length = RECORD.unpack_from(view, offset)
+                    end = offset + RECORD.size + length
+                    if end > len(view) or zlib.crc32(view[offset + 4:end]) != crc:
+                        break
+                    self._apply(kind, view[offset + RECORD.size:end])
+                    self.replayed += 1
+                    offset = end
+            finally:
+                view.close()
+        return offset
+
+    def _apply(self, kind, payload):
+        if kind == PROGRESS:
+            self.mask[tuple(payload)] = 1
+        elif kind == RESET:
+            self.mask.clear()
+        elif kind == MASK:
+            self.mask.load(payload)
+
+    ########################################################################
+    # Appending
+    def append(self, kind, payload=b""):
+        body = RECORD.pack(0, time.time(), kind, len(payload))[4:] + payload
+        self.file.write(struct.pack("<I", zlib.crc32(body)) + body)
+        self.file.flush()
+        self._apply(kind, payload)
+        self.sinceSnapshot += 1
+        if self.sinceSnapshot >= SNAPSHOT_EVERY:
+            self.snapshot()
+        elif time.monotonic() - self.lastSync >= SYNC_INTERVAL:
+            self.sync()
+
+    def progress(self, row, cell, side):
+        self.append(PROGRESS, bytes((row, cell, side)))
+
+    def command(self, text):
+        self.append(COMMAND, text.encode("utf-8"))
+
+    def reset(self):
+        self.append(RESET)
+        self.snapshot()
+
+    def setMask(self, mask):
+        self.append(MASK, bytes(mask.bits))
+
+    def sync(self):
+        os.fsync(self.file.fileno())
+        self.lastSync = time.monotonic()
+
+    # Write the current mask and the offset it covers, atomically replacing the old snapshot
+    def snapshot(self):
+        self.sync()
+        bits = bytes(self.mask.bits)
+        temporary = self.snapshotPath + ".tmp"
+        with open(temporary, "wb") as snapshot:
+            snapshot.write(SNAPSHOT.pack(MAGIC, self.file.tell(), zlib.crc32(bits)) + bits)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(temporary, self.snapshotPath)
+        self.sinceSnapshot = 0
+
+    def close(self):
+        if not self.file.closed:
+            self.snapshot()
+            self.file.close()
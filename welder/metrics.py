@@ -0,0 +1,212 @@
+"""Timing instrumentation for the serial link and the weld cycle.
+
+Metrics is fed from the serial layer: CommandQueue reports when each command is
+written and completed, and the reader thread passes every Event with its receive
+timestamp. From those it keeps rolling histograms of
+
+- command_latency_seconds: write to "ok"/"err", per command
+- move_seconds: write to "done <axis>" for non-blocking moves, per command
+- weld_cycle_seconds: gap between consecutive R lines on the same row and pass
+- pass_change_seconds / row_change_seconds: the same gap across a pass or a row
+- row_seconds: first weld of a row to the first weld of the next row (or finished)
+- idle_gap_seconds: nothing in flight until the next command is written
+- jog_stop_seconds: jog key released until the axis stands (jog.py)
+
+so the fixed delays, motion and WELD_TIME can be told apart. Export with writeCsv()
+(summary) / writeSamplesCsv() (every sample in the window) or writePrometheus() for
+node_exporter's textfile collector.
+
+The pass change, row change and row figures only mean something for runPack's
+row-by-row pattern; in a planned or blended order (startJob() with another mode)
+every gap counts as a weld cycle.
+"""
+import bisect
+import collections
+import csv
+import os
+import threading
+import time
+
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser("~"), ".cnc-spot-welder", "metrics")
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Samples kept per histogram for quantiles and the samples CSV
+WINDOW = 2000
+QUANTILES = (0.5, 0.9, 0.99)
+
+HELP = {
+    "command_latency_seconds": "Command write to ok/err from the firmware",
+    "move_seconds": "Non-blocking move write to done from the firmware",
+    "weld_cycle_seconds": "Time between consecutive welds in the same row and pass",
+    "pass_change_seconds": "Time between the last weld of a pass and the first of the next",
+    "row_change_seconds": "Time between the last weld of a row and the first of the next",
+    "row_seconds": "Time to weld one row, both passes",
+    "idle_gap_seconds": "Time with no command in flight before the next command",
+    "jog_stop_seconds": "Jog key release to the axis standing",
+}
+
+
+class Histogram:
+    # Cumulative bucket counts since start, plus the last `window` samples for quantiles
+    def __init__(self, bounds=BUCKETS, window=WINDOW):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.samples = collections.deque(maxlen=window)
+
+    def observe(self, value, stamp=None):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.samples.append((time.time() if stamp is None else stamp, value))
+
+    def quantile(self, q):
+        if not self.samples:
+            return None
+        values = sorted(value for stamp, value in self.samples)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def maximum(self):
+        return max((value for stamp, value in self.samples), default=None)
+
+
+class Metrics:
+    def __init__(self):
+        self.histograms = {}
+        self._lock = threading.RLock()
+        self._lastWeld = None
+        self._rowStart = None
+        # Welds come row by row and pass by pass, as in runPack
+        self._rowOrder = True
+        self._idleSince = None
+        # Offset from monotonic event timestamps to wall clock for exported samples
+        self._wallOffset = time.time() - time.monotonic()
+
+    def observe(self, name, value, label=None, stamp=None):
+        with self._lock:
+            histogram = self.histograms.get((name, label))
+            if histogram is None:
+                histogram = self.histograms[(name, label)] = Histogram()
+            histogram.observe(value, None if stamp is None else stamp + self._wallOffset)
+
+    ########################################################################
+    # Serial layer hooks, times are time.monotonic()
+    def commandSent(self, name, stamp):
+        with self._lock:
+            if self._idleSince is not None:
+                self.observe("idle_gap_seconds", stamp - self._idleSince, stamp=stamp)
+                self._idleSince = None
+
+    # pending is the number of commands still queued or in flight afterwards
+    def commandCompleted(self, name, sent, stamp, pending, moving=False):
+        with self._lock:
+            self.observe("move_seconds" if moving else "command_latency_seconds", stamp - sent, name, stamp)
+            if pending == 0:
+                self._idleSince = stamp
+
+    # A job of mode ("pattern", "optimize" or "blend", see WelderClient.runPack) starts
+    def startJob(self, mode):
+        with self._lock:
+            self._rowOrder = mode == "pattern"
+            self._lastWeld = None
+            self._rowStart = None
+
+    # Reader listener
+    def handleEvent(self, event):
+        with self._lock:
+            if event.kind == "progress":
+                row, cell, side = event.args
+                if self._lastWeld is not None:
+                    lastRow, lastSide, lastStamp = self._lastWeld
+                    gap = event.time - lastStamp
+                    if not self._rowOrder:
+                        self.observe("weld_cycle_seconds", gap, stamp=event.time)
+                    elif row != lastRow:
+                        self.observe("row_change_seconds", gap, stamp=event.time)
+                    elif side != lastSide:
+                        self.observe("pass_change_seconds", gap, stamp=event.time)
+                    else:
+                        self.observe("weld_cycle_seconds", gap, stamp=event.time)
+                if self._rowOrder and (self._lastWeld is None or row != self._lastWeld[0]):
+                    self._endRow(event.time)
+                    self._rowStart = event.time
+                self._lastWeld = (row, side, event.time)
+            elif event.kind in ("finished", "estop", "lost"):
+                if event.kind == "finished":
+                    self._endRow(event.time)
+                self._rowStart = None
+                self._lastWeld = None
+
+    def _endRow(self, stamp):
+        if self._rowStart is not None:
+            self.observe("row_seconds", stamp - self._rowStart, stamp=stamp)
+            self._rowStart = None
+
+    ########################################################################
+    # Reporting
+    def rows(self):
+        with self._lock:
+            items = sorted(self.histograms.items(), key=lambda item: (item[0][0], item[0][1] or ""))
+            return [(name, label, histogram.count, histogram.sum, histogram.mean(),
+                     *(histogram.quantile(q) for q in QUANTILES), histogram.maximum())
+                    for (name, label), histogram in items]
+
+    def summary(self):
+        lines = [f"{'metric':<26}{'label':<14}{'count':>7}{'mean':>9}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}"]
+        for name, label, count, total, mean, p50, p90, p99, maximum in self.rows():
+            values = "".join(f"{value:9.3f}" for value in (mean, p50, p90, p99, maximum))
+            lines.append(f"{name:<26}{label or '':<14}{count:7d}{values}")
+        return "\n".join(lines)
+
+    def writeCsv(self, path):
+        with open(path, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["metric", "label", "count", "sum", "mean", "p50", "p90", "p99", "max"])
+            writer.writerows(self.rows())
+
+    def writeSamplesCsv(self, path):
+        with self._lock:
+            samples = sorted((stamp, name, label or "", value)
+                             for (name, label), histogram in self.histograms.items()
+                             for stamp, value in histogram.samples)
+        with open(path, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["time", "metric", "label", "seconds"])
+            writer.writerows(samples)
+
+    # Prometheus text exposition format, replaced atomically for the textfile collector
+    def writePrometheus(self, path, prefix="welder_"):
+        lines = []
+        with self._lock:
+            byName = collections.defaultdict(list)
+            for (name, label), histogram in self.histograms.items():
+                byName[name].append((label, histogram))
+            for name in sorted(byName):
+                metric = prefix + name
+                lines.append(f"# HELP {metric} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {metric} histogram")
+                for label, histogram in sorted(byName[name], key=lambda item: item[0] or ""):
+                    labels = f'command="{label}",' if label else ""
+                    cumulative = 0
+                    for bound, count in zip(histogram.bounds + (float("inf"),), histogram.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(f'{metric}_bucket{{{labels}le="{le}"}} {cumulative}')
+                    labels = "{" + labels.rstrip(",") + "}" if labels else ""
+                    lines.append(f"{metric}_sum{labels} {histogram.sum:.6f}")
+                    lines.append(f"{metric}_count{labels} {histogram.count}")
+        temporary = path + ".tmp"
+        with open(temporary, "w") as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(temporary, path)
+
+    # Write metrics.prom, metrics.csv and metrics_samples.csv to directory
+    def export(self, directory=DEFAULT_DIRECTORY):
+        os.makedirs(directory, exist_ok=True)
+        self.writePrometheus(os.path.join(directory, "metrics.prom"))
+        self.writeCsv(os.path.join(directory, "metrics.csv"))
+        self.writeSamplesCsv(os.path.join(directory, "metrics_samples.csv"))
@@ -0,0 +1,124 @@
+"""Blended motion: overlap the Z lift and descent with the X/Y travel between welds.
+
+weldAt and weldCell run every phase of a weld one after the other: X/Y travel, a
+100 ms settle, Z down by the stepdown, WELD_TIME, Z back up, another 100 ms. This
+module streams absolute moves instead, so Z and X/Y run together wherever that is
+safe. The rule is one clearance height, CLEARANCE: X and Y may only move while Z is
+above it, and Z only goes below it once X and Y have stopped. For each weld after the
+first the host sends
+
+    xMoveTo x, yMoveTo y          X/Y start while Z is still lifting from the last weld
+    xyWaitWithin dx_dy            until X/Y are as close as the Z descent takes to cover
+    zMoveTo CLEARANCE             Z comes down to the clearance while X/Y finish
+    zPlunge CLEARANCE_row_cell_side
+
+zPlunge waits for X/Y to stop, lowers Z to the weld depth, welds, starts the lift and
+answers once Z is above the clearance, which is when the next X/Y move may start. The
+firmware enforces both halves of the rule; the gate distances only decide how much
+the moves overlap, so a wrong guess costs time, never clearance. The first weld is
+reached with a moveToPoint, which lifts Z all the way from wherever it is.
+
+    python -m welder.motion --welded-rows 4
+
+compares the blended stream with weldAt on the simulator, per weld and for the pack.
+"""
+import argparse
+import math
+
+from . import firmware as fw
+from . import planner
+from .geometry import DEFAULT_LAYOUT, layout
+
+# Lowest Z (Z grows downwards) at which X/Y may move, a quarter of the stepdown below the
+# travel height; the electrodes clear the cell tops above it
+CLEARANCE = fw.Z_ZERO + fw.Z_STEPDOWN / 4
+
+
+def zTime(steps, profile=fw.DEFAULT_PROFILE):
+    return planner.axisTime(steps, profile.zSpeed, profile.zAcceleration)
+
+
+# (dx, dy) for xyWaitWithin on the move from a to b: where X and Y are when the time
+# left of the move equals the time Z takes from the travel height down to clearance,
+# with the speeds and accelerations of profile (fw.Profile)
+def gate(a, b, clearance=CLEARANCE, profile=fw.DEFAULT_PROFILE):
+    xSteps = int(round(abs(b[0] - a[0]) * fw.X_MULTIPLIER))
+    ySteps = int(round(abs(b[1] - a[1]) * fw.Y_MULTIPLIER))
+    total = max(planner.xTime(xSteps, profile), planner.yTime(ySteps, profile))
+    start = max(0.0, total - zTime(int(round(abs(clearance - fw.Z_ZERO) * fw.Z_MULTIPLIER)), profile))
+    dx = xSteps - fw.moveProgress(start, xSteps, profile.xSpeed, profile.xAcceleration)
+    dy = ySteps - fw.moveProgress(start, ySteps, profile.ySpeed, profile.yAcceleration)
+    # In the units GetDistanceToGo reports, rounded up so the gate always opens
+    return math.ceil(dx * fw.X_MULTIPLIER), math.ceil(dy * fw.Y_MULTIPLIER)
+
+
+# Commands for each weld of order, a list per weld, gated for profile (the firmware's
+# defaults if None)
+def blendedCommands(geometry, order, clearance=CLEARANCE, profile=None):
+    profile = profile or fw.DEFAULT_PROFILE
+    groups = []
+    previous = None
+    for row, cell, side in order:
+        x, y = geometry.point(row, cell, side)
+        plunge = f"zPlunge {clearance:.0f}_{row}_{cell}_{side}"
+        if previous is None:
+            groups.append([f"moveToPoint {x:.2f}_{y:.2f}_{row}_{cell}_{side}", plunge])
+        else:
+            dx, dy = gate(previous, (x, y), clearance, profile)
+            groups.append([f"xMoveTo {x:.2f}", f"yMoveTo {y:.2f}", f"xyWaitWithin {dx}_{dy}",
+                           f"zMoveTo {clearance:.0f}", plunge])
+        previous = (x, y)
+    return groups
+
+
+# PlanRunner command for order: the commands of a weld by its (row, cell, side)
+def blendedCommand(geometry, order, clearance=CLEARANCE, profile=None):
+    groups = dict(zip(order, blendedCommands(geometry, order, clearance, profile)))
+    return lambda row, cell, side: groups[row, cell, side]
+
+
+# Run the blended stream for order on sim, sending each command as the host would
+def streamBlended(sim, order, geometry, clearance=CLEARANCE, profile=None):
+    for commands in blendedCommands(geometry, order, clearance, profile):
+        for command in commands:
+            sim.advance((len(command) + 1) * 10.0 / sim.baud)
+            cmd, _, cmd2 = command.partition(" ")
+            sim.parseCommand(cmd, cmd2)
+
+
+# Seconds to weld order with weldAt and with the blended stream
+def compare(order, geometry, clearance=CLEARANCE):
+    packType = fw.PACK_TYPES.get(geometry.packType, fw.PT_A)
+    sim = planner.alignedSimulator(packType, geometry)
+    planner.streamOrder(sim, order, geometry)
+    sequential = sim.now
+    sim = planner.alignedSimulator(packType, geometry)
+    streamBlended(sim, order, geometry, clearance)
+    return sequential, sim.now
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m welder.motion", description="Compare blended moves with weldAt on the simulator.")
+    parser.add_argument("--layout", default=DEFAULT_LAYOUT, help="pack layout from layouts.json")
+    parser.add_argument("--welded-rows", type=int, default=0, help="rows already welded, as after a resume")
+    parser.add_argument("--clearance", type=float, default=CLEARANCE, help="lowest Z at which X/Y may move")
+    args = parser.parse_args()
+
+    geometry = layout(args.layout)
+    if not fw.Z_ZERO <= args.clearance <= fw.Z_ZERO + fw.Z_STEPDOWN:
+        raise SystemExit(f"Clearance must be between the travel height {fw.Z_ZERO} and the weld depth {fw.Z_ZERO + fw.Z_STEPDOWN}")
+    remaining = [(row, cell, side) for row in range(args.welded_rows, geometry.rows)
+                 for cell in range(geometry.cells) for side in range(geometry.sides)]
+    if not remaining:
+        raise SystemExit("Nothing left to weld")
+    order = planner.planOrder(remaining, geometry=geometry)
+    sequential, blended = compare(order, geometry, args.clearance)
+    travel = planner.pathTime([geometry.point(*cell) for cell in order])
+    print(f"{len(order)} welds, clearance Z {args.clearance:.0f}, {travel / len(order):.3f} s of X/Y travel per weld")
+    print(f"weldAt:  {sequential / 60:7.2f} min, {sequential / len(order):.3f} s per weld")
+    print(f"blended: {blended / 60:7.2f} min, {blended / len(order):.3f} s per weld "
+          f"({(1 - blended / sequential) * 100:.1f}% faster, {(sequential - blended) / 60:.2f} min saved)")
+
+
+if __name__ == "__main__":
+    main()
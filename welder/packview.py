@@ -0,0 +1,272 @@
+"""Pack viewer drawn on a single Tk canvas.
+
+Each weld point is one canvas item (a half circle per cell side), so opening the
+viewer, resetting it and applying progress updates only touch the items that
+change. Cells are placed from the pack geometry's coordinate tables, rows down and
+cells across, and clicks are mapped back to (row, cell, side) with
+PackGeometry.locate(). The window is created once and hidden instead of destroyed
+when closed.
+
+Besides the single cell a click moves the head to, weld points can be gathered into
+a batch: drag a box over them (with Shift to add to the batch), Ctrl-click one, or
+add the clicked cell's row, or only its unwelded points, with the buttons below. The
+batch is handed to onBatch and welded as one job; each point leaves the batch as its
+progress comes in, so what is left after a stop is still selected.
+"""
+import tkinter as tk
+import customtkinter as ctk
+
+BACKGROUND = "#08003A"
+UNWELDED = "#2DB84D"
+WELDED = "#D9352B"
+SELECTED = "#FFD400"
+BATCH = "#00B4FF"
+
+# Width of one cell side and height of one row, in pixels; the layout's cell and row
+# pitch are scaled to these
+HALF = 14
+ROW = 26
+RADIUS = 11
+MARGIN = 10
+# Pixels the pointer must move with the button down before a click becomes a drag
+DRAG_THRESHOLD = 4
+
+
+class PackViewer:
+    # onSelect(row, cell, side) is called for clicks and returns True if the machine took
+    # the selection, onWeld() is called for the space bar and onReset() for the reset
+    # button. onBatch([(row, cell, side)]) is called to weld the batch and returns True
+    # if it took the batch; the job may start later, once it is planned. isWelded(row, cell, side) is read whenever the cells are drawn.
+    def __init__(self, root, geometry, isWelded, onSelect, onWeld, onReset, onBatch=None):
+        self.root = root
+        self.geometry = geometry
+        self.isWelded = isWelded
+        self.onSelect = onSelect
+        self.onWeld = onWeld
+        self.onBatch = onBatch
+        self.selected = None
+        # Weld points gathered for a batch job, and the drag in progress:
+        # (start x, start y, rubber band item or None)
+        self.batch = set()
+        self.drag = None
+
+        self.window = ctk.CTkToplevel(root, fg_color=BACKGROUND)
+        self.window.title("Pack Viewer")
+        self.window.protocol("WM_DELETE_WINDOW", self.window.withdraw)
+        self.window.bind("<space>", onWeld)
+
+        self.canvas = tk.Canvas(self.window, bg=BACKGROUND, highlightthickness=0)
+        self.canvas.pack(side=tk.TOP, padx=10, pady=10)
+        self.canvas.bind("<ButtonPress-1>", self.press)
+        self.canvas.bind("<B1-Motion>", self.motion)
+        self.canvas.bind("<ButtonRelease-1>", self.release)
+        self.canvas.bind("<Control-ButtonPress-1>", self.toggle)
+
+        self.footer = ctk.CTkFrame(self.window, fg_color=BACKGROUND)
+        self.footer.pack(side=tk.BOTTOM, fill=tk.X, expand=True, padx=10, pady=10)
+        self.batchFrame = ctk.CTkFrame(self.footer, fg_color=BACKGROUND)
+        self.batchFrame.pack(side=tk.TOP)
+        for text, command in (("Row", lambda: self.addRow(False)), ("Unwelded in Row", lambda: self.addRow(True)),
+                              ("Clear", self.clearBatch)):
+            button = ctk.CTkButton(self.batchFrame, text=text, command=command, corner_radius=999, width=50, height=25)
+            button.pack(side=tk.LEFT, padx=5)
+        self.weldBatchButton = ctk.CTkButton(self.batchFrame, text="Weld Selected", command=self.weldBatch, state=tk.DISABLED,
+                                             corner_radius=999, width=50, height=25)
+        self.weldBatchButton.pack(side=tk.LEFT, padx=5)
+        self.reset = ctk.CTkButton(self.footer, text="Reset", command=onReset, corner_radius=999, width=50, height=25)
+        self.reset.pack(side=tk.TOP, padx=10, pady=10)
+
+        # One item per weld point, in weld mask order
+        self.items = []
+        self.draw()
+
+    ########################################################################
+    # Layout
+    # Canvas scale and the machine position at the top left weld point
+    def scale(self):
+        minX, minY, maxX, maxY = self.geometry.bounds()
+        self.scaleX = ROW / self.geometry.rowPitch
+        self.scaleY = 2 * HALF / self.geometry.cellPitch
+        self.top = minX
+        self.left = minY + self.geometry.weldSpace / 2
+        width = 2 * MARGIN + (maxY - minY - self.geometry.weldSpace) * self.scaleY + 2 * HALF
+        height = 2 * MARGIN + (maxX - minX) * self.scaleX + ROW
+        self.canvas.configure(width=width, height=height)
+
+    def draw(self):
+        self.scale()
+        self.canvas.delete("cell")
+        self.items = []
+        rows, cells, sides = self.geometry.shape
+        for row in range(rows):
+            for cell in range(cells):
+                for side in range(sides):
+                    color = WELDED if self.isWelded(row, cell, side) else UNWELDED
+                    item = self.canvas.create_arc(self.bbox(row, cell, side), start=90 if side == 0 else -90, extent=180,
+                                                  style=tk.PIESLICE, fill=color, outline=color, tags=("cell",))
+                    self.items.append(item)
+        if self.selected is not None and not self.geometry.contains(*self.selected):
+            self.selected = None
+        self.select(self.selected)
+        self.batch = {point for point in self.batch if self.geometry.contains(*point)}
+        for point in self.batch:
+            self.outline(point)
+        self.showBatchCount()
+
+    def bbox(self, row, cell, side):
+        x, y = self.geometry.centre(row, cell)
+        centreX = MARGIN + HALF + (y - self.left) * self.scaleY + (1 if side else -1)
+        centreY = MARGIN + ROW / 2 + (x - self.top) * self.scaleX
+        return centreX - RADIUS, centreY - RADIUS, centreX + RADIUS, centreY + RADIUS
+
+    # Show another layout, moving the existing items if it has the same shape
+    def setGeometry(self, geometry):
+        if geometry is self.geometry:
+            return
+        sameShape = geometry.shape == self.geometry.shape
+        self.geometry = geometry
+        if not sameShape:
+            self.batch.clear()
+            self.draw()
+            return
+        self.scale()
+        rows, cells, sides = geometry.shape
+        for row in range(rows):
+            for cell in range(cells):
+                for side in range(sides):
+                    self.canvas.coords(self.item(row, cell, side), *self.bbox(row, cell, side))
+
+    def item(self, row, cell, side):
+        return self.items[self.geometry.index(row, cell, side)]
+
+    # Map a canvas position to (row, cell, side), or None outside the pack
+    def hitTest(self, x, y):
+        machineX = self.top + (y - MARGIN - ROW / 2) / self.scaleX
+        machineY = self.left + (x - MARGIN - HALF) / self.scaleY
+        return self.geometry.locate(machineX, machineY)
+
+    ########################################################################
+    # Updates
+    def show(self, geometry=None):
+        if geometry is not None:
+            self.setGeometry(geometry)
+        self.window.deiconify()
+        self.window.lift()
+        self.window.focus_set()
+
+    def isVisible(self):
+        return bool(self.window.winfo_ismapped())
+
+    # A weld point welded (or welded again) leaves the batch
+    def setWelded(self, row, cell, side, welded=True):
+        color = WELDED if welded else UNWELDED
+        self.canvas.itemconfigure(self.item(row, cell, side), fill=color)
+        if welded and (row, cell, side) in self.batch:
+            self.batch.discard((row, cell, side))
+            self.showBatchCount()
+        self.outline((row, cell, side))
+
+    def resetAll(self):
+        self.canvas.itemconfigure("cell", fill=UNWELDED, outline=UNWELDED, width=1)
+        self.select(self.selected)
+        for point in self.batch:
+            self.outline(point)
+
+    # Outline a weld point as selected, in the batch or in its own colour
+    def outline(self, point):
+        item = self.item(*point)
+        if point == self.selected:
+            self.canvas.itemconfigure(item, outline=SELECTED, width=2)
+        elif point in self.batch:
+            self.canvas.itemconfigure(item, outline=BATCH, width=2)
+        else:
+            self.canvas.itemconfigure(item, outline=self.canvas.itemcget(item, "fill"), width=1)
+
+    def select(self, cell):
+        previous, self.selected = self.selected, cell
+        if previous is not None:
+            self.outline(previous)
+        if cell is not None:
+            self.outline(cell)
+
+    def click(self, event):
+        cell = self.hitTest(event.x, event.y)
+        if cell is None:
+            return
+        if self.onSelect(*cell):
+            self.select(cell)
+
+    ########################################################################
+    # Batch
+    def setBatch(self, points):
+        previous, self.batch = self.batch, set(points)
+        for point in previous ^ self.batch:
+            self.outline(point)
+        self.showBatchCount()
+
+    def showBatchCount(self):
+        count = len(self.batch)
+        self.weldBatchButton.configure(text=f"Weld Selected ({count})" if count else "Weld Selected",
+                                       state=tk.NORMAL if count and self.onBatch is not None else tk.DISABLED)
+
+    def clearBatch(self):
+        self.setBatch(())
+
+    # Add the row of the clicked cell, or only its unwelded points
+    def addRow(self, unwelded):
+        if self.selected is None:
+            return
+        row = self.selected[0]
+        rows, cells, sides = self.geometry.shape
+        points = [(row, cell, side) for cell in range(cells) for side in range(sides)]
+        self.setBatch(self.batch.union(point for point in points if not (unwelded and self.isWelded(*point))))
+
+    def toggle(self, event):
+        point = self.hitTest(event.x, event.y)
+        if point is not None:
+            self.setBatch(self.batch ^ {point})
+
+    def weldBatch(self):
+        if self.batch and self.onBatch is not None:
+            self.onBatch(sorted(self.batch))
+
+    # A press becomes a click on release, or a drag once the pointer moves
+    def press(self, event):
+        self.drag = (event.x, event.y, None)
+
+    def motion(self, event):
+        if self.drag is None:
+            return
+        x, y, band = self.drag
+        if band is None:
+            if abs(event.x - x) < DRAG_THRESHOLD and abs(event.y - y) < DRAG_THRESHOLD:
+                return
+            band = self.canvas.create_rectangle(x, y, x, y, outline=BATCH, dash=(4, 2), tags=("band",))
+            self.drag = (x, y, band)
+        self.canvas.coords(band, x, y, event.x, event.y)
+
+    # The points whose centres are inside the box join the batch, replacing it unless
+    # Shift is held
+    def release(self, event):
+        if self.drag is None:
+            return
+        x, y, band = self.drag
+        self.drag = None
+        if band is None:
+            self.click(event)
+            return
+        self.canvas.delete(band)
+        left, right = sorted((x, event.x))
+        top, bottom = sorted((y, event.y))
+        rows, cells, sides = self.geometry.shape
+        inside = []
+        for row in range(rows):
+            for cell in range(cells):
+                for side in range(sides):
+                    x0, y0, x1, y1 = self.bbox(row, cell, side)
+                    # The middle of the half circle drawn for this side
+                    centreX = (x0 + x1) / 2 + (RADIUS / 2 if side else -RADIUS / 2)
+                    if left <= centreX <= right and top <= (y0 + y1) / 2 <= bottom:
+                        inside.append((row, cell, side))
+        shift = event.state & 0x1
+        self.setBatch(self.batch.union(inside) if shift else inside)
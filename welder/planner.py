@@ -0,0 +1,287 @@
+"""Travel-optimised weld order for runPack.
+
+runPack always sweeps every row twice in a fixed pattern, with a retract, a half
+stepover and a 3 s wait between rows, even when most cells are already welded after a
+resume. planOrder() orders just the cells that are left so the time spent moving
+between them is minimal, weighing each move with the per-axis trapezoidal profiles
+(X and Y move together, so a move costs the slower of the two). Weld points come from
+the pack layout (geometry.py). PlanRunner streams the order to the machine as weldAt
+commands with absolute positions, so any layout can be welded.
+
+    python -m welder.planner --type A --welded-rows 5
+
+compares the planned order against the fixed pattern on the simulator.
+"""
+import argparse
+import functools
+import math
+import random
+import time
+
+from . import firmware as fw
+from .geometry import layoutFor
+from .simulator import WelderSimulator
+from .weldmask import WeldMask
+
+# Time budget for improving the nearest-neighbour order with 2-opt, in seconds
+IMPROVE_TIME = 0.5
+# Candidate neighbours per weld point considered by 2-opt
+NEIGHBOURS = 8
+
+
+def allCells(rows=fw.PACK_ROWS, cells=fw.PACK_CELLS, sides=fw.PACK_SIDES):
+    return [(row, cell, side) for row in range(rows) for cell in range(cells) for side in range(sides)]
+
+
+@functools.lru_cache(maxsize=None)
+def axisTime(steps, maxSpeed, acceleration):
+    return fw.moveTime(steps, maxSpeed, acceleration)
+
+
+# Move times with the speeds and accelerations of profile (fw.Profile)
+def xTime(steps, profile=fw.DEFAULT_PROFILE):
+    return axisTime(steps, profile.xSpeed, profile.xAcceleration)
+
+
+def yTime(steps, profile=fw.DEFAULT_PROFILE):
+    return axisTime(steps, profile.ySpeed, profile.yAcceleration)
+
+
+# Time to move the head between two X/Y targets with both axes running at once
+def travelTime(a, b, profile=fw.DEFAULT_PROFILE):
+    return max(xTime(int(round(abs(a[0] - b[0]) * fw.X_MULTIPLIER)), profile),
+               yTime(int(round(abs(a[1] - b[1]) * fw.Y_MULTIPLIER)), profile))
+
+
+def pathTime(points, profile=fw.DEFAULT_PROFILE):
+    return sum(travelTime(points[i], points[i + 1], profile) for i in range(len(points) - 1))
+
+
+# Order cells (row, cell, side) for minimum travel time starting from start (the first
+# cell of the pack by default, where align() leaves the head). geometry defaults to
+# the layout of packType; travel is timed with profile, the firmware's defaults if None.
+def planOrder(cells, packType=fw.PT_A, start=None, improveTime=IMPROVE_TIME, geometry=None, profile=None):
+    cells = list(cells)
+    if len(cells) < 2:
+        return cells
+    geometry = geometry or layoutFor(packType)
+    profile = profile or fw.DEFAULT_PROFILE
+    points = [start or geometry.centre(0, 0)] + [geometry.point(row, cell, side) for row, cell, side in cells]
+    count = len(points)
+
+    # Nearest neighbour from the start point, collecting neighbour lists on the way
+    neighbours = []
+    for i in range(count):
+        costs = sorted((travelTime(points[i], points[j], profile), j) for j in range(1, count) if j != i)
+        neighbours.append([j for cost, j in costs[:NEIGHBOURS]])
+    order = [0]
+    left = set(range(1, count))
+    while left:
+        here = points[order[-1]]
+        nearest = next((j for j in neighbours[order[-1]] if j in left), None)
+        if nearest is None:
+            nearest = min(left, key=lambda j: travelTime(here, points[j], profile))
+        order.append(nearest)
+        left.remove(nearest)
+
+    order = improve(order, points, neighbours, improveTime, profile)
+    return [cells[i - 1] for i in order[1:]]
+
+
+# cells in the order runPack welds them: row by row, side 0 along the row and side 1 back
+def patternOrder(cells):
+    return sorted(cells, key=lambda weld: (weld[0], weld[2], weld[1] if weld[2] == 0 else -weld[1]))
+
+
+# 2-opt on an open path with a fixed first point, restricted to neighbour candidates
+def improve(order, points, neighbours, improveTime=IMPROVE_TIME, profile=fw.DEFAULT_PROFILE):
+    def cost(i, j):
+        return travelTime(points[i], points[j], profile)
+
+    count = len(order)
+    position = [0] * count
+    for index, node in enumerate(order):
+        position[node] = index
+    deadline = time.monotonic() + improveTime
+    improved = True
+    while improved and time.monotonic() < deadline:
+        improved = False
+        for i in range(count - 1):
+            a, b = order[i], order[i + 1]
+            for c in neighbours[a]:
+                j = position[c]
+                if j <= i + 1:
+                    continue
+                d = order[j + 1] if j + 1 < count else None
+                before = cost(a, b) + (cost(c, d) if d is not None else 0)
+                after = cost(a, c) + (cost(b, d) if d is not None else 0)
+                if after < before - 1e-9:
+                    order[i + 1:j + 1] = reversed(order[i + 1:j + 1])
+                    for index in range(i + 1, j + 1):
+                        position[order[index]] = index
+                    improved = True
+                    break
+    return order
+
+
+########################################################################
+# Cycle time prediction on the simulator
+
+def weldedMask(remaining, rows=fw.PACK_ROWS, cells=fw.PACK_CELLS):
+    welded = WeldMask(rows, cells)
+    welded.fill()
+    for cell in remaining:
+        welded[cell] = 0
+    return welded
+
+
+# Simulator (a new one, or sim) set up for the layout with the head at the first cell,
+# running profile (fw.Profile) when given
+def alignedSimulator(packType, geometry, sim=None, profile=None):
+    sim = sim or WelderSimulator(speed=math.inf)
+    sim.setup()
+    if profile is not None:
+        sim.applyProfile(profile)
+    sim.packType = packType
+    sim.packRows = geometry.rows
+    sim.packCells = geometry.cells
+    sim.align(packType)
+    sim.now = 0.0
+    return sim
+
+
+# Time runPack takes to weld the remaining cells with its fixed pattern
+def baselineTime(remaining, packType=fw.PT_A, geometry=None, profile=None):
+    geometry = geometry or layoutFor(packType)
+    sim = alignedSimulator(packType, geometry, profile=profile)
+    bits = weldedMask(remaining, geometry.rows, geometry.cells).bits
+    sim.welded[:len(bits)] = bits
+    sim.runPack(2, packType)
+    return sim.now
+
+
+# Time to stream the given order as weldAt commands, including sending each command
+def streamTime(order, packType=fw.PT_A, geometry=None, profile=None):
+    geometry = geometry or layoutFor(packType)
+    sim = alignedSimulator(packType, geometry, profile=profile)
+    streamOrder(sim, order, geometry)
+    return sim.now
+
+
+# Weld order on sim as the host streams it, one weldAt command at a time
+def streamOrder(sim, order, geometry):
+    for row, cell, side in order:
+        sim.advance((len(weldAtCommand(geometry, row, cell, side)) + 1) * 10.0 / sim.baud)
+        sim.weldAt(*geometry.point(row, cell, side), row, cell, side)
+
+
+# Commands that weld one cell of an order and answer "ok" when it is done
+WELD_COMMANDS = ("weldCell", "weldAt", "zPlunge")
+
+
+def weldCellCommand(row, cell, side):
+    return f"weldCell {row}_{cell}_{side}"
+
+
+# Weld at the cell's position from the layout, for packs the firmware has no pattern for
+def weldAtCommand(geometry, row, cell, side):
+    x, y = geometry.point(row, cell, side)
+    return f"weldAt {x:.2f}_{y:.2f}_{row}_{cell}_{side}"
+
+
+########################################################################
+class PlanRunner:
+    # Streams a weld order through send (e.g. CommandQueue.send) and advances on the
+    # "ok" of each weld. command(row, cell, side) makes the text, weldCell by default,
+    # or a list of commands ending in the weld. lookahead welds are sent ahead of the one
+    # running, so the firmware has the next commands as soon as a weld ends. Pausing
+    # holds the next weld back; the firmware handles a pause sent mid-weld. A weld the
+    # firmware rejects ends the run, with error set.
+    def __init__(self, send, order, command=weldCellCommand, lookahead=0):
+        self.send = send
+        self.command = command
+        self.order = list(order)
+        self.lookahead = lookahead
+        self.index = 0
+        self.sent = 0
+        self.active = False
+        self.paused = False
+        self.error = None
+
+    @property
+    def inFlight(self):
+        return self.sent > self.index
+
+    def start(self):
+        self.active = True
+        self.paused = False
+        self._sendNext()
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+        if self.active:
+            self._sendNext()
+
+    def stop(self):
+        self.active = False
+
+    def remaining(self):
+        return self.order[self.index:]
+
+    # Feed a reader Event; returns True once the last cell has been welded, or once a
+    # weld was rejected (error says which)
+    def handleEvent(self, event):
+        if not self.active:
+            return False
+        if event.kind == "estop":
+            self.active = False
+        elif event.kind == "err" and event.args[0] in WELD_COMMANDS and self.inFlight:
+            self.active = False
+            self.error = f"Firmware rejected {event.args[0]} for {'_'.join(map(str, self.order[self.index]))}"
+            return True
+        elif event.kind == "ok" and event.args[0] in WELD_COMMANDS and self.inFlight:
+            self.index += 1
+            if self.index >= len(self.order):
+                self.active = False
+                return True
+            self._sendNext()
+        return False
+
+    def _sendNext(self):
+        if self.index >= len(self.order):
+            self.active = False
+            return
+        while not self.paused and self.sent < len(self.order) and self.sent - self.index <= self.lookahead:
+            commands = self.command(*self.order[self.sent])
+            for command in [commands] if isinstance(commands, str) else commands:
+                self.send(command)
+            self.sent += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare a travel-optimised weld order against runPack.")
+    parser.add_argument("--type", choices=sorted(fw.PACK_TYPES), default="A", help="pack type")
+    parser.add_argument("--welded-rows", type=int, default=0, help="rows already welded, as after a resume")
+    parser.add_argument("--welded-fraction", type=float, default=0.0, help="fraction of other sides already welded")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    packType = fw.PACK_TYPES[args.type]
+    rng = random.Random(args.seed)
+    remaining = [(row, cell, side) for row, cell, side in allCells()
+                 if row >= args.welded_rows and rng.random() >= args.welded_fraction]
+    start = time.monotonic()
+    order = planOrder(remaining, packType)
+    planning = time.monotonic() - start
+    baseline = baselineTime(remaining, packType)
+    planned = streamTime(order, packType)
+    print(f"{len(remaining)} welds left, planned in {planning * 1000:.0f} ms")
+    print(f"runPack pattern: {baseline / 60:7.2f} min")
+    print(f"planned order:   {planned / 60:7.2f} min ({(1 - planned / baseline) * 100 if baseline else 0:.1f}% faster)")
+
+
+if __name__ == "__main__":
+    main()
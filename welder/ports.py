@@ -0,0 +1,156 @@
+"""Serial port discovery: which port the welder is on, and when it comes back.
+
+probe() opens a port at the firmware's text baud rate and pings it until it answers
+pong. Opening the port resets the Nano, which takes a couple of seconds to boot, and
+firmware left in frames only falls back to text after LINK_TIMEOUT, so a probe can
+take PROBE_TIMEOUT. findWelder() therefore probes every candidate at once, on a thread
+each, and answers with the first port that pongs.
+
+PortMonitor watches the port list on a background thread, so adapters plugged in or
+out show up without a refresh. While its client is disconnected with autoConnect set,
+it probes the USB serial ports (and any extra ones given, such as the simulator's)
+and posts Event("found", (port,)) to the client's event queue; the client connects on
+its poll thread. The port the client is reconnecting to itself is left alone.
+
+    python -m welder.ports
+    python -m welder.ports --sequential /tmp/weldsim
+
+lists the ports, probes them and prints how long it took.
+"""
+import argparse
+import concurrent.futures
+import threading
+import time
+
+import serial
+
+from . import firmware as fw
+from .reader import READ_TIMEOUT, Event
+
+# Seconds between scans of the port list
+SCAN_INTERVAL = 1.0
+# Longest a probe waits for pong, and the time between its pings
+PROBE_TIMEOUT = 3.0
+PROBE_PING = 0.25
+
+
+# [(device, description, USB)] of the serial ports, USB adapters first. Only USB
+# adapters are probed without being asked, Bluetooth and built-in ports could be anything.
+def listPorts():
+    import serial.tools.list_ports
+    ports = [(port.device, port.description, port.vid is not None) for port in serial.tools.list_ports.comports()]
+    return sorted(ports, key=lambda port: (not port[2], port[0]))
+
+
+# True if the welder's firmware answers a ping on port within timeout
+def probe(port, baud=fw.BAUD, timeout=PROBE_TIMEOUT, cancelled=None):
+    try:
+        with serial.Serial(port, baud, timeout=READ_TIMEOUT) as ser:
+            deadline = time.monotonic() + timeout
+            received = b""
+            while time.monotonic() < deadline and not (cancelled is not None and cancelled.is_set()):
+                ser.write(b"ping\n")
+                nextPing = min(deadline, time.monotonic() + PROBE_PING)
+                while time.monotonic() < nextPing:
+                    received = (received + ser.read(max(1, ser.in_waiting)))[-64:]
+                    if b"pong" in received:
+                        return True
+    except (serial.SerialException, OSError, ValueError):
+        pass
+    return False
+
+
+# The first of ports whose firmware answers, probed in parallel, or None
+def findWelder(ports, baud=fw.BAUD, timeout=PROBE_TIMEOUT, cancelled=None):
+    if not ports:
+        return None
+    # The other probes give up as soon as one port answers
+    done = threading.Event()
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(ports))
+    try:
+        futures = {pool.submit(probe, port, baud, timeout, done): port for port in ports}
+        for future in concurrent.futures.as_completed(futures):
+            if future.result():
+                return futures[future]
+            if cancelled is not None and cancelled.is_set():
+                return None
+        return None
+    finally:
+        done.set()
+        pool.shutdown(wait=True)
+
+
+class PortMonitor(threading.Thread):
+    # Calls onPorts([device]) from the monitor thread whenever the port list changes, and
+    # connects client (see above) when given. extra ports are probed as well.
+    def __init__(self, client=None, onPorts=None, extra=(), interval=SCAN_INTERVAL):
+        super().__init__(daemon=True)
+        self.client = client
+        self.onPorts = onPorts
+        self.extra = list(extra)
+        self.interval = interval
+        self.ports = None
+        self._stopping = threading.Event()
+        self._wake = threading.Event()
+
+    # Scan again now, e.g. for a refresh button
+    def rescan(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()
+
+    def run(self):
+        while not self._stopping.is_set():
+            try:
+                ports = listPorts()
+            except Exception as error:
+                print(f"Could not list ports: {error}")
+                ports = []
+            devices = [device for device, description, usb in ports]
+            if devices != self.ports:
+                self.ports = devices
+                if self.onPorts is not None:
+                    self.onPorts(devices)
+            if self._wanted():
+                candidates = [device for device, description, usb in ports if usb]
+                candidates += [port for port in self.extra if port not in candidates]
+                candidates = [port for port in candidates if port != self.client.port]
+                found = findWelder(candidates, cancelled=self._stopping)
+                if found is not None and self._wanted():
+                    self.client.events.put(Event("found", (found,), "", time.monotonic()))
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    # Reading the client's state from here is only a hint, the client checks again
+    def _wanted(self):
+        client = self.client
+        return client is not None and client.autoConnect and not client.isConnected()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m welder.ports", description="Find the welder among the serial ports.")
+    parser.add_argument("ports", nargs="*", help="ports to probe besides the USB serial ports")
+    parser.add_argument("--baud", type=int, default=fw.BAUD)
+    parser.add_argument("--timeout", type=float, default=PROBE_TIMEOUT, help="seconds a probe waits for pong")
+    parser.add_argument("--sequential", action="store_true", help="also probe one port after the other, for comparison")
+    args = parser.parse_args()
+
+    ports = listPorts()
+    for device, description, usb in ports:
+        print(f"{device:24s} {description}" + ("" if usb else " (not USB, not probed)"))
+    candidates = [device for device, description, usb in ports if usb] + args.ports
+    if not candidates:
+        raise SystemExit("No ports to probe")
+    began = time.monotonic()
+    found = findWelder(candidates, args.baud, args.timeout)
+    print(f"Parallel: {found or 'no welder'} after {time.monotonic() - began:.2f} s, {len(candidates)} ports")
+    if args.sequential:
+        began = time.monotonic()
+        found = next((port for port in candidates if probe(port, args.baud, args.timeout)), None)
+        print(f"One after the other: {found or 'no welder'} after {time.monotonic() - began:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""Framed binary protocol between the host and the firmware.
+
+The firmware boots in the text protocol at 9600 baud. `binary <baud>` answers
+`ok binary` in text, then switches both the baud rate and the framing; if no valid
+frame arrives for LINK_TIMEOUT ms it falls back to text at 9600 on its own, so a host
+that can't follow (or goes away) loses nothing. Old firmware answers `err binary` and
+the link stays in text.
+
+Every frame in either direction is
+
+    SYNC | length | seq | type | payload (length bytes) | crc16 (little endian)
+
+with a CRC-16/CCITT over length, seq, type and payload. A corrupted frame is dropped
+and the decoder resyncs on the next SYNC byte; the per-direction sequence number
+tells the host that frames were lost, so it can ask for the weld mask again.
+
+The host sends commands as their usual text in F_COMMAND frames and pings with
+F_PING. The firmware answers commands with F_ACK (the command's seq and 1 for ok, 0
+for err) and reports progress, status (with the axis positions on idle/moving),
+finished moves and the weld mask in their own compact frames. Anything else it
+prints, such as query results, goes out as F_TEXT; debug lines are not sent.
+"""
+import struct
+
+from .reader import Event, axesEvent, parseLine
+
+SYNC = 0xA5
+MAX_PAYLOAD = 120
+# sync, length, seq, type
+HEADER = struct.Struct("<BBBB")
+CRC = struct.Struct("<H")
+FRAME_OVERHEAD = HEADER.size + CRC.size
+# Baud rate asked for by default; 16 MHz AVRs hit 115200 within 2.1%
+BINARY_BAUD = 115200
+# Firmware falls back to text after this long without a valid frame, in ms
+LINK_TIMEOUT = 2000
+
+# Frame types, host to firmware
+F_COMMAND = 0x01  # command text
+F_PING = 0x02  # answered with ST_PONG
+# Frame types, firmware to host
+F_ACK = 0x10  # seq of the command, 1 ok / 0 err
+F_PROGRESS = 0x11  # row, side, cell
+F_STATUS = 0x12  # status code, then x, y, z as int32 for idle and moving
+F_DONE = 0x13  # axis letter
+F_WELDS = 0x14  # weld mask, same layout as getWelds
+F_TEXT = 0x15  # any other line
+F_AXES = 0x16  # x, y, z positions then targets as int32, running bits, the answer to status
+
+# Status codes, the firmware's text line for each and the event kind they map to
+ST_IDLE, ST_MOVING, ST_PAUSED, ST_FINISHED, ST_ESTOP, ST_PONG = range(6)
+STATUS_TEXT = ("idle", "moving", "paused", "finished", "ESTOP", "pong")
+STATUS_KINDS = ("idle", "moving", "paused", "finished", "estop", "pong")
+POSITION = struct.Struct("<lll")
+AXES = struct.Struct("<llllllB")
+
+
+def _crcTable():
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for bit in range(8):
+            crc = ((crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1) & 0xFFFF
+        table.append(crc)
+    return table
+
+
+CRC_TABLE = _crcTable()
+
+
+# CRC-16/CCITT-FALSE
+def crc16(data, crc=0xFFFF):
+    table = CRC_TABLE
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ byte]
+    return crc
+
+
+def encodeFrame(seq, kind, payload=b""):
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError(f"Frame payload too long ({len(payload)} bytes)")
+    header = HEADER.pack(SYNC, len(payload), seq & 0xFF, kind)
+    return header + payload + CRC.pack(crc16(payload, crc16(header[1:])))
+
+
+class FrameEncoder:
+    # Frames commands from the host and remembers which command each seq carried, so
+    # acknowledgements can be reported by name like in the text protocol
+    def __init__(self):
+        self.seq = 0
+        self.names = {}
+
+    def encode(self, text):
+        self.seq = (self.seq + 1) & 0xFF
+        if text == "ping":
+            return encodeFrame(self.seq, F_PING)
+        name, _, argument = text.partition(" ")
+        self.names[self.seq] = name
+        if name == "setWelds":
+            # The mask as hex text is too long for one frame, send the bytes
+            return encodeFrame(self.seq, F_WELDS, bytes.fromhex(argument))
+        return encodeFrame(self.seq, F_COMMAND, text.encode("ascii"))
+
+
+class FrameDecoder:
+    # Parses frames in place from a fixed receive buffer. Bytes are appended at `end`
+    # and consumed from `start`; the unparsed tail is moved to the front only when the
+    # free space at the end runs out, so the buffer is never reallocated or sliced.
+    def __init__(self, encoder, capacity=4096):
+        self.encoder = encoder
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.expected = None
+        self.crcErrors = 0
+        self.lost = 0
+
+    def feed(self, data):
+        if len(data) > len(self.buffer) - self.end:
+            self._compact()
+            if len(data) > len(self.buffer) - self.end:
+                # More than a buffer of unparsable bytes, drop what we have
+                self.start = self.end = 0
+                data = data[-len(self.buffer):]
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def _compact(self):
+        size = self.end - self.start
+        self.buffer[:size] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = size
+
+    # Parse every complete frame, yielding Events
+    def events(self, stamp):
+        buffer = self.buffer
+        while True:
+            sync = buffer.find(SYNC, self.start, self.end)
+            if sync < 0:
+                self.start = self.end
+                return
+            self.start = sync
+            if self.end - sync < FRAME_OVERHEAD:
+                return
+            length = buffer[sync + 1]
+            end = sync + HEADER.size + length + CRC.size
+            if length > MAX_PAYLOAD:
+                self.start = sync + 1
+                continue
+            if end > self.end:
+                return
+            crc, = CRC.unpack_from(buffer, end - CRC.size)
+            if crc16(self.view[sync + 1:end - CRC.size]) != crc:
+                self.crcErrors += 1
+                self.start = sync + 1
+                continue
+            self.start = end
+            seq, kind = buffer[sync + 2], buffer[sync + 3]
+            if self.expected is not None and seq != self.expected:
+                missed = (seq - self.expected) & 0xFF
+                self.lost += missed
+                yield Event("gap", (missed,), f"# {missed} frames lost", stamp)
+            self.expected = (seq + 1) & 0xFF
+            event = self._event(kind, seq, self.view[sync + HEADER.size:end - CRC.size], stamp)
+            for item in event:
+                yield item
+
+    def _event(self, kind, seq, payload, stamp):
+        if kind == F_ACK and len(payload) == 2:
+            name = self.encoder.names.pop(payload[0], "?")
+            result = "ok" if payload[1] else "err"
+            return [Event(result, (name,), f"{result} {name}", stamp)]
+        if kind == F_PROGRESS and len(payload) == 3:
+            row, side, cell = payload
+            return [Event("progress", (row, cell, side), f"R{row} {side} {cell}", stamp)]
+        if kind == F_STATUS and len(payload) >= 1 and payload[0] < len(STATUS_KINDS):
+            status = STATUS_KINDS[payload[0]]
+            events = [Event(status, (), STATUS_TEXT[payload[0]], stamp)]
+            if len(payload) == 1 + POSITION.size:
+                position = POSITION.unpack_from(payload, 1)
+                events.append(Event("position", position, "# position %d %d %d" % position, stamp))
+            return events
+        if kind == F_DONE and len(payload) == 1:
+            axis = chr(payload[0])
+            return [Event("done", (axis,), "done " + axis, stamp)]
+        if kind == F_AXES and len(payload) == AXES.size:
+            values = AXES.unpack_from(payload)
+            return [axesEvent(values[:6], values[6], "S " + " ".join(map(str, values)), stamp)]
+        if kind == F_WELDS:
+            text = "W " + payload.hex().upper()
+            return [Event("welds", (text[2:],), text, stamp)]
+        if kind == F_TEXT:
+            event = parseLine(bytes(payload).decode("ascii", errors="replace"), stamp)
+            return [event] if event is not None else []
+        return [Event("line", (), f"# unknown frame {kind:#04x}", stamp)]
+
+
+class HostFrameDecoder(FrameDecoder):
+    # Decodes the frames the host wrote, e.g. from a recording: commands come out as
+    # "command" Events with the text that was framed, and their seq is registered with
+    # encoder so the firmware's acks decode by name
+    def _event(self, kind, seq, payload, stamp):
+        if kind == F_PING:
+            return [Event("ping", (), "ping", stamp)]
+        if kind == F_COMMAND:
+            text = bytes(payload).decode("ascii", errors="replace")
+        elif kind == F_WELDS:
+            text = "setWelds " + payload.hex().upper()
+        else:
+            return [Event("line", (), f"# unknown frame {kind:#04x}", stamp)]
+        name = text.split(" ", 1)[0]
+        self.encoder.names[seq] = name
+        return [Event("command", (name,), text, stamp)]
@@ -0,0 +1,295 @@
+"""Event-driven reader for the welder's serial output.
+
+A SerialReader thread blocks on the port and wakes as soon as bytes arrive. Every
+complete line is parsed into an Event and put on a queue; the GUI drains that queue
+from the Tk thread with root.after(), so no Tk call ever happens off the main thread.
+Once the link has switched to the framed protocol, bytes go to a
+protocol.FrameDecoder instead of being split into lines.
+
+    python -m welder.reader
+
+measures how many messages per second go through the parser, as text lines and as
+frames, for a stream like the firmware's during a pack.
+"""
+import argparse
+import collections
+import queue
+import threading
+import time
+
+import serial
+
+# Read timeout set on the port so the reader notices stop() without traffic
+READ_TIMEOUT = 0.1
+
+Event = collections.namedtuple("Event", ["kind", "args", "line", "time"])
+
+# Single-word status lines and the event kind they map to
+STATUS_LINES = {
+    "finished": "finished",
+    "paused": "paused",
+    "ESTOP": "estop",
+    "idle": "idle",
+    "moving": "moving",
+    "pong": "pong",
+}
+
+
+def _parseReply(line, stamp):
+    # Completion or rejection of a command, e.g. "ok weldCell"
+    kind, _, name = line.partition(" ")
+    if kind in ("ok", "err") and name:
+        return Event(kind, (name,), line, stamp)
+    return None
+
+
+def _parseWelds(line, stamp):
+    # Whole weld mask as hex, the answer to getWelds
+    if line.startswith("W "):
+        return Event("welds", (line[2:],), line, stamp)
+    return None
+
+
+def _parseDone(line, stamp):
+    # End of a non-blocking move on one axis
+    if line.startswith("done "):
+        return Event("done", (line[5:],), line, stamp)
+    return None
+
+
+def _parseProgress(line, stamp):
+    # R<row> <side> <cell> from a pack, R<pass> <cell> from runSeries18650
+    if not line[1:2].isdigit():
+        return None
+    fields = line[1:].split(" ")
+    if not all(field.isdigit() for field in fields):
+        return Event("malformed", (), line, stamp)
+    if len(fields) == 3:
+        row, side, cell = map(int, fields)
+        return Event("progress", (row, cell, side), line, stamp)
+    if len(fields) == 2:
+        return Event("line", (), line, stamp)
+    return Event("malformed", (), line, stamp)
+
+
+# positions and targets are x, y, z; running has bit 0 set for x, 1 for y, 2 for z
+def axesEvent(values, running, line, stamp):
+    flags = tuple(bool(running >> axis & 1) for axis in range(3))
+    return Event("axes", (tuple(values[:3]), tuple(values[3:6]), flags), line, stamp)
+
+
+def _parseAxes(line, stamp):
+    # S <x> <y> <z> <x target> <y target> <z target> <running>, the answer to status
+    if not line.startswith("S "):
+        return None
+    try:
+        values = [int(value) for value in line[2:].split(" ")]
+    except ValueError:
+        return Event("malformed", (), line, stamp)
+    if len(values) != 7:
+        return Event("malformed", (), line, stamp)
+    return axesEvent(values[:6], values[6], line, stamp)
+
+
+# Parsers by the first character of a line. Each returns an Event, or None when the
+# line isn't one it knows and is passed on as a plain "line".
+LINE_PARSERS = {
+    "#": lambda line, stamp: Event("debug", (), line, stamp),
+    "o": _parseReply,
+    "e": _parseReply,
+    "W": _parseWelds,
+    "d": _parseDone,
+    "R": _parseProgress,
+    "S": _parseAxes,
+}
+
+
+# Parse one line from the firmware (without line ending) into an Event. A progress
+# line that doesn't parse becomes a "malformed" event instead of progress.
+def parseLine(line, stamp=None):
+    if line == "":
+        return None
+    stamp = time.monotonic() if stamp is None else stamp
+    status = STATUS_LINES.get(line)
+    if status is not None:
+        return Event(status, (), line, stamp)
+    parser = LINE_PARSERS.get(line[0])
+    event = parser(line, stamp) if parser is not None else None
+    return event if event is not None else Event("line", (), line, stamp)
+
+
+class SerialReader(threading.Thread):
+    # Posts an Event for every line received on ser to events, plus Event("lost") when
+    # the port fails, or once `silence` is set, when no pong arrives for that many
+    # seconds: the firmware's heartbeat stopped, or a reset Nano talks at the wrong baud
+    # rate. stop() ends the thread without posting anything.
+    # Listeners are called with each event on the reader thread before it is queued,
+    # for consumers that must not wait for the Tk thread (such as CommandQueue).
+    def __init__(self, ser, events, echo=True, listeners=()):
+        super().__init__(daemon=True)
+        self.ser = ser
+        self.events = events
+        self.echo = echo
+        self.listeners = list(listeners)
+        self._stopping = threading.Event()
+        self._buffer = bytearray()
+        self.frames = None
+        self.silence = None
+        self.lastPong = time.monotonic()
+
+    # Decode frames from now on, e.g. from a listener once the firmware agreed to switch.
+    # Bytes already received after the current line are decoded as frames.
+    def useFrames(self, decoder):
+        self.frames = decoder
+
+    def useLines(self):
+        self.frames = None
+        self._buffer.clear()
+
+    def stop(self):
+        self._stopping.set()
+        try:
+            self.ser.cancel_read()
+        except (AttributeError, serial.SerialException, OSError):
+            pass
+        if self is not threading.current_thread():
+            self.join(1)
+
+    def run(self):
+        self.ser.timeout = READ_TIMEOUT
+        while not self._stopping.is_set():
+            try:
+                data = self.ser.read(1)
+                if data and self.ser.in_waiting:
+                    data += self.ser.read(self.ser.in_waiting)
+            except (serial.SerialException, OSError, TypeError, AttributeError):
+                # TypeError/AttributeError come out of pyserial when the port is closed under it
+                if not self._stopping.is_set():
+                    self.post(Event("lost", (), "", time.monotonic()))
+                return
+            if data:
+                self.feed(data)
+            if self.silence is not None and time.monotonic() - self.lastPong > self.silence:
+                print(f"No heartbeat from the welder for {self.silence:g} s")
+                self.post(Event("lost", (), "", time.monotonic()))
+                return
+
+    # Handle bytes from the port, stamped with when they arrived (now by default)
+    def feed(self, data, stamp=None):
+        stamp = time.monotonic() if stamp is None else stamp
+        frames = self.frames
+        if frames is not None:
+            frames.feed(data)
+            for event in frames.events(stamp):
+                # Heartbeat pongs and positions would flood the console
+                if self.echo and event.kind not in ("pong", "position"):
+                    print(event.line)
+                self.post(event)
+            return
+        self._buffer += data
+        while self.frames is None:
+            end = self._buffer.find(b"\n")
+            if end < 0:
+                return
+            line = self._buffer[:end].rstrip(b"\r").decode("ascii", errors="replace")
+            del self._buffer[:end + 1]
+            if self.echo and line != "pong":
+                print(line)
+            event = parseLine(line, stamp)
+            if event is not None:
+                self.post(event)
+        if self._buffer:
+            data = bytes(self._buffer)
+            self._buffer.clear()
+            self.feed(data, stamp)
+
+    def post(self, event):
+        if event.kind == "pong":
+            self.lastPong = event.time
+        for listener in self.listeners:
+            listener(event)
+        self.events.put(event)
+
+
+# Drain every pending event from events without blocking
+def drain(events):
+    while True:
+        try:
+            yield events.get_nowait()
+        except queue.Empty:
+            return
+
+
+########################################################################
+# Benchmark
+# What the firmware sends around each weld of a pack, with a pause and a debug line
+# now and then, as text lines
+def sampleLines(count):
+    lines = []
+    for index in range(count // 4):
+        row, cell, side = index // 32 % 8, index // 2 % 16, index % 2
+        lines += ["moving", f"R{row} {side} {cell}", "ok weldAt", "idle"]
+        if index % 16 == 0:
+            lines[-1] = "paused" if index % 32 else "# Z at weld height"
+    return lines
+
+
+# The same lines as the firmware frames them on the framed link
+def sampleFrames(lines):
+    from . import protocol
+    statuses = {name: code for code, name in enumerate(protocol.STATUS_TEXT)}
+    position = protocol.POSITION.pack(1200, 3400, 0)
+    data = bytearray()
+    for seq, line in enumerate(lines):
+        if line in statuses:
+            payload = bytes([statuses[line]]) + (position if line in ("idle", "moving") else b"")
+            data += protocol.encodeFrame(seq, protocol.F_STATUS, payload)
+        elif line[0] == "R":
+            row, side, cell = map(int, line[1:].split(" "))
+            data += protocol.encodeFrame(seq, protocol.F_PROGRESS, bytes([row, side, cell]))
+        elif line.startswith("ok "):
+            data += protocol.encodeFrame(seq, protocol.F_ACK, bytes([seq & 0xFF, 1]))
+        else:
+            data += protocol.encodeFrame(seq, protocol.F_TEXT, line.encode("ascii"))
+    return bytes(data)
+
+
+# Messages per second through parseLine alone, and through SerialReader.feed in
+# chunks of chunk bytes as text and as frames
+def benchmark(count=200000, chunk=64):
+    from .protocol import FrameDecoder, FrameEncoder
+    lines = sampleLines(count)
+    results = {}
+
+    began = time.perf_counter()
+    for line in lines:
+        parseLine(line, 0.0)
+    results["parseLine"] = len(lines) / (time.perf_counter() - began)
+
+    streams = (("text", "\n".join(lines).encode("ascii") + b"\n", None),
+               ("frames", sampleFrames(lines), FrameDecoder(FrameEncoder())))
+    for name, data, decoder in streams:
+        events = queue.SimpleQueue()
+        reader = SerialReader(None, events, echo=False)
+        if decoder is not None:
+            reader.useFrames(decoder)
+        began = time.perf_counter()
+        for offset in range(0, len(data), chunk):
+            reader.feed(data[offset:offset + chunk], 0.0)
+        results[name] = len(lines) / (time.perf_counter() - began)
+    return len(lines), results
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m welder.reader", description="Measure the firmware message parser's throughput.")
+    parser.add_argument("--count", type=int, default=200000, help="messages per run")
+    parser.add_argument("--chunk", type=int, default=64, help="bytes handed to the reader at a time")
+    args = parser.parse_args()
+    count, results = benchmark(args.count, args.chunk)
+    print(f"{count} messages, {args.chunk} byte reads")
+    for name, rate in results.items():
+        print(f"{name:10} {rate:12,.0f} messages/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+"""Serial session recorder and replay.
+
+RecordingSerial is a serial.Serial that appends every chunk read or written, and
+every baud rate change, to a session file with a monotonic timestamp, as does the
+client's note of each job it starts (Recorder.mark()):
+
+    MAGIC | start (unix time, double) | records
+
+where each record is RECORD (seconds since the start, direction, length) followed by
+the bytes. Records are flushed as they are written, so a recording survives the
+program dying mid-pack.
+
+Replay feeds the bytes the firmware sent back through the same reader, decoders and
+WelderClient event handling the GUI uses, at the recorded pace, faster, or as fast as
+possible, with the recorded timestamps on every event so metrics come out as they
+were on the floor; each recorded job start hands its mode to the metrics again:
+
+    python -m welder.recording dump session.rec
+    python -m welder.recording replay session.rec --speed 100
+    python -m welder.recording replay session.rec --speed max --viewer
+
+replay also reports how fast the events went through, which makes a long recording a
+benchmark of the parsing and pack viewer update path.
+"""
+import argparse
+import math
+import os
+import struct
+import threading
+import time
+
+import serial
+
+from .geometry import DEFAULT_LAYOUT, layout
+from .protocol import FrameDecoder, FrameEncoder, HostFrameDecoder
+from .reader import SerialReader
+
+DEFAULT_DIR = os.path.join(os.path.expanduser("~"), ".cnc-spot-welder", "sessions")
+MAGIC = b"WELDREC1"
+HEADER = struct.Struct("<d")
+# seconds since the start, direction, length
+RECORD = struct.Struct("<dBH")
+BAUD = struct.Struct("<I")
+
+# Directions
+RX = 0  # bytes from the firmware
+TX = 1  # bytes to the firmware
+BAUDRATE = 2  # the port's baud rate changed, BAUD payload
+MARKER = 3  # a note from the host as text, "job <mode>" when a job starts
+
+DIRECTION_MARKS = {RX: "<", TX: ">", BAUDRATE: "=", MARKER: "*"}
+
+
+class Recorder:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.file = open(path, "wb")
+        self.start = time.monotonic()
+        self.file.write(MAGIC + HEADER.pack(time.time()))
+        self.file.flush()
+        self.lock = threading.Lock()
+
+    def record(self, direction, data):
+        stamp = time.monotonic() - self.start
+        # Chunks are limited by RECORD's length field
+        with self.lock:
+            if self.file is None:
+                return
+            for offset in range(0, len(data), 0xFFFF):
+                chunk = data[offset:offset + 0xFFFF]
+                self.file.write(RECORD.pack(stamp, direction, len(chunk)) + chunk)
+            self.file.flush()
+
+    # Note text in the session, e.g. "job optimize" from WelderClient.runPack
+    def mark(self, text):
+        self.record(MARKER, text.encode("utf-8"))
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+# File name for a session on port started now
+def sessionPath(port, directory=DEFAULT_DIR):
+    name = os.path.basename(port) or "port"
+    return os.path.join(directory, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.rec")
+
+
+class RecordingSerial(serial.Serial):
+    # Records to recorder while one is set
+    def __init__(self, *args, **kwargs):
+        self.recorder = None
+        super().__init__(*args, **kwargs)
+
+    def read(self, size=1):
+        data = super().read(size)
+        if data and self.recorder is not None:
+            self.recorder.record(RX, data)
+        return data
+
+    def write(self, data):
+        if self.recorder is not None:
+            self.recorder.record(TX, data)
+        return super().write(data)
+
+    @serial.Serial.baudrate.setter
+    def baudrate(self, baudrate):
+        serial.Serial.baudrate.fset(self, baudrate)
+        if self.recorder is not None:
+            self.recorder.record(BAUDRATE, BAUD.pack(baudrate))
+
+
+# (start unix time, [(seconds, direction, bytes)]) from a session file
+def readSession(path):
+    with open(path, "rb") as file:
+        data = file.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(f"{path} is not a session recording")
+    start, = HEADER.unpack_from(data, len(MAGIC))
+    offset = len(MAGIC) + HEADER.size
+    records = []
+    while offset + RECORD.size <= len(data):
+        stamp, direction, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if offset + length > len(data):
+            break  # Torn record at the end
+        records.append((stamp, direction, data[offset:offset + length]))
+        offset += length
+    return start, records
+
+
+########################################################################
+# Replay
+class Replay:
+    # Feeds a session's received bytes to client's event handling, as if they had just
+    # come off the port. The client must not be connected; its listeners (the GUI, a
+    # pack viewer) see every event. speed is recorded seconds per real second.
+    def __init__(self, path, client, speed=math.inf, echo=False):
+        self.start, self.records = readSession(path)
+        self.client = client
+        self.speed = speed
+        # Decodes the host's frames so the firmware's acks are reported by name
+        self.encoder = FrameEncoder()
+        self.hostFrames = None
+        self.reader = SerialReader(None, client.events, echo=echo,
+                                   listeners=[self._switchLink, client.metrics.handleEvent])
+        self.events = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+
+    def _switchLink(self, event):
+        if event.kind == "ok" and event.args[0] == "binary" and self.reader.frames is None:
+            self.reader.useFrames(FrameDecoder(self.encoder))
+            self.hostFrames = HostFrameDecoder(self.encoder)
+
+    # A job started here: its mode decides how the metrics read the welds' timing
+    def _mark(self, text):
+        words = text.split()
+        if len(words) == 2 and words[0] == "job":
+            self.client.metrics.startJob(words[1])
+
+    # Replay everything, calling step() after each record (e.g. to update Tk)
+    def run(self, step=None):
+        began = time.monotonic()
+        for stamp, direction, data in self.records:
+            if self.speed != math.inf:
+                wait = began + stamp / self.speed - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+            if direction == TX:
+                if self.hostFrames is not None:
+                    # Decoding registers the names of the commands sent
+                    self.hostFrames.feed(data)
+                    list(self.hostFrames.events(stamp))
+            elif direction == RX:
+                self.bytes += len(data)
+                self.reader.feed(data, stamp)
+                self.events += self.client.poll()
+            elif direction == MARKER:
+                self._mark(data.decode("utf-8", errors="replace"))
+            if step is not None:
+                step()
+        self.elapsed = time.monotonic() - began
+        return self
+
+    def summary(self):
+        duration = self.records[-1][0] if self.records else 0.0
+        rate = self.events / self.elapsed if self.elapsed else math.inf
+        started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.start))
+        return (f"Session from {started}, {duration:.1f} s, {len(self.records)} records, {self.bytes} bytes received\n"
+                f"Replayed {self.events} events in {self.elapsed:.3f} s ({rate:,.0f} events/s, "
+                f"{duration / self.elapsed if self.elapsed else math.inf:,.0f}x real time)\n"
+                f"{self.client.welds.count()}/{self.client.welds.size} welded, last status {self.client.status}")
+
+
+# Session as text lines, both directions, for reading an incident
+def dumpLines(path):
+    start, records = readSession(path)
+    encoder = FrameEncoder()
+    decoders = {RX: None, TX: None}
+    buffers = {RX: bytearray(), TX: bytearray()}
+    for stamp, direction, data in records:
+        mark = DIRECTION_MARKS.get(direction, "?")
+        if direction == BAUDRATE:
+            yield f"{stamp:10.3f} {mark} {BAUD.unpack(data)[0]} baud"
+            continue
+        if direction == MARKER:
+            yield f"{stamp:10.3f} {mark} {data.decode('utf-8', errors='replace')}"
+            continue
+        if decoders[direction] is not None:
+            decoders[direction].feed(data)
+            for event in decoders[direction].events(stamp):
+                yield f"{stamp:10.3f} {mark} {event.line}"
+            continue
+        buffers[direction] += data
+        while decoders[direction] is None:
+            end = buffers[direction].find(b"\n")
+            if end < 0:
+                break
+            line = buffers[direction][:end].rstrip(b"\r").decode("ascii", errors="replace")
+            del buffers[direction][:end + 1]
+            yield f"{stamp:10.3f} {mark} {line}"
+            if direction == RX and line == "ok binary":
+                # Both sides frame everything after this line
+                decoders[RX] = FrameDecoder(encoder)
+                decoders[TX] = HostFrameDecoder(encoder)
+                for side in (TX, RX):
+                    if buffers[side]:
+                        decoders[side].feed(bytes(buffers[side]))
+                        buffers[side].clear()
+                        for event in decoders[side].events(stamp):
+                            yield f"{stamp:10.3f} {DIRECTION_MARKS[side]} {event.line}"
+
+
+def _viewerStep(client, geometry):
+    # The GUI's pack viewer, hidden, updated from the client's events
+    import customtkinter as ctk
+    from .packview import PackViewer
+    root = ctk.CTk()
+    root.withdraw()
+    viewer = PackViewer(root, geometry, lambda row, cell, side: client.welds[row, cell, side] == 1,
+                        lambda row, cell, side: False, lambda event=None: None, lambda: None)
+
+    def handleEvent(event):
+        if event.kind == "welded":
+            viewer.setWelded(*event.args)
+        elif event.kind == "reset":
+            viewer.resetAll()
+
+    client.listeners.append(handleEvent)
+    return root.update_idletasks
+
+
+def main():
+    from .client import WelderClient
+    parser = argparse.ArgumentParser(prog="python -m welder.recording", description="Read or replay a recorded serial session.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    command = commands.add_parser("dump", help="print the session as timestamped lines")
+    command.add_argument("path")
+    command = commands.add_parser("replay", help="feed the session through the client's event handling")
+    command.add_argument("path")
+    command.add_argument("--speed", default="max", help="recorded seconds per real second, or max")
+    command.add_argument("--layout", default=DEFAULT_LAYOUT, help="pack layout of the session")
+    command.add_argument("--echo", action="store_true", help="print every line from the firmware")
+    command.add_argument("--viewer", action="store_true", help="also update a hidden pack viewer (needs a display)")
+    args = parser.parse_args()
+
+    try:
+        if args.command == "dump":
+            for line in dumpLines(args.path):
+                print(line)
+            return
+        speed = math.inf if args.speed == "max" else float(args.speed)
+        client = WelderClient(echo=args.echo, geometry=layout(args.layout))
+        replay = Replay(args.path, client, speed, echo=args.echo)
+        replay.run(_viewerStep(client, client.geometry) if args.viewer else None)
+    except (OSError, ValueError) as error:
+        raise SystemExit(str(error))
+    print(replay.summary())
+    print(client.metrics.summary())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1231 @@
+"""Firmware-accurate simulator of the spot welder behind a pseudo-terminal.
+
+The simulator runs the same command handling as Spot_Welder.ino against a virtual
+clock built from the firmware's axis speeds, accelerations, delays and WELD_TIME.
+It exposes a pty, so anything that opens a serial.Serial (including Welder_GUI.py)
+can connect to it like to the real Arduino.
+
+    python -m welder.simulator --speed 200
+
+prints the port to connect to. --speed max runs as fast as the host allows.
+"""
+import argparse
+import math
+import os
+import re
+import select
+import sys
+import threading
+import time
+import tty
+
+from . import firmware as fw
+from . import protocol
+from .protocol import ST_IDLE, ST_MOVING, ST_PAUSED, ST_FINISHED, ST_ESTOP, ST_PONG
+
+# Longest real time the simulator sleeps in one go, bounds e-stop and shutdown latency
+MAX_REAL_SLEEP = 0.02
+# Shortest real time the idle loop waits, bounds status spam in accelerated modes
+MIN_IDLE_WAIT = 0.02
+# Real time granted to the host to finish writing a line once its first byte arrived
+MIN_READ_WAIT = 0.002
+# Size of the Arduino's serial transmit buffer
+TX_BUFFER = 64
+# Size of its receive buffer. Bytes arriving while it is full and the sketch isn't
+# reading are lost, like on the board.
+RX_BUFFER = 64
+
+
+class SimulatorClosed(Exception):
+    pass
+
+
+# Raised on the firmware thread when the reset button is pressed
+class SimulatorReset(Exception):
+    pass
+
+
+########################################################################
+class SimAxis:
+    # Model of Axis from Axis.h: an AccelStepper driven against the simulator clock.
+    # Positions are kept in steps; the public methods take and return firmware units.
+    # A retarget during a move restarts the profile from rest, which is close enough
+    # for the short corrections the firmware does.
+    def __init__(self, sim, maxSpeed, acceleration, inverted=False, multiplier=1.0, homeDistance=0):
+        self.sim = sim
+        self.maxSpeed = maxSpeed
+        self.acceleration = acceleration
+        self.inverted = inverted
+        self.multiplier = multiplier
+        self.ESTOPPED = False
+        # Step position of the home switch, homing runs towards negative steps unless inverted
+        self.switchAt = homeDistance if inverted else -homeDistance
+        self._from = 0.0
+        self._to = 0
+        self._start = 0.0
+        self._frozen = None
+
+    def _toSteps(self, value):
+        return int((-value if self.inverted else value) * self.multiplier)
+
+    # Same conversion as Axis::getPosition(), including the multiplier being applied again
+    def _toUnits(self, steps):
+        return (-steps if self.inverted else steps) * self.multiplier
+
+    def _profile(self):
+        return self._to - self._from, self.maxSpeed, self.acceleration
+
+    def currentPosition(self):
+        if self._frozen is not None:
+            return self._frozen
+        steps, speed, accel = self._profile()
+        done = fw.moveProgress(self.sim.now - self._start, steps, speed, accel)
+        return self._from + math.copysign(done, steps)
+
+    def speed(self):
+        if self._frozen is not None:
+            return 0.0
+        steps, speed, accel = self._profile()
+        return math.copysign(fw.moveSpeed(self.sim.now - self._start, steps, speed, accel), steps)
+
+    def timeLeft(self):
+        if self._frozen is not None:
+            return math.inf if self.distanceToGo() != 0 else 0.0
+        steps, speed, accel = self._profile()
+        left = fw.moveTime(steps, speed, accel) - (self.sim.now - self._start)
+        return left if left > 1e-9 else 0.0
+
+    def distanceToGo(self):
+        return self._to - int(round(self.currentPosition()))
+
+    # Seconds until getDistanceToGo() is within units of the target, for the firmware's
+    # wait loops on a position short of the target
+    def timeUntilWithin(self, units):
+        if abs(self.getDistanceToGo()) <= units:
+            return 0.0
+        if self._frozen is not None:
+            return math.inf
+        steps, speed, accel = self._profile()
+        remaining = abs(units / self.multiplier)
+        low, high = self.sim.now - self._start, fw.moveTime(steps, speed, accel)
+        for _ in range(40):
+            middle = (low + high) / 2
+            if abs(steps) - fw.moveProgress(middle, steps, speed, accel) <= remaining:
+                high = middle
+            else:
+                low = middle
+        return max(0.0, self._start + high - self.sim.now)
+
+    def moveToSteps(self, target):
+        position = int(round(self.currentPosition()))
+        self._from = float(position)
+        self._to = int(target)
+        self._start = self.sim.now
+
+    def setCurrentPosition(self, steps):
+        self._from = float(steps)
+        self._to = int(steps)
+        if self._frozen is not None:
+            self._frozen = float(steps)
+
+    ########################################################################
+    # Axis.h API
+    def setMaxSpeed(self, speed):
+        if self.isRunning():
+            self.moveToSteps(self._to)
+        self.maxSpeed = speed
+
+    def setAcceleration(self, acceleration):
+        if self.isRunning():
+            self.moveToSteps(self._to)
+        self.acceleration = acceleration
+
+    def move(self, distance):
+        self.moveToSteps(int(round(self.currentPosition())) + self._toSteps(distance))
+
+    def moveTo(self, position):
+        self.moveToSteps(self._toSteps(position))
+
+    def stop(self):
+        speed = self.speed()
+        if speed == 0:
+            return
+        stepsToStop = int(speed * speed / (2.0 * self.acceleration)) + 1
+        self.moveToSteps(int(round(self.currentPosition())) + (stepsToStop if speed > 0 else -stepsToStop))
+
+    def isRunning(self):
+        return self.timeLeft() > 0 or self.distanceToGo() != 0
+
+    def getPosition(self):
+        return self._toUnits(int(round(self.currentPosition())))
+
+    def getTargetPosition(self):
+        return self._toUnits(self._to)
+
+    def getDistanceToGo(self):
+        return self._toUnits(self.distanceToGo())
+
+    def home(self, homeSpeed=fw.HOME_SPEED):
+        sim = self.sim
+        sim.delay(5)
+        sim.delay(5)
+        sim.sendDebug("# Homing")
+        sim.sendDebug(int(self.ESTOPPED))
+        position = self.currentPosition()
+        if not self.ESTOPPED:
+            start = sim.now
+            sim.advance(abs(self.switchAt - position) / homeSpeed)
+            travelled = min(abs(self.switchAt - position), (sim.now - start) * homeSpeed)
+            self.setCurrentPosition(int(round(position + math.copysign(travelled, self.switchAt - position))))
+        sim.sendDebug(int(self.ESTOPPED))
+        self.stop()
+        sim.delay(50)
+        self.move(fw.HOME_BACKOFF)
+        sim.runAxes([self], guarded=True)
+        self.stop()
+        position = int(round(self.currentPosition()))
+        self.switchAt -= position
+        self.setCurrentPosition(0)
+
+    # The stepper gets one more run() call and is then never stepped again until reset,
+    # so the axis freezes where it is with its stopping target still pending
+    def eStop(self):
+        self.sim.sendDebug("# EMERGENCY STOP")
+        self.ESTOPPED = True
+        position = float(int(round(self.currentPosition())))
+        self.stop()
+        self._frozen = position
+
+    def resetEStop(self):
+        if self._frozen is not None:
+            self._from = self._frozen
+            self._start = self.sim.now
+            self._frozen = None
+        self.ESTOPPED = False
+
+
+class SimHorizontalAxis(SimAxis):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mStepover = 0.0
+
+    def setStepover(self, stepover):
+        self.mStepover = stepover
+
+    def getStepover(self):
+        return self.mStepover
+
+    def stepover(self, backwards=False):
+        self.move(-self.mStepover if backwards else self.mStepover)
+
+    def stepoverHalf(self, backwards=False):
+        self.move(-self.mStepover / 2 if backwards else self.mStepover / 2)
+
+    def stepoverCustom(self, stepSize, backwards=False):
+        self.move(-stepSize if backwards else stepSize)
+
+    def stepoverBlocking(self, backwards=False):
+        self.stepover(backwards)
+        self.sim.runAxes([self], guarded=True)
+        self.stop()
+
+    def stepoverHalfBlocking(self, backwards=False):
+        self.stepoverHalf(backwards)
+        self.sim.runAxes([self], guarded=True)
+        self.stop()
+
+    def stepoverBlockingCustom(self, stepSize, backwards=False):
+        self.stepoverCustom(stepSize, backwards)
+        self.sim.runAxes([self], guarded=True)
+        self.stop()
+
+
+class SimZAxis(SimAxis):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mStepdown = 0.0
+
+    def setStepdown(self, stepSize):
+        self.mStepdown = stepSize
+
+    def getStepdown(self):
+        return self.mStepdown
+
+    def stepdown(self):
+        self.move(self.mStepdown)
+
+    def stepup(self):
+        self.move(-self.mStepdown)
+
+    def stepdownCycle(self, pause):
+        self.stepdown()
+        self.sim.runAxes([self], guarded=True)
+        self.stop()
+        self.sim.delay(pause)
+        self.stepup()
+        self.sim.runAxes([self], guarded=True)
+        self.stop()
+
+
+########################################################################
+class WelderSimulator:
+    # Mirror of Spot_Welder.ino. speed is virtual seconds per real second (math.inf for
+    # as fast as possible). The firmware runs on its own thread once start() is called.
+    # Axes follow the clock on their own, so an axis left moving by a non-blocking command
+    # keeps moving during another axis' blocking loop, where the Nano would hold it.
+    def __init__(self, speed=1.0, baud=fw.BAUD, homeDistance=2000):
+        self.speed = float(speed)
+        self.bootBaud = baud
+        self.homeDistance = homeDistance
+        self.now = 0.0
+        self.powerOn()
+
+        self._rx = bytearray()
+        self._rxCondition = threading.Condition()
+        self._busy = False
+        self.rxDropped = 0
+        self._txFree = 0.0
+        self._eStopPending = False
+        self._resetPending = False
+        self._closed = threading.Event()
+        self._threads = []
+        self.master = None
+        self.slave = None
+        self.port = None
+        self.link = None
+
+    # The sketch's globals as they are after a reset
+    def powerOn(self):
+        homeDistance = self.homeDistance
+        self.baud = self.bootBaud
+        self.x = SimHorizontalAxis(self, fw.X_MAX_SPEED, fw.X_ACCELERATION, fw.X_INVERTED, fw.X_MULTIPLIER, homeDistance)
+        self.y = SimHorizontalAxis(self, fw.Y_MAX_SPEED, fw.Y_ACCELERATION, fw.Y_INVERTED, fw.Y_MULTIPLIER, homeDistance)
+        self.z = SimZAxis(self, fw.Z_MAX_SPEED, fw.Z_ACCELERATION, fw.Z_INVERTED, fw.Z_MULTIPLIER, homeDistance)
+
+        self.stopped = False
+        self.packType = fw.PT_A
+        self.lastPrint = 0.0
+        self.row = 0
+        self.cell = 0
+        self.side = 0
+        self.packRows = fw.PACK_ROWS
+        self.packCells = fw.PACK_CELLS
+        self.welded = bytearray(fw.MAX_WELD_BYTES)
+        self.deferredCmd = ""
+        self.awaiting = set()
+        self.jogAxis = None
+        self.lastJog = 0
+        self.binaryMode = False
+        self.txSeq = 0
+        self.cmdSeq = 0
+        self.deferredSeq = 0
+        self.lastFrame = 0
+        self.beatInterval = 0
+        self.lastBeat = 0
+        self.eStopPending = False
+        self.weldTime = fw.WELD_TIME
+        self.cellDelay = fw.SERIES_CELL_DELAY
+        self.passDelay = fw.SERIES_PASS_DELAY
+        self.rowDelay = fw.PACK_ROW_DELAY
+
+    # Set the axes and timing to profile (fw.Profile) like the commands would
+    def applyProfile(self, profile):
+        for axis, speed, acceleration in ((self.x, profile.xSpeed, profile.xAcceleration),
+                                          (self.y, profile.ySpeed, profile.yAcceleration),
+                                          (self.z, profile.zSpeed, profile.zAcceleration)):
+            axis.setMaxSpeed(speed)
+            axis.setAcceleration(acceleration)
+        self.weldTime, self.cellDelay, self.passDelay, self.rowDelay = profile[6:]
+
+    ########################################################################
+    # Virtual time
+    # Waits like delay() and the blocking loops, which yield() to the heartbeat;
+    # Serial.flush() doesn't, it passes yielding=False
+    def advance(self, seconds, interruptible=True, yielding=True):
+        if seconds <= 0:
+            self._serviceEStop()
+            return
+        if math.isinf(self.speed):
+            self.now += seconds
+            self._serviceEStop()
+            if yielding:
+                self.onYield()
+            return
+        end = self.now + seconds
+        self._busy = True
+        try:
+            while self.now < end:
+                if self._closed.is_set():
+                    raise SimulatorClosed()
+                step = min(end - self.now, MAX_REAL_SLEEP * self.speed)
+                time.sleep(step / self.speed)
+                self.now += step
+                if yielding:
+                    self.onYield()
+                if self._serviceEStop() and interruptible:
+                    return
+        finally:
+            self._busy = False
+
+    def delay(self, ms):
+        self.advance(ms / 1000.0)
+
+    # Rounding error must not truncate a deadline computed from millis() to one ms
+    # short, or loop() would wait zero seconds for it forever
+    def millis(self):
+        return int(self.now * 1000 + 1e-6)
+
+    # millis() for the link timeout. The host's heartbeat runs on real time, so the
+    # timeout does too, whatever the speed.
+    def linkMillis(self):
+        return int(time.monotonic() * 1000)
+
+    # yield(), called by delay() and the blocking loops
+    def onYield(self):
+        self.reportEStop()
+        self.beat()
+
+    # Send the ESTOP status the interrupt left pending, never from eStop() itself
+    def reportEStop(self):
+        if self.eStopPending:
+            self.eStopPending = False
+            self.sendStatus(ST_ESTOP)
+
+    # beat(), called from yield(): with the heartbeat on, a pong at least every
+    # beatInterval ms. The host watches it on real time, so it runs on linkMillis().
+    def beat(self):
+        if self.beatInterval and self.linkMillis() - self.lastBeat >= self.beatInterval:
+            self.lastBeat = self.linkMillis()
+            self.sendStatus(ST_PONG)
+
+    # Busy-wait on the given axes like the firmware's while (...isRunning()) loops.
+    # Guarded loops also give up on an emergency stop, unguarded ones hang like the Nano does.
+    def runAxes(self, axes, guarded=False):
+        while True:
+            if guarded and any(axis.ESTOPPED for axis in axes):
+                return
+            left = max(axis.timeLeft() for axis in axes)
+            if left <= 0:
+                return
+            if math.isinf(left):
+                # The Nano's loop still calls run() and so yield(), which reports the
+                # e-stop and keeps the heartbeat going; the reset button gets it out
+                while not self._closed.wait(MAX_REAL_SLEEP):
+                    self.onYield()
+                    self._serviceEStop()
+                raise SimulatorClosed()
+            self.advance(left)
+
+    ########################################################################
+    # Emergency stop interrupt
+    def pressEStop(self):
+        with self._rxCondition:
+            self._eStopPending = True
+            self._rxCondition.notify_all()
+
+    # The reset button, like a brown-out or a USB glitch resetting the Nano: the sketch
+    # starts over from setup() with its globals cleared
+    def pressReset(self):
+        with self._rxCondition:
+            self._resetPending = True
+            self._rxCondition.notify_all()
+
+    def _serviceEStop(self):
+        if self._resetPending:
+            self._resetPending = False
+            raise SimulatorReset()
+        if not self._eStopPending:
+            return False
+        self._eStopPending = False
+        self.eStop()
+        return True
+
+    # The interrupt handler: interrupts are off, so its delay doesn't yield
+    def eStop(self):
+        self.advance(0.02, yielding=False)
+        self.x.eStop()
+        self.y.eStop()
+        self.z.eStop()
+        self.stopped = True
+        self.eStopPending = True
+
+    ########################################################################
+    # Serial port
+    def println(self, value=""):
+        self.transmit((str(value) + "\r\n").encode("ascii", errors="replace"))
+
+    # Serial.write(): queue data behind what is still being sent, waiting when the
+    # transmit buffer is full
+    def transmit(self, data):
+        byteTime = 10.0 / self.baud
+        self._txFree = max(self._txFree, self.now) + len(data) * byteTime
+        backlog = self._txFree - self.now - TX_BUFFER * byteTime
+        if backlog > 0:
+            self.now += backlog
+            if not math.isinf(self.speed):
+                time.sleep(backlog / self.speed)
+        self.write(data)
+
+    def write(self, data):
+        if self.master is None:
+            return
+        try:
+            os.write(self.master, data)
+        except (BlockingIOError, OSError):
+            pass  # Nobody is reading, the bytes are lost like on the real board
+
+    # Bytes from the host. loop() takes them as they arrive; during delays and blocking
+    # moves nothing reads, and whatever doesn't fit the receive buffer is dropped.
+    def feed(self, data):
+        with self._rxCondition:
+            room = max(0, RX_BUFFER - len(self._rx)) if self._busy else len(data)
+            if len(data) > room:
+                self.rxDropped += len(data) - room
+                print("Receive buffer full, dropped %d bytes" % (len(data) - room), file=sys.stderr)
+                data = data[:room]
+            self._rx += data
+            self._rxCondition.notify_all()
+
+    def available(self):
+        return len(self._rx)
+
+    # Serial.flush(): wait until everything has been sent
+    def flush(self):
+        self.advance(self._txFree - self.now, interruptible=False, yielding=False)
+
+    # Stream::read(): next byte or -1
+    def read(self):
+        with self._rxCondition:
+            if not self._rx:
+                return -1
+            value = self._rx[0]
+            del self._rx[:1]
+        return value
+
+    # Stream::readBytes(): up to count bytes, waiting up to the timeout for each
+    def readBytes(self, count):
+        while len(self._rx) < count and self._waitRx(fw.SERIAL_TIMEOUT / 1000.0, MIN_READ_WAIT):
+            pass
+        with self._rxCondition:
+            data = bytes(self._rx[:count])
+            del self._rx[:count]
+        return data
+
+    def _waitRx(self, seconds, minimum):
+        real = minimum if math.isinf(self.speed) else max(seconds / self.speed, minimum)
+        size = len(self._rx)
+        start = time.monotonic()
+        with self._rxCondition:
+            arrived = self._rxCondition.wait_for(
+                lambda: len(self._rx) != size or self._eStopPending or self._resetPending or self._closed.is_set(), real)
+        if self._closed.is_set():
+            raise SimulatorClosed()
+        if len(self._rx) != size:
+            self.now += min(seconds, (time.monotonic() - start) * self.speed)
+        else:
+            self.now += seconds
+        self._serviceEStop()
+        return arrived and len(self._rx) != size
+
+    # Stream::readStringUntil('\n'): up to the terminator, or whatever arrived until the line went quiet
+    def readStringUntil(self, terminator=b"\n"):
+        while terminator not in self._rx and self._waitRx(fw.SERIAL_TIMEOUT / 1000.0, MIN_READ_WAIT):
+            pass
+        with self._rxCondition:
+            end = self._rx.find(terminator)
+            end = len(self._rx) if end < 0 else end
+            data = bytes(self._rx[:end])
+            del self._rx[:end + 1]
+        return data.decode("ascii", errors="replace")
+
+    ########################################################################
+    # Pty plumbing
+    def open(self, link=None):
+        self.link = link
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.port = os.ttyname(self.slave)
+        if link:
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(self.port, link)
+            self.port = link
+        return self.port
+
+    def start(self, link=None):
+        if self.master is None:
+            self.open(link)
+        self._threads = [threading.Thread(target=self._rxThread, daemon=True),
+                         threading.Thread(target=self._firmwareThread, daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        return self.port
+
+    def close(self):
+        self._closed.set()
+        with self._rxCondition:
+            self._rxCondition.notify_all()
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join(1)
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                os.close(fd)
+        self.master = self.slave = None
+
+    # Pull the USB cable for seconds: the host's port fails, and the Nano comes back
+    # reset behind a new port (under the same link)
+    def unplug(self, seconds=1.0):
+        master, slave = self.master, self.slave
+        self.master = self.slave = None
+        os.close(master)
+        os.close(slave)
+        time.sleep(seconds)
+        self.pressReset()
+        self.open(self.link)
+        return self.port
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _rxThread(self):
+        while not self._closed.is_set():
+            master = self.master
+            if master is None:
+                time.sleep(0.05)  # Unplugged
+                continue
+            try:
+                ready, _, _ = select.select([master], [], [], 0.1)
+            except (OSError, ValueError):
+                continue  # Closed by unplug()
+            if not ready:
+                continue
+            try:
+                data = os.read(master, 1024)
+            except (BlockingIOError, InterruptedError):
+                continue
+            except OSError:
+                time.sleep(0.05)  # No host has the port open yet
+                continue
+            if data:
+                self.feed(data)
+
+    def _firmwareThread(self):
+        while True:
+            try:
+                self.setup()
+                while True:
+                    self.loop()
+            except SimulatorClosed:
+                return
+            except SimulatorReset:
+                with self._rxCondition:
+                    self._rx.clear()
+                self.powerOn()
+
+    ########################################################################
+    # Spot_Welder.ino
+    def setup(self):
+        self.x.setStepover(fw.X_STEPOVER)
+        self.y.setStepover(fw.Y_STEPOVER)
+        self.z.setStepdown(fw.Z_STEPDOWN)
+        self.delay(10)
+        self.x.resetEStop()
+        self.y.resetEStop()
+        self.z.resetEStop()
+
+    def loop(self):
+        if self.deferredCmd or self.available():
+            cmd, self.deferredCmd = self.deferredCmd, ""
+            if cmd:
+                self.cmdSeq = self.deferredSeq
+            else:
+                cmd = self.readCommand()
+            cmd2 = ""
+            if " " in cmd:
+                cmd, cmd2 = cmd.split(" ", 1)
+            if cmd:
+                self.parseCommand(cmd, cmd2)
+                self.lastFrame = self.linkMillis()
+        if self.binaryMode and not self.available() and self.linkMillis() - self.lastFrame > protocol.LINK_TIMEOUT:
+            # Host stopped sending frames, fall back to text
+            self.flush()
+            self.baud = fw.BAUD
+            self.binaryMode = False
+        if self.jogAxis is not None and self.millis() - self.lastJog > fw.JOG_TIMEOUT:
+            self.jogAxis.stop()
+            self.jogAxis = None
+        self.reportEStop()
+        self.beat()
+        axes = (self.x, self.y, self.z)
+        for name, axis in zip("xyz", axes):
+            if name in self.awaiting and axis.getDistanceToGo() == 0:
+                self.sendDone(name)
+                self.awaiting.discard(name)
+        if self.millis() > self.lastPrint + fw.STATUS_PERIOD:
+            if all(axis.getDistanceToGo() == 0 for axis in axes):
+                self.sendStatus(ST_IDLE)
+            else:
+                self.sendStatus(ST_MOVING)
+            self.lastPrint = self.millis()
+            return
+        wait = (self.lastPrint + fw.STATUS_PERIOD + 1) / 1000.0 - self.now
+        moving = [axis.timeLeft() for axis in axes if axis.timeLeft() > 0 and not math.isinf(axis.timeLeft())]
+        if moving:
+            wait = min(wait, min(moving))
+        if self.jogAxis is not None:
+            wait = min(wait, (self.lastJog + fw.JOG_TIMEOUT + 1) / 1000.0 - self.now)
+        if self.beatInterval and not math.isinf(self.speed):
+            wait = min(wait, (self.lastBeat + self.beatInterval - self.linkMillis()) / 1000.0 * self.speed)
+        if not self.available():
+            self._waitRx(max(wait, 0.0), MIN_IDLE_WAIT)
+
+    ########################################################################
+    # Output, as text lines or frames like the sketch's send* functions
+    def sendFrame(self, kind, payload=b""):
+        self.transmit(protocol.encodeFrame(self.txSeq, kind, payload))
+        self.txSeq = (self.txSeq + 1) & 0xFF
+
+    def sendLine(self, line):
+        if self.binaryMode:
+            self.sendFrame(protocol.F_TEXT, str(line).encode("ascii")[:protocol.MAX_PAYLOAD])
+        else:
+            self.println(line)
+
+    # Debug lines are only sent in text mode
+    def sendDebug(self, line):
+        if not self.binaryMode:
+            self.println(line)
+
+    def sendStatus(self, status):
+        if not self.binaryMode:
+            self.println(protocol.STATUS_TEXT[status])
+            return
+        payload = bytes([status])
+        if status in (ST_IDLE, ST_MOVING):
+            payload += protocol.POSITION.pack(*(int(axis.getPosition()) for axis in (self.x, self.y, self.z)))
+        self.sendFrame(protocol.F_STATUS, payload)
+
+    def sendAxes(self):
+        axes = (self.x, self.y, self.z)
+        values = [int(axis.getPosition()) for axis in axes] + [int(axis.getTargetPosition()) for axis in axes]
+        running = sum(int(axis.isRunning()) << index for index, axis in enumerate(axes))
+        if self.binaryMode:
+            self.sendFrame(protocol.F_AXES, protocol.AXES.pack(*values, running))
+        else:
+            self.println("S " + " ".join(str(value) for value in values + [running]))
+
+    def sendAck(self, cmd, ok, seq):
+        if self.binaryMode:
+            self.sendFrame(protocol.F_ACK, bytes([seq, int(ok)]))
+        else:
+            self.println(("ok " if ok else "err ") + cmd)
+
+    def sendDone(self, name):
+        if self.binaryMode:
+            self.sendFrame(protocol.F_DONE, name.encode("ascii"))
+        else:
+            self.println("done " + name)
+
+    def sendProgress(self):
+        if self.binaryMode:
+            self.sendFrame(protocol.F_PROGRESS, bytes([self.row, self.side, self.cell]))
+        else:
+            self.println("R%d %d %d" % (self.row, self.side, self.cell))
+
+    # Next command, from a text line or a frame; "" for pings and bad frames
+    def readCommand(self):
+        if not self.binaryMode:
+            return self.readStringUntil().strip()
+        if self.read() != protocol.SYNC:
+            return ""
+        header = self.readBytes(3)
+        if len(header) != 3 or header[0] > protocol.MAX_PAYLOAD:
+            return ""
+        payload = self.readBytes(header[0])
+        crc = self.readBytes(2)
+        if len(payload) != header[0] or len(crc) != 2:
+            return ""
+        if protocol.crc16(payload, protocol.crc16(header)) != int.from_bytes(crc, "little"):
+            return ""
+        self.lastFrame = self.linkMillis()
+        self.cmdSeq = header[1]
+        if header[2] == protocol.F_PING:
+            self.sendStatus(ST_PONG)
+            return ""
+        if header[2] == protocol.F_WELDS:
+            return "setWelds " + payload.hex()
+        if header[2] != protocol.F_COMMAND:
+            return ""
+        return payload.decode("ascii", errors="replace").strip()
+
+    def inPack(self, mRow, mCell, mSide):
+        return 0 <= mRow < self.packRows and 0 <= mCell < self.packCells and mSide in (0, 1)
+
+    def weldBytes(self):
+        return (self.packRows * self.packCells * 2 + 7) // 8
+
+    def isWelded(self, mRow, mCell, mSide):
+        i = (mRow * self.packCells + mCell) * 2 + mSide
+        return (self.welded[i >> 3] >> (i & 7)) & 1
+
+    def sendWelds(self):
+        data = bytes(self.welded[:self.weldBytes()])
+        if self.binaryMode:
+            self.sendFrame(protocol.F_WELDS, data)
+            return
+        self.println("W " + data.hex().upper())
+
+    def loadWelds(self, text):
+        try:
+            data = bytes.fromhex(text)
+        except ValueError:
+            return False
+        if len(text) != self.weldBytes() * 2:
+            return False
+        self.welded[:len(data)] = data
+        return True
+
+    def zWeld(self):
+        self.sendProgress()
+        self.z.stepdownCycle(self.weldTime)
+        if self.inPack(self.row, self.cell, self.side):
+            i = (self.row * self.packCells + self.cell) * 2 + self.side
+            self.welded[i >> 3] |= 1 << (i & 7)
+
+    def readControl(self):
+        cmd = self.readCommand()
+        self.sendDebug("# " + cmd)
+        if cmd in ("stop", "pause", "continue", "next"):
+            return cmd
+        if cmd:
+            self.deferredCmd = cmd
+            self.deferredSeq = self.cmdSeq
+        return ""
+
+    def pollPause(self, manual=False):
+        while self.available() or manual:
+            cmd = self.readControl()
+            if cmd == "stop":
+                self.stopped = True
+                break
+            while cmd == "pause":
+                while not self.available():
+                    self.sendStatus(ST_PAUSED)
+                    self.delay(100)
+                following = self.readControl()
+                if following == "stop":
+                    self.stopped = True
+                    break
+                if following:
+                    cmd = following
+            if manual and cmd == "next":
+                break
+            self.delay(20)
+
+    def weldCell(self, mRow, mCell, mSide):
+        self.stopped = False
+        self.moveToCell(mRow, mCell, mSide, self.packType, self.z.getPosition() > fw.Z_ZERO)
+        self.delay(self.cellDelay)
+        self.zWeld()
+        self.delay(self.cellDelay)
+        self.pollPause()
+
+    def weldAt(self, px, py, mRow, mCell, mSide):
+        self.stopped = False
+        self.row = mRow
+        self.cell = mCell
+        self.side = mSide
+        self.moveToPoint(px, py, self.z.getPosition() > fw.Z_ZERO)
+        self.delay(self.cellDelay)
+        self.zWeld()
+        self.delay(self.cellDelay)
+        self.pollPause()
+
+    def zPlunge(self, clear, mRow, mCell, mSide):
+        self.stopped = False
+        self.row = mRow
+        self.cell = mCell
+        self.side = mSide
+        self.runAxes([self.x, self.y], guarded=True)
+        if self.stopped:
+            return
+        self.sendProgress()
+        self.z.moveTo(fw.Z_ZERO + self.z.getStepdown())
+        self.runAxes([self.z], guarded=True)
+        self.delay(self.weldTime)
+        if self.inPack(self.row, self.cell, self.side):
+            i = (self.row * self.packCells + self.cell) * 2 + self.side
+            self.welded[i >> 3] |= 1 << (i & 7)
+        self.z.moveTo(fw.Z_ZERO)
+        # The lift runs towards Z_ZERO, so Z is above clear within Z_ZERO - clear of it
+        self.advance(self.z.timeUntilWithin(max(0.0, clear - fw.Z_ZERO)))
+
+    def xyWaitWithin(self, dx, dy):
+        self.advance(self.x.timeUntilWithin(dx))
+        if not self.stopped:
+            self.advance(self.y.timeUntilWithin(dy))
+
+    def jog(self, axis, direction):
+        if direction == 0:
+            return False
+        if self.jogAxis is not None and self.jogAxis is not axis:
+            self.jogAxis.stop()
+        self.jogAxis = axis
+        self.lastJog = self.millis()
+        axis.move(fw.JOG_DISTANCE if direction > 0 else -fw.JOG_DISTANCE)
+        return True
+
+    def jogStop(self, axis, name):
+        axis.stop()
+        self.awaiting.add(name)
+        if self.jogAxis is axis:
+            self.jogAxis = None
+
+    def runSeries(self, passes=2, cells=fw.PACK_CELLS, manual=False):
+        self.stopped = False
+        for i in range(passes):
+            if self.stopped:
+                break
+            self.side = i
+            for j in range(cells):
+                if self.stopped:
+                    break
+                self.cell = (cells - j - 1) if i % 2 == 1 else j
+                if self.isWelded(self.row, self.cell, self.side):
+                    continue
+                self.moveToCell(self.row, self.cell, self.side, self.packType, False)
+                self.delay(self.cellDelay)
+                self.zWeld()
+                self.delay(self.cellDelay)
+                self.pollPause(manual)
+            if self.stopped:
+                break
+            self.delay(self.passDelay)
+        return not self.stopped
+
+    def runPack(self, passes=2, packType=fw.PT_A):
+        close = not packType
+        for i in range(self.packRows):
+            self.row = i
+            if not self.runSeries(passes, self.packCells, False):
+                return
+            self.y.stepoverBlockingCustom(80 * passes, True)
+            self.y.stepoverHalfBlocking(not close)
+            close = not close
+            self.x.stepoverBlocking()
+            self.delay(self.rowDelay)
+        self.sendStatus(ST_FINISHED)
+
+    def runSeries18650(self, cells, passes=1):
+        self.y.setStepover(889)
+        self.z.setStepdown(250)
+        self.stopped = False
+        for i in range(passes):
+            if self.stopped:
+                break
+            self.sendLine("R%d %d" % (i, 0))
+            self.z.stepdownCycle(fw.WELD_TIME)
+            for j in range(cells):
+                if self.stopped:
+                    break
+                self.sendLine("R%d %d" % (i, j + 1))
+                self.y.stepoverBlocking(True)
+                self.delay(100)
+                self.z.stepdownCycle(fw.WELD_TIME)
+                self.delay(100)
+                while self.available():
+                    cmd = self.readCommand()
+                    if cmd == "stop":
+                        self.stopped = True
+                        break
+                    while cmd == "pause":
+                        while not self.available():
+                            self.sendStatus(ST_PAUSED)
+                            self.delay(100)
+                        cmd = self.readCommand()
+                        if cmd == "stop":
+                            self.stopped = True
+                            break
+            if self.stopped:
+                break
+            self.y.stepoverBlockingCustom(10)
+            self.y.stepoverBlockingCustom(self.y.getStepover() * 6, True)
+            self.delay(1000)
+            while self.available():
+                cmd = self.readCommand()
+                self.sendDebug(cmd)
+                if cmd == "stop":
+                    self.stopped = True
+                    break
+                while cmd == "pause":
+                    while not self.available():
+                        self.sendStatus(ST_PAUSED)
+                        self.delay(100)
+                    cmd = self.readCommand()
+                    if cmd == "stop":
+                        self.stopped = True
+                        break
+        self.sendStatus(ST_FINISHED)
+
+    def align(self, packType):
+        self.z.moveTo(0)
+        self.runAxes([self.z])
+        self.x.moveTo(fw.X_ZERO)
+        if packType == fw.PT_A:
+            self.y.moveTo(fw.Y_ZERO)
+        else:
+            self.y.moveTo(fw.Y_ZERO + self.y.getStepover() / 2)
+        self.runAxes([self.x, self.y])
+        self.z.moveTo(fw.Z_ZERO)
+        self.runAxes([self.z])
+
+    def moveToCell(self, mRow, mCell, mSide, packType, retract=True):
+        self.row = mRow
+        self.cell = mCell
+        self.side = mSide
+        self.moveToPoint(*fw.cellTarget(mRow, mCell, mSide, packType), retract)
+
+    def moveToPoint(self, px, py, retract=True):
+        if retract:
+            self.z.moveTo(0)
+            self.runAxes([self.z])
+        self.x.moveTo(px)
+        self.y.moveTo(py)
+        self.runAxes([self.x, self.y])
+        self.z.moveTo(fw.Z_ZERO)
+        self.runAxes([self.z])
+
+    def parseCommand(self, cmd, cmd2=""):
+        seq = self.cmdSeq
+        self.sendDebug("# " + cmd + " " + cmd2)
+        axes = {"x": self.x, "y": self.y, "z": self.z}
+        axis = axes.get(cmd[:1])
+        name = cmd[1:] if axis is not None else None
+        if cmd == "runSeries":
+            self.runSeries(2)
+        elif cmd == "runSeries18650":
+            self.runSeries18650(toInt(cmd2), 2)
+        elif cmd == "runPack":
+            self.runPack(2, self.packType)
+        elif cmd == "packType":
+            if cmd2 in fw.PACK_TYPES:
+                self.packType = fw.PACK_TYPES[cmd2]
+            else:
+                self.sendDebug("# Unknown pack type " + cmd2)
+                self.sendAck(cmd, False, seq)
+                return
+        elif cmd == "align":
+            self.align(self.packType)
+        elif name == "SetStepSize" and axis is not self.z:
+            axis.setStepover(toFloat(cmd2))
+        elif cmd == "zSetStepSize":
+            self.z.setStepdown(toFloat(cmd2))
+        elif name in ("Stepover", "Stepback") and axis is not self.z:
+            axis.stepover(name == "Stepback")
+            self.awaiting.add(cmd[0])
+        elif cmd == "zStepdown":
+            self.z.stepdown()
+            self.awaiting.add("z")
+        elif cmd == "zStepup":
+            self.z.stepup()
+            self.awaiting.add("z")
+        elif cmd == "zStepCycle":
+            self.z.stepdownCycle(self.weldTime)
+        elif cmd == "zWeld":
+            self.zWeld()
+        elif cmd == "resetWelds":
+            self.welded[:] = bytes(len(self.welded))
+        elif cmd == "packShape":
+            rows, _, cells = cmd2.partition("_")
+            rows, cells = toInt(rows), toInt(cells)
+            if not _ or rows <= 0 or cells <= 0 or rows * cells * 2 > fw.MAX_WELD_BYTES * 8:
+                self.sendDebug("# Bad pack shape " + cmd2)
+                self.sendAck(cmd, False, seq)
+                return
+            if (rows, cells) != (self.packRows, self.packCells):
+                self.welded[:] = bytes(len(self.welded))
+            self.packRows = rows
+            self.packCells = cells
+        elif cmd == "getWelds":
+            self.sendWelds()
+        elif cmd == "setWelds":
+            if not self.loadWelds(cmd2):
+                self.sendDebug("# Bad weld mask")
+                self.sendAck(cmd, False, seq)
+                return
+        elif name == "Home":
+            axis.home({"x": 500, "y": 900, "z": 500}[cmd[0]])
+        elif cmd == "homeAll":
+            self.z.home()
+            self.x.home()
+            self.y.home()
+        elif name == "Move":
+            distance = toFloat(cmd2)
+            self.sendDebug("# %s %.2f" % (cmd, distance))
+            axis.move(distance)
+            self.awaiting.add(cmd[0])
+        elif name == "MoveTo":
+            axis.moveTo(toFloat(cmd2))
+            self.awaiting.add(cmd[0])
+        elif name == "RunMs":
+            self.delay(toFloat(cmd2))
+        elif name == "Jog":
+            if not self.jog(axis, toFloat(cmd2)):
+                self.sendAck(cmd, False, seq)
+                return
+        elif name == "JogStop":
+            self.jogStop(axis, cmd[0])
+        elif name == "Stop":
+            axis.stop()
+        elif cmd == "eStop":
+            self.x.eStop()
+            self.y.eStop()
+            self.z.eStop()
+        elif cmd == "moveToCell":
+            row, cell, side = parseCell(cmd2)
+            self.sendDebug("# %d %d %d" % (row, cell, side))
+            self.moveToCell(row, cell, side, self.packType)
+        elif cmd == "weldCell":
+            row, cell, side = parseCell(cmd2)
+            if not self.inPack(row, cell, side):
+                self.sendDebug("# Cell outside the pack")
+                self.sendAck(cmd, False, seq)
+                return
+            self.weldCell(row, cell, side)
+        elif cmd == "weldAt" or cmd == "moveToPoint":
+            px, first, rest = cmd2.partition("_")
+            py, second, rest = rest.partition("_")
+            row, cell, side = parseCell(rest)
+            if not first or not second or not self.inPack(row, cell, side):
+                self.sendDebug("# Bad weld point " + cmd2)
+                self.sendAck(cmd, False, seq)
+                return
+            if cmd == "weldAt":
+                self.weldAt(toFloat(px), toFloat(py), row, cell, side)
+            else:
+                self.row, self.cell, self.side = row, cell, side
+                self.moveToPoint(toFloat(px), toFloat(py))
+        elif cmd == "zPlunge":
+            clear, found, rest = cmd2.partition("_")
+            row, cell, side = parseCell(rest)
+            if not found or not self.inPack(row, cell, side):
+                self.sendDebug("# Bad plunge " + cmd2)
+                self.sendAck(cmd, False, seq)
+                return
+            self.zPlunge(toFloat(clear), row, cell, side)
+        elif cmd == "xyWaitWithin":
+            dx, _, dy = cmd2.partition("_")
+            self.xyWaitWithin(toFloat(dx), toFloat(dy))
+        elif cmd == "resetEStop":
+            self.x.resetEStop()
+            self.y.resetEStop()
+            self.z.resetEStop()
+        elif cmd == "status":
+            self.sendAxes()
+        elif name == "IsRunning":
+            self.sendLine(int(axis.isRunning()))
+        elif name == "GetPosition":
+            self.sendLine("%.2f" % axis.getPosition())
+        elif name == "GetTargetPosition":
+            self.sendLine("%.2f" % axis.getTargetPosition())
+        elif name == "GetDistanceToGo":
+            self.sendLine("%.2f" % axis.getDistanceToGo())
+        elif name == "SetMaxSpeed":
+            axis.setMaxSpeed(toFloat(cmd2))
+        elif name == "SetAcceleration":
+            axis.setAcceleration(toFloat(cmd2))
+        elif cmd == "setTiming":
+            values = [toInt(value) for value in (cmd2.split("_") + ["", "", ""])[:4]]
+            if values[0] <= 0 or min(values) < 0:
+                self.sendDebug("# Bad timing " + cmd2)
+                self.sendAck(cmd, False, seq)
+                return
+            self.weldTime, self.cellDelay, self.passDelay, self.rowDelay = values
+        elif cmd == "ping":
+            self.sendStatus(ST_PONG)
+        elif cmd == "heartbeat":
+            self.beatInterval = max(0, toInt(cmd2))
+            self.lastBeat = self.linkMillis()
+        elif cmd == "binary":
+            baud = toInt(cmd2)
+            if baud <= 0:
+                self.sendDebug("# Bad baud rate " + cmd2)
+                self.sendAck(cmd, False, seq)
+                return
+            # Acknowledge in text at the old rate, then switch
+            self.sendAck(cmd, True, seq)
+            self.flush()
+            self.baud = baud
+            self.binaryMode = True
+            self.lastFrame = self.linkMillis()
+            return
+        elif cmd == "stop":
+            self.x.stop()
+            self.y.stop()
+            self.z.stop()
+        elif cmd in ("pause", "continue"):
+            pass
+        else:
+            self.sendDebug("# Unknown command " + cmd + ".")
+            self.sendAck(cmd, False, seq)
+            return
+        self.sendAck(cmd, True, seq)
+
+
+# String::toInt() / String::toFloat(): parse the leading number, 0 if there is none
+def toFloat(text):
+    match = re.match(r"\s*[-+]?(\d+\.?\d*|\.\d+)", text)
+    return float(match.group(0)) if match else 0.0
+
+
+def toInt(text):
+    match = re.match(r"\s*[-+]?\d+", text)
+    return int(match.group(0)) if match else 0
+
+
+# parseCell(): "row_cell_side"
+def parseCell(arg):
+    row, _, rest = arg.partition("_")
+    cell, _, side = rest.partition("_")
+    return toInt(row), toInt(cell), toInt(side)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate the spot welder firmware on a pseudo-terminal.")
+    parser.add_argument("--speed", default="1", help="virtual seconds per real second, or 'max'")
+    parser.add_argument("--link", help="also expose the port under this path (symlink)")
+    parser.add_argument("--baud", type=int, default=fw.BAUD, help="simulated baud rate used for transmit timing")
+    args = parser.parse_args()
+
+    speed = math.inf if args.speed == "max" else float(args.speed)
+    sim = WelderSimulator(speed=speed, baud=args.baud)
+    port = sim.start(args.link)
+    print("Simulated welder on %s (speed %s)" % (port, args.speed))
+    sys.stdout.flush()
+    try:
+        while True:
+            line = sys.stdin.readline()
+            if not line:
+                threading.Event().wait()
+            command = line.strip().lower()
+            if command == "estop":
+                sim.pressEStop()
+            elif command == "reset":
+                sim.pressReset()
+            elif command == "unplug":
+                print("Plugged back in on %s" % sim.unplug())
+                sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.close()
+
+
+if __name__ == "__main__":
+    main()
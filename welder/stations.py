@@ -0,0 +1,502 @@
+"""Drive several welders at once from one asyncio event loop.
+
+One GUI per machine means a window, a reader thread and a command thread per port.
+StationController runs every station as a few coroutines on a single loop instead:
+a port is read when the loop sees its file descriptor become readable
+(loop.add_reader, POSIX), or by polling it every POLL_INTERVAL where that is not
+available (Windows), so there is no thread per port. Each Station has its own link,
+weld mask, journal and job; an error, a stall or a lost port on one station is
+caught and shown on that station only.
+
+    python -m welder.stations run-pack --optimize /dev/ttyUSB0 /dev/ttyUSB1
+    python -m welder.stations watch /dev/ttyUSB0 /dev/ttyUSB1
+
+print a dashboard of every station's status and weld progress, taken from its
+R, idle and moving lines.
+"""
+import argparse
+import asyncio
+import collections
+import os
+import sys
+import time
+
+import serial
+
+from . import firmware as fw
+from . import planner
+from .client import (BINARY_COMMAND, HEARTBEAT_INTERVAL, LINK_CONFIRM_TIMEOUT, PING_INTERVAL, READY_TIMEOUT,
+                     framedLink, mergeWelds, textLink)
+from .commands import CommandError, encodeLine
+from .estimate import formatDuration, jobEstimate
+from .geometry import DEFAULT_LAYOUT, layout
+from .journal import DEFAULT_PATH, Journal, shapePath
+from .protocol import LINK_TIMEOUT
+from .reader import parseLine
+from .weldmask import WeldMask
+
+# Seconds between reads of a port the loop can't watch
+POLL_INTERVAL = 0.01
+# Seconds a write may block before the port is given up
+WRITE_TIMEOUT = 1.0
+# A running job without an R line for this long is stalled: it is stopped and the
+# station fails. runPack waits a few seconds between rows, so this is well above that.
+STALL_TIMEOUT = 30.0
+# Seconds between dashboard updates
+DASHBOARD_INTERVAL = 1.0
+
+# Status shown for each status event
+STATUS_TEXT = {
+    "progress": "Running",
+    "paused": "Paused",
+    "estop": "Emergency Stop",
+    "idle": "Idle",
+    "moving": "Moving",
+    "finished": "Finished",
+}
+
+
+class Station:
+    # One welder on one port. Only touched from the event loop's thread.
+    def __init__(self, name, port, geometry=None, journal=None, baud=fw.BAUD, binary=True):
+        self.name = name
+        self.port = port
+        self.geometry = geometry or layout()
+        self.journal = journal
+        self.welds = journal.mask.copy() if journal is not None else WeldMask(*self.geometry.shape)
+        self.baud = baud
+        self.binary = binary
+        self.ser = None
+        self.status = "Disconnected"
+        self.error = None
+        self.framed = False
+        self.position = None
+        # Last (row, cell, side) from an R line
+        self.current = None
+        self.running = False
+        self.stalled = False
+        self.lastProgress = None
+        # estimate.JobEstimate of the running or last job
+        self.estimate = None
+        self._encode = encodeLine
+        self._frames = None
+        self._buffer = bytearray()
+        # (name, future) of commands written and not yet acknowledged, in order
+        self._pending = collections.deque()
+        self._lock = asyncio.Lock()
+        self._resumed = asyncio.Event()
+        self._resumed.set()
+        self._stopping = False
+        self._pong = None
+        self._watching = False
+        self._tasks = []
+        self._lastWrite = 0.0
+
+    ########################################################################
+    # Connection
+    async def connect(self):
+        self.status = "Connecting"
+        self.error = None
+        self.ser = serial.Serial(self.port, self.baud, timeout=0, write_timeout=WRITE_TIMEOUT)
+        self._attach()
+        await self._waitForPong(READY_TIMEOUT)
+        if self.binary:
+            await self._negotiate()
+        self.status = "Connected"
+        self._tasks.append(asyncio.create_task(self._monitor()))
+        await self.command(f"packShape {self.geometry.rows}_{self.geometry.cells}")
+        await self.command("getWelds")
+
+    def close(self, status="Disconnected"):
+        for task in self._tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+        self._tasks = []
+        if self.ser is not None:
+            if self._watching:
+                asyncio.get_running_loop().remove_reader(self.ser.fileno())
+                self._watching = False
+            self.ser.close()
+            self.ser = None
+        self._failPending(ConnectionError(status))
+        self.framed = False
+        self._frames = None
+        self._encode = encodeLine
+        self._buffer.clear()
+        self.running = False
+        self.status = status
+
+    # Read the port from the loop: a reader callback on its file descriptor, or a
+    # polling task on platforms whose ports the loop can't watch
+    def _attach(self):
+        try:
+            asyncio.get_running_loop().add_reader(self.ser.fileno(), self._readable)
+            self._watching = True
+        except (AttributeError, NotImplementedError, ValueError, OSError):
+            self._tasks.append(asyncio.create_task(self._pollPort()))
+
+    def _readable(self):
+        try:
+            data = self.ser.read(self.ser.in_waiting or 1)
+        except (serial.SerialException, OSError, TypeError) as error:
+            self._lost(error)
+            return
+        if data:
+            self.feed(data)
+
+    async def _pollPort(self):
+        while self.ser is not None:
+            self._readable()
+            await asyncio.sleep(POLL_INTERVAL)
+
+    def _lost(self, error):
+        self.error = str(error)
+        self.close("Lost Connection")
+
+    # Ping until the firmware answers, raises TimeoutError after timeout seconds
+    async def _waitForPong(self, timeout):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            self._pong = asyncio.get_running_loop().create_future()
+            self._write("ping")
+            try:
+                await asyncio.wait_for(asyncio.shield(self._pong), PING_INTERVAL)
+                return
+            except asyncio.TimeoutError:
+                pass
+        raise TimeoutError(f"No answer on {self.port}")
+
+    # Switch to the framed protocol, as WelderClient does; old firmware answers
+    # "err binary" and a link that can't follow falls back to text
+    async def _negotiate(self):
+        try:
+            await self.command(BINARY_COMMAND)
+        except CommandError:
+            return
+        try:
+            await self._waitForPong(LINK_CONFIRM_TIMEOUT)
+            self.framed = True
+        except TimeoutError:
+            self._frames = None
+            self._encode = textLink(self.ser, self.baud)
+            # The firmware falls back on its own once no valid frame has come for a while
+            await asyncio.sleep(LINK_TIMEOUT / 1000)
+            await self._waitForPong(READY_TIMEOUT)
+
+    # Heartbeat for the framed link and the stall watchdog. Like CommandQueue, no pings
+    # while a command is in flight: the firmware only reads between welds then.
+    async def _monitor(self):
+        while self.ser is not None:
+            await asyncio.sleep(min(HEARTBEAT_INTERVAL / 2, STALL_TIMEOUT))
+            now = time.monotonic()
+            if self.framed and not self._pending and now - self._lastWrite >= HEARTBEAT_INTERVAL:
+                self._write("ping")
+            if self.running and self._resumed.is_set() and now - self.lastProgress > STALL_TIMEOUT:
+                self._stall()
+
+    # Stop a stalled job and fail the command it waits on, so the job ends with the
+    # station failed instead of waiting forever
+    def _stall(self):
+        self.stalled = True
+        self.status = "Stalled"
+        self.error = f"No progress for {STALL_TIMEOUT:.0f} s"
+        self.stop()
+        self._failPending(TimeoutError(self.error))
+
+    ########################################################################
+    # Commands
+    def _write(self, text):
+        if self.ser is None:
+            return
+        try:
+            self.ser.write(self._encode(text))
+        except (serial.SerialException, OSError) as error:
+            self._lost(error)
+            return
+        self._lastWrite = time.monotonic()
+
+    # Write a command and wait for its "ok", raises CommandError on "err" and
+    # ConnectionError when the port goes away. One command is in flight at a time.
+    async def command(self, text):
+        async with self._lock:
+            if self.ser is None:
+                raise ConnectionError("Not connected")
+            future = asyncio.get_running_loop().create_future()
+            self._pending.append((text.split(" ", 1)[0], future))
+            if self.journal is not None:
+                self.journal.command(text)
+            self._write(text)
+            return await future
+
+    # Write a job control word (pause, continue, stop) ahead of the command in flight
+    def sendUrgent(self, text):
+        if self.journal is not None:
+            self.journal.command(text)
+        self._write(text)
+
+    def _acknowledge(self, name, line, error):
+        for index, (pending, future) in enumerate(self._pending):
+            if pending == name:
+                del self._pending[index]
+                if not future.done():
+                    if error is None:
+                        future.set_result(line)
+                    else:
+                        future.set_exception(error)
+                return
+
+    def _failPending(self, error):
+        while self._pending:
+            name, future = self._pending.popleft()
+            if not future.done():
+                future.set_exception(error)
+
+    ########################################################################
+    # Jobs
+    # Run runPack, or weld order with weldAt commands when given
+    async def runPack(self, order=None):
+        welds = self.welds.copy()
+        self.estimate = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: jobEstimate(welds, self.geometry, order))
+        self.estimate.start()
+        self.running = True
+        self.stalled = False
+        self._stopping = False
+        self.status = "Running"
+        self.lastProgress = time.monotonic()
+        try:
+            if order is None:
+                if self.geometry.packType is None:
+                    raise ValueError(f"Layout {self.geometry.name} has no firmware pack type")
+                await self.command(f"packType {self.geometry.packType}")
+                await self.command("runPack")
+            else:
+                for row, cell, side in order:
+                    await self._resumed.wait()
+                    if self._stopping:
+                        break
+                    await self.command(planner.weldAtCommand(self.geometry, row, cell, side))
+        finally:
+            self.running = False
+        if self.status in ("Running", "Stalled", "Moving", "Idle"):
+            self.status = "Finished"
+
+    # Weld what is left in travel-optimised order. Planning runs off the loop so the
+    # other stations keep being read meanwhile.
+    async def runRemaining(self):
+        cells = self.welds.unwelded()
+        order = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: planner.planOrder(cells, geometry=self.geometry))
+        await self.runPack(order)
+
+    def pause(self):
+        self._resumed.clear()
+        if self.estimate is not None:
+            self.estimate.pause()
+        self.sendUrgent("pause")
+
+    def resume(self):
+        self._resumed.set()
+        # A pause isn't a stall
+        self.lastProgress = time.monotonic()
+        if self.estimate is not None:
+            self.estimate.resume()
+        self.sendUrgent("continue")
+
+    def stop(self):
+        self._stopping = True
+        self._resumed.set()
+        self.sendUrgent("stop")
+
+    ########################################################################
+    # Events
+    def feed(self, data):
+        stamp = time.monotonic()
+        if self._frames is not None:
+            self._frames.feed(data)
+            for event in self._frames.events(stamp):
+                self.handleEvent(event)
+            return
+        self._buffer += data
+        while self._frames is None:
+            end = self._buffer.find(b"\n")
+            if end < 0:
+                return
+            line = self._buffer[:end].rstrip(b"\r").decode("ascii", errors="replace")
+            del self._buffer[:end + 1]
+            event = parseLine(line, stamp)
+            if event is None:
+                continue
+            if event.kind == "ok" and event.args[0] == "binary":
+                # The firmware switches right after this line
+                self._frames, self._encode = framedLink(self.ser)
+            self.handleEvent(event)
+        if self._buffer:
+            data = bytes(self._buffer)
+            self._buffer.clear()
+            self.feed(data)
+
+    def handleEvent(self, event):
+        if event.kind == "ok":
+            self._acknowledge(event.args[0], event.line, None)
+        elif event.kind == "err":
+            self._acknowledge(event.args[0], event.line, CommandError(f"Firmware rejected {event.args[0]}"))
+        elif event.kind == "pong":
+            if self._pong is not None and not self._pong.done():
+                self._pong.set_result(event.time)
+        elif event.kind == "progress":
+            row, cell, side = event.args
+            self.current = event.args
+            self.lastProgress = event.time
+            if self.running and self.estimate is not None:
+                self.estimate.progress(event.time)
+            self.stalled = False
+            if self.geometry.contains(row, cell, side) and not self.welds[row, cell, side]:
+                self.welds[row, cell, side] = 1
+                if self.journal is not None:
+                    self.journal.progress(row, cell, side)
+        elif event.kind == "welds":
+            try:
+                firmwareWelds = WeldMask.fromHex(event.args[0], *self.geometry.shape)
+            except ValueError:
+                return
+            self.welds, _, command = mergeWelds(self.welds, firmwareWelds, self.journal)
+            if command is not None:
+                asyncio.ensure_future(self._quietly(self.command(command)))
+        elif event.kind == "gap":
+            asyncio.ensure_future(self._quietly(self.command("getWelds")))
+        elif event.kind == "position":
+            self.position = event.args
+        elif event.kind == "estop":
+            self._failPending(CommandError("Emergency stop"))
+        if event.kind in ("idle", "moving") and (self.running or self.status == "Finished"):
+            # Between the welds of a job, or after it
+            return
+        if event.kind in STATUS_TEXT:
+            self.status = STATUS_TEXT[event.kind]
+
+    async def _quietly(self, coroutine):
+        try:
+            await coroutine
+        except (CommandError, ConnectionError):
+            pass
+
+    ########################################################################
+    # Dashboard
+    def summary(self):
+        count = self.welds.count()
+        percent = 100 * count / self.welds.size
+        current = "R%d %d %d" % (self.current[0], self.current[2], self.current[1]) if self.current else "-"
+        status = self.status if self.error is None else f"{self.status} ({self.error})"
+        eta = formatDuration(self.estimate.remaining()) if self.running and self.estimate is not None else "-"
+        return f"{self.name:<14} {count:>4}/{self.welds.size:<4} {percent:5.1f}%  {current:<10} {eta:>8}  {status}"
+
+
+class StationController:
+    def __init__(self, stations):
+        self.stations = list(stations)
+
+    # Connect every station and run job(station) on each at once. A station that
+    # fails keeps its error and status; the others carry on. Returns the stations
+    # that failed.
+    async def run(self, job=None, dashboard=sys.stdout):
+        work = asyncio.gather(*(self._runStation(station, job) for station in self.stations))
+        shown = asyncio.create_task(self._showDashboard(dashboard)) if dashboard is not None else None
+        try:
+            await work
+        finally:
+            for station in self.stations:
+                if station.running:
+                    station.stop()
+                station.close(station.status)
+            if shown is not None:
+                shown.cancel()
+                self._printDashboard(dashboard)
+        return [station for station in self.stations if station.error is not None]
+
+    async def _runStation(self, station, job):
+        try:
+            await station.connect()
+            if job is not None:
+                await job(station)
+        except (CommandError, ConnectionError, TimeoutError, ValueError, serial.SerialException) as error:
+            # A lost port has already recorded why
+            if station.error is None:
+                station.error = str(error)
+            if station.ser is not None:
+                station.close("Failed")
+            elif station.status in ("Connecting", "Disconnected"):
+                station.status = "Failed"
+
+    def dashboard(self):
+        return "\n".join(station.summary() for station in self.stations)
+
+    async def _showDashboard(self, out):
+        while True:
+            await asyncio.sleep(DASHBOARD_INTERVAL)
+            self._printDashboard(out)
+
+    def _printDashboard(self, out):
+        print(time.strftime("%H:%M:%S"), file=out)
+        print(self.dashboard(), file=out, flush=True)
+
+
+# Journal of a station, kept apart from the GUI's
+def stationJournal(name, geometry):
+    path = os.path.join(os.path.dirname(DEFAULT_PATH), f"station-{name}.journal")
+    return Journal(shapePath(path, geometry.rows, geometry.cells), WeldMask(*geometry.shape))
+
+
+async def _watch(station):
+    await asyncio.Event().wait()
+
+
+async def _runPack(station):
+    await station.runPack()
+
+
+async def _runRemaining(station):
+    if station.welds.unwelded():
+        await station.runRemaining()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m welder.stations", description="Drive several welders from one process.")
+    parser.add_argument("--baud", type=int, default=fw.BAUD)
+    parser.add_argument("--layout", default=DEFAULT_LAYOUT, help="pack layout from layouts.json")
+    parser.add_argument("--no-journal", action="store_true", help="don't read or write the stations' weld journals")
+    parser.add_argument("--text", action="store_true", help="stay on the text protocol instead of switching to frames")
+    ports = argparse.ArgumentParser(add_help=False)
+    ports.add_argument("ports", nargs="+", help="serial ports, one per station")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("watch", parents=[ports], help="show every station's status until interrupted")
+    command = commands.add_parser("run-pack", parents=[ports], help="weld every remaining cell on every station")
+    command.add_argument("--optimize", action="store_true", help="stream a travel-optimised order")
+    args = parser.parse_args()
+
+    try:
+        geometry = layout(args.layout)
+    except ValueError as error:
+        raise SystemExit(str(error))
+    stations = []
+    for port in args.ports:
+        name = os.path.basename(port)
+        journal = None if args.no_journal else stationJournal(name, geometry)
+        stations.append(Station(name, port, geometry, journal, baud=args.baud, binary=not args.text))
+    job = _watch
+    if args.command == "run-pack":
+        job = _runRemaining if args.optimize or geometry.packType is None else _runPack
+    try:
+        failed = asyncio.run(StationController(stations).run(job))
+    except KeyboardInterrupt:
+        raise SystemExit("Stopped")
+    finally:
+        for station in stations:
+            if station.journal is not None:
+                station.journal.close()
+    if failed:
+        raise SystemExit(", ".join(f"{station.name}: {station.error}" for station in failed))
+
+
+if __name__ == "__main__":
+    main()
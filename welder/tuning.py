@@ -0,0 +1,298 @@
+"""Motion profile tuning: pack time against the operator's limits, on the simulator.
+
+A motion profile (fw.Profile) is the axis speeds and accelerations and the weld
+timing: the weld hold, the settling delay before and after each weld, and the delays
+after a pass and after a row. sweep() runs a whole pack on the simulator for every
+combination of speed and acceleration factors on each axis, up to the operator's
+acceleration limit, and prices every allowed settling delay from those runs. The
+profiles that can't be made faster without a higher acceleration or a shorter
+settling delay make the Pareto front.
+
+The delays only add to a pack's time, nothing moves while the firmware waits, so
+each speed and acceleration setting is simulated once, with marker delays of a few
+ms, and the delays are counted instead of simulated again for every settling time.
+The simulations are spread over a process pool.
+
+    python -m welder.tuning sweep --max-acceleration 8000 --min-settle 50
+    python -m welder.tuning sweep --layout B --save 2
+    python -m welder.tuning show
+    python -m welder.tuning apply --port /dev/ttyUSB0
+    python -m welder.tuning clear
+
+The saved profile is sent to the welder on every connect by the GUI, the command
+line and the job queue, and their time estimates, planned orders and blended moves
+(the xyWaitWithin gates) are computed with it.
+"""
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import time
+
+import serial
+
+from . import firmware as fw
+from . import planner
+from .calibration import calibratedLayout
+from .estimate import TimingSimulator, formatDuration
+from .geometry import DEFAULT_LAYOUT
+from .weldmask import WeldMask
+
+PROFILE_PATH = os.path.join(os.path.expanduser("~"), ".cnc-spot-welder", "profile.json")
+# Factors on the firmware's speed and acceleration of each axis
+SPEED_FACTORS = (1.0, 1.5)
+ACCELERATION_FACTORS = (0.5, 1.0, 1.5, 2.0)
+# Settling delays before and after each weld, in ms
+SETTLE_TIMES = (25, 50, 100)
+# Shortest delay after a pass or a row, in ms, the head has travelled furthest then
+ROW_SETTLE = 500
+# Delays the simulations run with, in ms, cell, pass and row. No other delay() the
+# pack runs through has these lengths, so each is counted apart.
+MARKERS = (1, 2, 3)
+
+# A priced profile, time in seconds for the whole pack
+Result = collections.namedtuple("Result", ["time", "profile"])
+
+
+class CountingSimulator(TimingSimulator):
+    # Counts the delays by length
+    def __init__(self):
+        super().__init__()
+        self.delays = collections.Counter()
+
+    def delay(self, ms):
+        self.delays[ms] += 1
+        super().delay(ms)
+
+
+def peakAcceleration(profile):
+    return max(profile.xAcceleration, profile.yAcceleration, profile.zAcceleration)
+
+
+# [(x speed, x acceleration, y ..., z ...)] for every combination of the factors on
+# each axis, leaving out accelerations above maxAcceleration
+def motionGrid(speedFactors=SPEED_FACTORS, accelerationFactors=ACCELERATION_FACTORS, maxAcceleration=None):
+    axes = []
+    for name, speed, acceleration in (("X", fw.X_MAX_SPEED, fw.X_ACCELERATION), ("Y", fw.Y_MAX_SPEED, fw.Y_ACCELERATION),
+                                      ("Z", fw.Z_MAX_SPEED, fw.Z_ACCELERATION)):
+        options = [(speed * s, acceleration * a) for s in speedFactors for a in accelerationFactors
+                   if maxAcceleration is None or acceleration * a <= maxAcceleration]
+        if not options:
+            raise ValueError(f"No {name} acceleration within {maxAcceleration:g} steps/s^2")
+        axes.append(options)
+    return [x + y + z for x in axes[0] for y in axes[1] for z in axes[2]]
+
+
+# What runPack, or the order streamed as weldAt commands, takes on a simulator running
+# profile. Returns the simulator.
+def simulatePack(geometry, profile, order=None, sim=None):
+    packType = fw.PACK_TYPES.get(geometry.packType, fw.PT_A)
+    sim = planner.alignedSimulator(packType, geometry, sim or TimingSimulator(), profile)
+    if order is None:
+        sim.runPack(2, packType)
+    else:
+        planner.streamOrder(sim, order, geometry)
+    return sim
+
+
+# The order a pack of geometry is streamed in, None for runPack; like WelderClient._jobOrder.
+# A planned order is planned once, for profile, and kept for every profile tried.
+def packOrder(geometry, optimize=False, profile=None):
+    cells = WeldMask(*geometry.shape).unwelded()
+    if optimize or geometry.packType is None:
+        return planner.planOrder(cells, geometry=geometry, profile=profile)
+    if geometry.transform is not None:
+        return planner.patternOrder(cells)
+    return None
+
+
+_geometries = {}
+
+
+# In a pool worker: (motion, pack time with the marker delays, {marker: count})
+def _runMotion(task):
+    layoutName, order, motion, weldTime = task
+    if layoutName not in _geometries:
+        _geometries[layoutName] = calibratedLayout(layoutName)
+    sim = simulatePack(_geometries[layoutName], fw.Profile(*motion, weldTime, *MARKERS), order, CountingSimulator())
+    return motion, sim.now, {marker: sim.delays[marker] for marker in MARKERS}
+
+
+# [Result] for every motion setting and settling delay, fastest first. settleTimes are the
+# delays before and after a weld; after a pass or a row the delay is at least rowSettle.
+def sweep(layoutName, motions, settleTimes=SETTLE_TIMES, rowSettle=ROW_SETTLE, weldTime=fw.WELD_TIME,
+          order=None, workers=None):
+    tasks = [(layoutName, order, motion, weldTime) for motion in motions]
+    # A few chunks per worker: few round trips, and still an even spread
+    chunk = max(1, len(tasks) // (4 * (workers or os.cpu_count() or 1)))
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        for motion, packTime, counts in pool.map(_runMotion, tasks, chunksize=chunk):
+            fixed = packTime - sum(marker * count for marker, count in counts.items()) / 1000.0
+            for settle in settleTimes:
+                delays = (settle, max(settle, rowSettle), max(settle, rowSettle))
+                total = fixed + sum(delay * counts[marker] for delay, marker in zip(delays, MARKERS)) / 1000.0
+                results.append(Result(total, fw.Profile(*motion, weldTime, *delays)))
+    return sorted(results)
+
+
+# The results no other result beats on time, peak acceleration and settling delay at once
+def paretoFront(results):
+    front = []
+    for result in sorted(results, key=lambda r: (r.time, peakAcceleration(r.profile), -r.profile.cellDelay)):
+        dominated = any(peakAcceleration(other.profile) <= peakAcceleration(result.profile)
+                        and other.profile.cellDelay >= result.profile.cellDelay for other in front)
+        if not dominated:
+            front.append(result)
+    return front
+
+
+########################################################################
+# Saved profile
+def loadProfile(path=PROFILE_PATH):
+    try:
+        with open(path) as file:
+            return fw.Profile(**json.load(file)["profile"])
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError) as error:
+        print(f"Ignoring motion profile {path}: {error}")
+        return None
+
+
+def saveProfile(profile, packTime=None, layoutName=None, path=PROFILE_PATH):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temporary = path + ".tmp"
+    with open(temporary, "w") as file:
+        json.dump({"profile": profile._asdict(), "time": time.time(), "layout": layoutName, "packTime": packTime},
+                  file, indent=2)
+    os.replace(temporary, path)
+
+
+def clearProfile(path=PROFILE_PATH):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def describe(profile):
+    return (f"X {profile.xSpeed:g}/{profile.xAcceleration:g}, Y {profile.ySpeed:g}/{profile.yAcceleration:g}, "
+            f"Z {profile.zSpeed:g}/{profile.zAcceleration:g} steps/s, steps/s^2; weld {profile.weldTime} ms, "
+            f"settle {profile.cellDelay} ms, pass {profile.passDelay} ms, row {profile.rowDelay} ms")
+
+
+########################################################################
+# Command line
+def parseFactors(text):
+    return tuple(float(value) for value in text.split(","))
+
+
+def parseTimes(text):
+    return tuple(int(value) for value in text.split(","))
+
+
+def runSweep(args):
+    geometry = calibratedLayout(args.layout)
+    current = loadProfile(args.file) or fw.DEFAULT_PROFILE
+    order = packOrder(geometry, args.optimize, current)
+    motions = motionGrid(args.speeds, args.accelerations, args.max_acceleration)
+    settleTimes = [settle for settle in args.settle if settle >= args.min_settle]
+    if not settleTimes:
+        raise ValueError(f"No settling time of at least {args.min_settle} ms among {args.settle}")
+    weldTime = args.weld_time
+    began = time.monotonic()
+    results = sweep(args.layout, motions, settleTimes, args.row_settle, weldTime, order, args.workers)
+    elapsed = time.monotonic() - began
+    currentTime = simulatePack(geometry, current, order).now
+    front = paretoFront(results)
+    print(f"Layout {args.layout}, {'streamed' if order is not None else 'runPack'}: {len(motions)} motion settings "
+          f"simulated in {elapsed:.1f} s, {len(results)} profiles, {len(front)} on the Pareto front")
+    print(f"Current: {formatDuration(currentTime)} ({describe(current)})")
+    print(f"{'#':>3} {'pack time':>9} {'saved':>7} {'peak acc':>8} {'settle':>6}  profile")
+    for index, result in enumerate(front):
+        profile = result.profile
+        print(f"{index:3d} {formatDuration(result.time):>9} {(currentTime - result.time) / 60:6.1f}m "
+              f"{peakAcceleration(profile):8g} {profile.cellDelay:4d}ms  {describe(profile)}")
+    # The counted delays against a plain simulation of the fastest profile
+    check = simulatePack(geometry, front[0].profile, order).now
+    print(f"Model check: #0 simulated in full takes {formatDuration(check)}, "
+          f"{abs(check - front[0].time) * 1000:.0f} ms from the priced time")
+    if args.save is not None:
+        if not 0 <= args.save < len(front):
+            raise ValueError(f"No profile #{args.save} on the front")
+        saveProfile(front[args.save].profile, front[args.save].time, args.layout, args.file)
+        print(f"Saved #{args.save} to {args.file}, it is sent to the welder on connect")
+
+
+def showProfile(args):
+    try:
+        with open(args.file) as file:
+            saved = json.load(file)
+    except FileNotFoundError:
+        print(f"No motion profile saved, the firmware's defaults are used ({describe(fw.DEFAULT_PROFILE)})")
+        return
+    profile = fw.Profile(**saved["profile"])
+    print(f"Saved {time.strftime('%Y-%m-%d %H:%M', time.localtime(saved['time']))}: {describe(profile)}")
+    if saved.get("packTime") is not None:
+        print(f"Layout {saved['layout']} pack time {formatDuration(saved['packTime'])}")
+    for command in fw.profileCommands(profile):
+        print(command)
+
+
+# Send the saved profile, or the firmware's defaults, now
+def applyProfile(args):
+    from .client import WelderClient
+    profile = None if args.default else loadProfile(args.file)
+    if profile is None and not args.default:
+        raise ValueError(f"No motion profile saved in {args.file}")
+    client = WelderClient(echo=args.echo, baud=args.baud, binary=not args.text)
+    try:
+        client.connect(args.port)
+        if not client.waitReady():
+            raise SystemExit(f"No answer from the welder on {args.port}")
+        client.wait(client.setProfile(profile), 5)
+        print(f"Sent {describe(profile or fw.DEFAULT_PROFILE)}")
+    except serial.SerialException as error:
+        raise SystemExit(f"Could not open {args.port}: {error}")
+    finally:
+        client.close()
+
+
+def main():
+    from .commands import CommandError
+    parser = argparse.ArgumentParser(prog="python -m welder.tuning", description="Tune the welder's motion profile on the simulator.")
+    parser.add_argument("--file", default=PROFILE_PATH, help="saved motion profile")
+    commands = parser.add_subparsers(dest="command", required=True)
+    command = commands.add_parser("sweep", help="simulate the profiles within the limits and print the Pareto front")
+    command.add_argument("--layout", default=DEFAULT_LAYOUT, help="pack layout from layouts.json")
+    command.add_argument("--optimize", action="store_true", help="weld in planned order instead of the runPack pattern")
+    command.add_argument("--speeds", type=parseFactors, default=SPEED_FACTORS, help="speed factors, e.g. 1,1.25,1.5")
+    command.add_argument("--accelerations", type=parseFactors, default=ACCELERATION_FACTORS, help="acceleration factors")
+    command.add_argument("--max-acceleration", type=float, help="highest acceleration of any axis, steps/s^2")
+    command.add_argument("--settle", type=parseTimes, default=SETTLE_TIMES, help="settling delays to try, ms")
+    command.add_argument("--min-settle", type=int, default=0, help="shortest settling delay before and after a weld, ms")
+    command.add_argument("--row-settle", type=int, default=ROW_SETTLE, help="shortest delay after a pass or a row, ms")
+    command.add_argument("--weld-time", type=int, default=fw.WELD_TIME, help="weld hold, ms")
+    command.add_argument("--workers", type=int, help="simulation processes, the number of CPUs by default")
+    command.add_argument("--save", type=int, metavar="N", help="save profile #N of the front")
+    command.set_defaults(run=runSweep)
+    commands.add_parser("show", help="print the saved profile").set_defaults(run=showProfile)
+    command = commands.add_parser("apply", help="send the saved profile to the welder now")
+    command.add_argument("--port", required=True, help="serial port of the welder")
+    command.add_argument("--baud", type=int, default=fw.BAUD)
+    command.add_argument("--text", action="store_true", help="stay on the text protocol instead of switching to frames")
+    command.add_argument("--echo", action="store_true", help="print every line from the firmware")
+    command.add_argument("--default", action="store_true", help="send the firmware's defaults instead")
+    command.set_defaults(run=applyProfile)
+    commands.add_parser("clear", help="go back to the firmware's defaults on connect").set_defaults(
+        run=lambda args: clearProfile(args.file))
+    args = parser.parse_args()
+
+    try:
+        args.run(args)
+    except (ValueError, OSError, CommandError, ConnectionError, TimeoutError) as error:
+        raise SystemExit(str(error))
+
+
+if __name__ == "__main__":
+    main()
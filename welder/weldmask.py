@@ -0,0 +1,140 @@
+"""Packed bitmap of welded cell sides.
+
+Two bits per cell (side 0 in the low bit), cells in row-major order, eight bits per
+byte starting at the least significant bit. For the 16x24 pack that is 96 bytes and
+matches the layout of the firmware's getWelds/setWelds commands, which carry the
+mask as hex so the whole pack syncs in one exchange.
+"""
+from . import firmware as fw
+
+# Set bits per byte value
+POPCOUNT = bytes(bin(value).count("1") for value in range(256))
+# 1 for every byte value that still has an unwelded side
+NOT_FULL = bytes(int(value != 0xFF) for value in range(256))
+
+
+class WeldMask:
+    def __init__(self, rows=fw.PACK_ROWS, cells=fw.PACK_CELLS, sides=fw.PACK_SIDES, data=None):
+        self.rows = rows
+        self.cells = cells
+        self.sides = sides
+        self.size = rows * cells * sides
+        self.bits = bytearray((self.size + 7) // 8)
+        if data is not None:
+            self.load(data)
+
+    def _index(self, row, cell, side):
+        return (row * self.cells + cell) * self.sides + side
+
+    def _cell(self, index):
+        cell, side = divmod(index, self.sides)
+        row, cell = divmod(cell, self.cells)
+        return row, cell, side
+
+    def __getitem__(self, key):
+        index = self._index(*key)
+        return (self.bits[index >> 3] >> (index & 7)) & 1
+
+    def __setitem__(self, key, value):
+        index = self._index(*key)
+        if value:
+            self.bits[index >> 3] |= 1 << (index & 7)
+        else:
+            self.bits[index >> 3] &= ~(1 << (index & 7)) & 0xFF
+
+    def __eq__(self, other):
+        return isinstance(other, WeldMask) and self.bits == other.bits
+
+    def copy(self):
+        return WeldMask(self.rows, self.cells, self.sides, self.bits)
+
+    def clear(self):
+        self.bits[:] = bytes(len(self.bits))
+
+    def fill(self):
+        self.bits[:] = b"\xff" * len(self.bits)
+        if self.size % 8:
+            self.bits[-1] = (1 << (self.size % 8)) - 1
+
+    def load(self, data):
+        if len(data) != len(self.bits):
+            raise ValueError(f"Weld mask needs {len(self.bits)} bytes, got {len(data)}")
+        self.bits[:] = data
+
+    ########################################################################
+    # Queries
+    def count(self):
+        return sum(self.bits.translate(POPCOUNT))
+
+    def remainingCount(self):
+        return self.size - self.count()
+
+    # Welded sides per row
+    def rowCounts(self):
+        rowBits = self.cells * self.sides
+        if rowBits % 8 == 0:
+            rowBytes = rowBits // 8
+            counts = self.bits.translate(POPCOUNT)
+            return [sum(counts[row * rowBytes:(row + 1) * rowBytes]) for row in range(self.rows)]
+        return [sum(self[row, cell, side] for cell in range(self.cells) for side in range(self.sides))
+                for row in range(self.rows)]
+
+    # Fraction welded per row
+    def rowCompletion(self):
+        rowSize = self.cells * self.sides
+        return [count / rowSize for count in self.rowCounts()]
+
+    # First unwelded (row, cell, side) in row-major order, or None when all are welded
+    def nextUnwelded(self):
+        notFull = self.bits.translate(NOT_FULL)
+        byte = notFull.find(1)
+        while 0 <= byte:
+            value = self.bits[byte]
+            for bit in range(8):
+                index = byte * 8 + bit
+                if index >= self.size:
+                    return None
+                if not (value >> bit) & 1:
+                    return self._cell(index)
+            byte = notFull.find(1, byte + 1)
+        return None
+
+    def unwelded(self):
+        return [self._cell(index) for index in self._indices(invert=True)]
+
+    def welded(self):
+        return [self._cell(index) for index in self._indices()]
+
+    def _indices(self, invert=False):
+        value = int.from_bytes(self.bits, "little")
+        if invert:
+            value = ~value & ((1 << self.size) - 1)
+        while value:
+            low = value & -value
+            index = low.bit_length() - 1
+            yield index
+            value ^= low
+
+    # Cells whose state differs between two masks of the same shape
+    def diff(self, other):
+        changed = int.from_bytes(self.bits, "little") ^ int.from_bytes(other.bits, "little")
+        cells = []
+        while changed:
+            low = changed & -changed
+            cells.append(self._cell(low.bit_length() - 1))
+            changed ^= low
+        return cells
+
+    def __or__(self, other):
+        merged = self.copy()
+        merged.bits[:] = bytes(a | b for a, b in zip(self.bits, other.bits))
+        return merged
+
+    ########################################################################
+    # Firmware exchange
+    def toHex(self):
+        return self.bits.hex().upper()
+
+    @classmethod
+    def fromHex(cls, text, rows=fw.PACK_ROWS, cells=fw.PACK_CELLS, sides=fw.PACK_SIDES):
+        return cls(rows, cells, sides, bytes.fromhex(text.strip()))